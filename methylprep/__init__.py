@@ -1,17 +1,9 @@
 # Lib
+from importlib import import_module
 from logging import NullHandler, getLogger
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 # App
-from .files import get_sample_sheet, get_sample_sheet_s3
-from .processing import (
-    run_pipeline,
-    make_pipeline,
-    consolidate_values_for_sheet
-    )
-from .download import run_series, run_series_list, convert_miniml, build_composite_dataset
-from .models import ArrayType, parse_sample_sheet_into_idat_datasets
-from .files import Manifest
 from .version import __version__
 
 getLogger(__name__).addHandler(NullHandler())
@@ -19,6 +11,24 @@ getLogger(__name__).addHandler(NullHandler())
 #import numpy as np
 #np.seterr(all='raise') -- for debugging overflow / underflow somewhere
 
+# v1.7.2: public names are imported on first use (PEP 562), so `import methylprep` and CLI startup
+# don't load pandas, scipy, statsmodels or the GEO download stack until something needs them.
+_LAZY_IMPORTS = {
+    'ArrayType': '.models',
+    'Manifest': '.files',
+    'get_sample_sheet': '.files',
+    'get_sample_sheet_s3': '.files',
+    'parse_sample_sheet_into_idat_datasets': '.models',
+    'consolidate_values_for_sheet': '.processing',
+    'run_series': '.download',
+    'run_series_list': '.download',
+    'convert_miniml': '.download',
+    'build_composite_dataset': '.download',
+    'run_pipeline': '.processing',
+    'make_pipeline': '.processing',
+}
+_SUBPACKAGES = ('download', 'files', 'models', 'processing', 'utils', 'cli')
+
 __all__ = [
     'ArrayType',
     'Manifest',
@@ -34,3 +44,17 @@ __all__ = [
     'run_pipeline',
     'make_pipeline',
 ]
+
+
+def __getattr__(name):
+    if name in _LAZY_IMPORTS:
+        value = getattr(import_module(_LAZY_IMPORTS[name], __name__), name)
+        globals()[name] = value # later lookups skip __getattr__
+        return value
+    if name in _SUBPACKAGES:
+        return import_module(f'.{name}', __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_IMPORTS) | set(_SUBPACKAGES))
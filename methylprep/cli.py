@@ -3,18 +3,8 @@ import argparse
 import logging
 from pathlib import Path
 import sys
-# App
-from .files import get_sample_sheet
-from .models import ArrayType
-from .processing import run_pipeline
-from .download import (
-    run_series,
-    run_series_list,
-    convert_miniml,
-    build_composite_dataset,
-    search,
-    pipeline_find_betas_any_source
-    )
+# subcommands import what they need when they run, so `python -m methylprep <command>` doesn't load
+# scipy/statsmodels for downloads, or the GEO/methylcheck stack for processing.
 
 LOGGER = logging.getLogger(__name__)
 
@@ -53,6 +43,9 @@ def build_parser():
     process_parser = subparsers.add_parser('process', help='Finds idat files and calculates raw, beta, m_values for a batch of samples.')
     process_parser.set_defaults(func=cli_process)
 
+    rethreshold_parser = subparsers.add_parser('rethreshold', help='Regenerates beta_values and m_values from saved poobah_values and noob_meth/unmeth_values with a new p-value threshold, without reprocessing IDATs.')
+    rethreshold_parser.set_defaults(func=cli_rethreshold)
+
     beta_bake_parser = subparsers.add_parser('beta_bake', help='All encompasing pipeline that will find GEO datasets in any form, download, and convert into a pickled dataframe of beta-values. Just specify the GEO_ID.')
     beta_bake_parser.set_defaults(func=cli_beta_bakery)
 
@@ -84,6 +77,9 @@ def build_parser():
 
 
 def cli_process(cmd_args):
+    from functools import partial
+    from .models import ArrayType
+    from .processing import run_pipeline, watch_pipeline
     parser = DefaultParser(
         prog='methylprep process',
         description='Process Illumina IDAT files, producing NOOB, beta-value, or m_value corrected scores per probe per sample',
@@ -152,8 +148,127 @@ def cli_process(cmd_args):
     parser.add_argument(
         '--batch_size',
         required=False,
+        type=lambda value: value if value == 'auto' else int(value),
+        help='If specified, samples will be processed and saved in batches no greater than the specified batch size. `auto` picks the batch size (and --workers, if not given) that fits in the available memory.'
+    )
+
+    parser.add_argument(
+        '--max_memory',
+        required=False,
+        type=str,
+        help='With --batch_size auto, the most memory to use, like 16G or 512M. Default: 80%% of the memory available to this process (including container limits).'
+    )
+
+    parser.add_argument(
+        '-j', '--workers',
+        required=False,
+        type=int,
+        default=None,
+        help='Number of samples to process in parallel, each in its own process. Use -1 for one worker per CPU. Outputs are identical to processing one sample at a time.'
+    )
+
+    parser.add_argument(
+        '--append',
+        required=False,
+        action='store_true',
+        default=False,
+        help='If specified, only samples that are not in the existing output files (beta_values, noob_meth_values, ...) in the data_dir are processed, and their columns are added to those files.'
+    )
+
+    parser.add_argument(
+        '--resume',
+        required=False,
+        action='store_true',
+        default=False,
+        help='If specified, each processed sample is checkpointed in the data_dir, and an interrupted run started again with --resume only processes the samples that were not finished (or whose IDATs or settings changed).'
+    )
+
+    parser.add_argument(
+        '--stream',
+        required=False,
+        action='store_true',
+        default=False,
+        help='If specified, each output matrix (beta_values, noob_meth_values, ...) is a memory-mapped file that each sample is written into as soon as it is processed, so memory use stays flat for any number of samples and batches are not merged.'
+    )
+
+    parser.add_argument(
+        '--cache_dir',
+        required=False,
+        type=str,
+        default=None,
+        help='A folder to cache each processed sample (and its p-values) in. Later runs over the same IDATs, with the same processing settings, reuse them; a run that only changes poobah_sig or the NOOB / dye-bias steps still reuses the p-values.'
+    )
+
+    parser.add_argument(
+        '--cache_size',
+        required=False,
+        type=str,
+        default='20G',
+        help='The --cache_dir size budget, like 20G or 500M. The least recently used samples are removed to stay under it.'
+    )
+
+    parser.add_argument(
+        '--concurrent_arrays',
+        required=False,
+        action='store_true',
+        default=False,
+        help='If the data_dir has sample sheets for several array types (like a GEO package of 450k and EPIC samples), process the array types at the same time instead of one after another. Each array type is saved in its own data_dir/<array type> folder either way.'
+    )
+
+    parser.add_argument(
+        '--shard',
+        required=False,
+        choices=['auto'],
+        default=None,
+        help='Run this as one of several workers (on one machine, or on cluster nodes that share the data_dir) that process the data_dir together: each claims shards of --batch_size samples (16 by default) through lock files in data_dir/.methylprep_shards, and the last one merges every shard into the usual output files. Start every worker with the same options.'
+    )
+
+    parser.add_argument(
+        '--shard_lease',
+        required=False,
         type=int,
-        help='If specified, samples will be processed and saved in batches no greater than the specified batch size'
+        default=1800,
+        help='With --shard auto: seconds after which the shard of a worker that stopped (and stopped renewing its claim) is processed by another worker.'
+    )
+
+    parser.add_argument(
+        '--watch',
+        required=False,
+        action='store_true',
+        default=False,
+        help='Keep running, and process IDATs as a scanner saves them in data_dir: each sample with both a Grn and a Red IDAT, unchanged for --watch_settle seconds, is added to the output files (in runs of up to --batch_size samples, 16 by default). A restarted --watch continues where it stopped. Stop it with Ctrl-C.'
+    )
+
+    parser.add_argument(
+        '--watch_interval',
+        required=False,
+        type=float,
+        default=30,
+        help='With --watch: seconds between searches of data_dir for new IDATs.'
+    )
+
+    parser.add_argument(
+        '--watch_settle',
+        required=False,
+        type=float,
+        default=60,
+        help='With --watch: seconds an IDAT must be unchanged before it is processed.'
+    )
+
+    parser.add_argument(
+        '--watch_idle',
+        required=False,
+        type=float,
+        default=None,
+        help='With --watch: stop once no new samples have arrived for this many seconds, instead of running until interrupted.'
+    )
+
+    parser.add_argument(
+        '--profile',
+        required=False,
+        action='store_true',
+        default=False,
+        help='If specified, the wall time, CPU time and peak memory of each processing stage is recorded for each sample and saved as methylprep_profile.json and .csv in the data_dir.'
     )
 
     parser.add_argument(
@@ -200,8 +315,8 @@ def cli_process(cmd_args):
         '--poobah',
         required=False,
         action='store_true',
-        default=False,
-        help='By default, any beta-values or m-values output will contain all probes. If True, those probes that fail the p-value signal:noise detection are replaced with NaNs in dataframes in beta_values and m_value output.'
+        default=None,
+        help='Probes that fail the p-value signal:noise detection are replaced with NaNs in dataframes in beta_values and m_value output. This is the default with sesame processing; with --minfi, output will contain all probes unless this is specified.'
     )
 
     parser.add_argument(
@@ -224,7 +339,7 @@ def cli_process(cmd_args):
         '-f', '--file_format',
         required=False,
         default='pickle',
-        help='Specify `parquet` instead of default `pickle`'
+        help='Specify `parquet` instead of default `pickle`, or `npy` (with --stream) to keep the memory-mapped numpy matrices'
     )
 
     parser.add_argument(
@@ -256,7 +371,7 @@ def cli_process(cmd_args):
     array_type = args.array_type
     manifest_filepath = args.manifest
 
-    if args.export_poobah == True and args.poobah == False:
+    if args.export_poobah == True and not args.poobah:
         print("Enabling --poobah corrections, because user specified --export_poobah.")
         args.poobah = True
 
@@ -273,7 +388,11 @@ def cli_process(cmd_args):
 
     #print(vars(args).items())
 
-    run_pipeline(
+    if args.watch:
+        process = partial(watch_pipeline, poll_interval=args.watch_interval, settle=args.watch_settle, idle_timeout=args.watch_idle)
+    else:
+        process = run_pipeline
+    process(
         args.data_dir,
         array_type=args.array_type,
         manifest_filepath=args.manifest,
@@ -283,6 +402,7 @@ def cli_process(cmd_args):
         betas=args.betas,
         m_value=args.m_value,
         batch_size=args.batch_size,
+        max_memory=args.max_memory,
         save_uncorrected=args.uncorrected,
         export=args.no_export, # flag flips here
         meta_data_frame=args.no_meta_export, # flag flips here
@@ -293,11 +413,119 @@ def cli_process(cmd_args):
         quality_mask=(not args.no_quality_mask),
         sesame=(not args.minfi), # default 'sesame' method can be turned off using --minfi,
         pneg_ecdf=args.pneg_ecdf,
-        file_format=args.file_format
+        file_format=args.file_format,
+        n_jobs=args.workers,
+        stream_outputs=args.stream,
+        checkpoint=args.resume,
+        append=args.append,
+        profile=args.profile,
+        concurrent_arrays=args.concurrent_arrays,
+        shard=args.shard,
+        shard_lease=args.shard_lease,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size,
+        results='files', # the CLI doesn't use returned data, so never keep SampleDataContainers
+    )
+
+
+def cli_rethreshold(cmd_args):
+    from .models import ArrayType
+    from .processing import rethreshold
+    parser = DefaultParser(
+        prog='methylprep rethreshold',
+        description='Re-applies a poobah p-value threshold (and optionally the quality_mask) to saved run_pipeline outputs, and saves new beta_values and m_values.',
+    )
+
+    parser.add_argument(
+        '-d', '--data_dir',
+        required=True,
+        type=Path,
+        help='Folder containing poobah_values, noob_meth_values and noob_unmeth_values from `methylprep process --export_poobah`.',
+    )
+
+    parser.add_argument(
+        '--poobah_sig',
+        required=False,
+        type=float,
+        default=0.05,
+        help='Probes with a poobah p-value at or above this threshold are replaced with NaNs. Default is 0.05.',
+    )
+
+    parser.add_argument(
+        '--run_poobah_sig',
+        required=False,
+        type=lambda value: None if value.lower() == 'none' else float(value),
+        default=0.05,
+        help="The --poobah_sig that `process` used (default 0.05); --poobah_sig can only be stricter than it. Pass 'none' if process ran with poobah=False, which saves noob values without the filter.",
+    )
+
+    parser.add_argument(
+        '--quality_mask',
+        required=False,
+        action='store_true',
+        default=False,
+        help='If specified, also removes the sesame quality_mask probes for --array_type.',
+    )
+
+    parser.add_argument(
+        '--array_type',
+        choices=list(ArrayType),
+        required=False,
+        type=ArrayType,
+        help='Type of array processed. Required with --quality_mask.',
+    )
+
+    parser.add_argument(
+        '--minfi',
+        required=False,
+        action='store_true',
+        default=False,
+        help='If specified, beta values use the minfi offset (100) instead of sesame (0).',
+    )
+
+    parser.add_argument(
+        '-i','--bit',
+        required=False,
+        choices=['float64','float32','float16'],
+        default='float32',
+        help="Change the beta or m_value data_type output from float32 to float16 or float64.",
+    )
+
+    parser.add_argument(
+        '-f', '--file_format',
+        required=False,
+        default='pickle',
+        help='Specify `parquet` instead of default `pickle`, matching how the inputs were saved.'
+    )
+
+    parser.add_argument(
+        '-o', '--out_dir',
+        required=False,
+        type=Path,
+        help='Where to save beta_values and m_values. Default is data_dir, replacing the existing files.',
+    )
+
+    args = parser.parse_args(cmd_args)
+    if args.run_poobah_sig is not None and args.poobah_sig > args.run_poobah_sig:
+        parser.error(f"--poobah_sig {args.poobah_sig} is looser than the --run_poobah_sig {args.run_poobah_sig} of the "
+            "process run. Its noob values are already blank (NaN) for probes that failed that threshold, so rethreshold "
+            "can only make it stricter. To loosen it, process again with run_pipeline(poobah=False, export_poobah=True), "
+            "which saves unfiltered noob values, and pass --run_poobah_sig none.")
+    rethreshold(
+        args.data_dir,
+        poobah_sig=args.poobah_sig,
+        run_poobah_sig=args.run_poobah_sig,
+        quality_mask=args.quality_mask,
+        array_type=args.array_type,
+        sesame=(not args.minfi),
+        bit=args.bit,
+        file_format=args.file_format,
+        out_dir=args.out_dir,
     )
 
 
 def cli_beta_bakery(cmd_args):
+    from .download import pipeline_find_betas_any_source
     parser = DefaultParser(
         prog='methylprep download',
         description='Download and process a public dataset, either from GEO or ArrayExpress'
@@ -381,6 +609,7 @@ def cli_beta_bakery(cmd_args):
 
 
 def cli_download(cmd_args):
+    from .download import run_series, run_series_list
     parser = DefaultParser(
         prog='methylprep download',
         description='Download and process a public dataset, either from GEO or ArrayExpress'
@@ -463,6 +692,7 @@ def cli_download(cmd_args):
 
 
 def cli_meta_data(cmd_args):
+    from .download import convert_miniml
     parser = DefaultParser(
         prog='methylprep meta_data',
         description="""A more feature-rich meta data parser for public MINiML GEO datasets.
@@ -526,6 +756,7 @@ based on the associated meta data."""
 
 
 def cli_composite(cmd_args):
+    from .download import build_composite_dataset
     parser = DefaultParser(
         prog='methylprep composite',
         description="A tool to build a data set from a list of public datasets."
@@ -592,6 +823,7 @@ def cli_composite(cmd_args):
 
 
 def cli_sample_sheet(cmd_args):
+    from .files import get_sample_sheet
     parser = DefaultParser(
         prog='methylprep sample_sheet',
         description='Create an Illumina sample sheet file from idat filenames and user-defined meta data, or parse an existing sample sheet.',
@@ -652,6 +884,7 @@ def cli_sample_sheet(cmd_args):
         sys.stdout.write(f'{sample}\n')
 
 def cli_alert(cmd_args):
+    from .download import search
     parser = DefaultParser(
         prog='methylprep alert',
         description="""Searches GEO for datasets, filtered by keyword, and saves results to <keyword-pattern>_meta.csv.""",
@@ -225,6 +225,17 @@ class IdatDataset():
 
         return offsets
 
+    @staticmethod
+    def read_probe_count(filepath_or_buffer, idat_id=DEFAULT_IDAT_FILE_ID):
+        """Reads only the number of probes (n_snps_read) from an IDAT file's header, without parsing the probe data.
+        ArrayType.from_probe_count() turns this into the file's array type."""
+        with get_file_object(filepath_or_buffer) as idat_file:
+            if not IdatDataset.is_idat_file(idat_file, idat_id):
+                raise ValueError('Not an IDAT file. Unsupported file type.')
+            section_offsets = IdatDataset.get_section_offsets(idat_file)
+            idat_file.seek(section_offsets[IdatSectionCode.NUM_SNPS_READ.value])
+            return read_int(idat_file)
+
     def read(self, idat_file):
         """Reads the IDAT file and parses the appropriate sections. Joins the
         mean probe intensity values with their Illumina probe ID.
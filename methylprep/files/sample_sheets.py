@@ -513,3 +513,43 @@ class SampleSheet():
             row['Sample_ID'] = f"{row['Sentrix_ID']}_{row['Sentrix_Position']}"
             meta_frame = meta_frame.append(row, ignore_index=True)
         return meta_frame
+
+
+class SampleSubset():
+    """Some of the samples of one or more SampleSheets, which run_pipeline processes in place of a SampleSheet: it has
+    the same get_samples(), get_sample() and build_meta_data() methods. Used for each array type of a mixed-array
+    folder, and for each shard of run_pipeline(shard='auto').
+
+    Arguments:
+        sample_sheets -- a list of (SampleSheet, [its Samples to include]) pairs
+    """
+
+    def __init__(self, sample_sheets=None):
+        self.sample_sheets = []
+        self.renamed_fields = {}
+        for sample_sheet, samples in (sample_sheets or []):
+            self.add(sample_sheet, samples)
+
+    def add(self, sample_sheet, samples):
+        self.sample_sheets.append((sample_sheet, list(samples)))
+        self.renamed_fields.update(sample_sheet.renamed_fields)
+
+    def get_samples(self):
+        return [sample for _, samples in self.sample_sheets for sample in samples]
+
+    def get_sample(self, sample_name):
+        candidates = [sample for sample in self.get_samples() if sample.name == sample_name]
+        if len(candidates) != 1:
+            raise ValueError(f'Expected sample with name `{sample_name}`. Found {len(candidates)}')
+        return candidates[0]
+
+    def build_meta_data(self, samples=None):
+        """ each sample sheet's meta data for its samples, in one data_frame """
+        samples = samples or self.get_samples()
+        frames = []
+        for sample_sheet, sheet_samples in self.sample_sheets:
+            in_sheet = {id(sample) for sample in sheet_samples}
+            selected = [sample for sample in samples if id(sample) in in_sheet]
+            if selected:
+                frames.append(sample_sheet.build_meta_data(selected))
+        return pd.concat(frames, ignore_index=True)
@@ -10,6 +10,7 @@ from ..models import (
 )
 from ..files import IdatDataset
 from ..utils.progress_bar import * # checks environment and imports tqdm appropriately.
+from ..utils.profiling import profile_stage
 from collections import Counter
 
 
@@ -78,7 +79,8 @@ def parse_sample_sheet_into_idat_datasets(sample_sheet, sample_name=None, from_s
             return {'green_idat': green_idat, 'red_idat': red_idat, 'sample': sample}
         idat_datasets = []
         for sample in tqdm(samples, total=len(samples), desc='Reading IDATs'):
-            idat_datasets.append(parser(zip_reader, sample))
+            with profile_stage('read_idats', sample):
+                idat_datasets.append(parser(zip_reader, sample))
     elif not from_s3 and not meta_only:
         #parser = RawDataset.from_sample
         def parser(sample):
@@ -89,7 +91,8 @@ def parse_sample_sheet_into_idat_datasets(sample_sheet, sample_name=None, from_s
             return {'green_idat': green_idat, 'red_idat': red_idat, 'sample': sample}
         idat_datasets = []
         for sample in tqdm(samples, total=len(samples), desc='Reading IDATs'):
-            idat_datasets.append(parser(sample))
+            with profile_stage('read_idats', sample):
+                idat_datasets.append(parser(sample))
 
     if not meta_only:
         idat_datasets = list(idat_datasets) # tqdm objects are not subscriptable, not like a real list
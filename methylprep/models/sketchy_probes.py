@@ -1,34 +1,63 @@
 import numpy as np
 import pandas as pd
 from pathlib import Path
-try:
-    from importlib import resources # py >= 3.7
-except ImportError: # py < 3.7
-    import pkg_resources
-    loader = pkg_resources.resource_filename
+from importlib import resources
+# App
+from .arrays import ArrayType
+
 pkg_namespace = 'methylprep.models'
 
-try:
-    if pkg_resources:
-        # resource_filename context manager does not support "with"
-        probe_filepath = loader(pkg_namespace, 'qualityMask450.txt.gz')
-        qualityMask450 = pd.read_csv(probe_filepath)['x']
-        probe_filepath = loader(pkg_namespace, 'qualityMaskEPIC.txt.gz')
-        qualityMaskEPIC = pd.read_csv(probe_filepath)['x']
-        probe_filepath = loader(pkg_namespace, 'qualityMaskEPICPLUS.txt.gz')
-        qualityMaskEPICPLUS = pd.read_csv(probe_filepath)['x']
-        probe_filepath = loader(pkg_namespace, 'qualityMaskmouse.txt.gz')
-        qualityMaskmouse = pd.read_csv(probe_filepath)['x']
-except:
-    with resources.path(pkg_namespace, 'qualityMask450.txt.gz') as probe_filepath:
-        qualityMask450 = pd.read_csv(probe_filepath)['x']
-    with resources.path(pkg_namespace, 'qualityMaskEPIC.txt.gz') as probe_filepath:
-        qualityMaskEPIC = pd.read_csv(probe_filepath)['x']
-    with resources.path(pkg_namespace, 'qualityMaskEPICPLUS.txt.gz') as probe_filepath:
-        qualityMaskEPICPLUS = pd.read_csv(probe_filepath)['x']
-    with resources.path(pkg_namespace, 'qualityMaskmouse.txt.gz') as probe_filepath:
-        qualityMaskmouse = pd.read_csv(probe_filepath)['x']
+# sesame's qualityMask probe lists, one gzipped CSV per array type. Nothing is read at import time:
+# each file is read on first use, and the module attributes (qualityMask450 etc) still work, through __getattr__.
+QUALITY_MASK_FILES = {
+    'qualityMask450': 'qualityMask450.txt.gz',
+    'qualityMaskEPIC': 'qualityMaskEPIC.txt.gz',
+    'qualityMaskEPICPLUS': 'qualityMaskEPICPLUS.txt.gz',
+    'qualityMaskmouse': 'qualityMaskmouse.txt.gz',
+}
+QUALITY_MASK_ARRAY_TYPES = {
+    ArrayType.ILLUMINA_450K: 'qualityMask450',
+    ArrayType.ILLUMINA_EPIC: 'qualityMaskEPIC',
+    ArrayType.ILLUMINA_EPIC_PLUS: 'qualityMaskEPICPLUS',
+    ArrayType.ILLUMINA_MOUSE: 'qualityMaskmouse',
+}
+_loaded_masks = {} # name -> pd.Series of probe names
+_aligned_masks = {} # name -> (probe index, boolean array)
+
+
+def load_quality_mask(name):
+    """ returns the probe names in one qualityMask file (a pd.Series named 'x'); read once, then cached. """
+    if name not in QUALITY_MASK_FILES:
+        raise ValueError(f"Unknown quality mask {name}; expected one of {list(QUALITY_MASK_FILES)}")
+    if name not in _loaded_masks:
+        with resources.path(pkg_namespace, QUALITY_MASK_FILES[name]) as probe_filepath:
+            _loaded_masks[name] = pd.read_csv(probe_filepath)['x']
+    return _loaded_masks[name]
+
+
+def quality_mask_excluded(array_type, probe_index):
+    """ a boolean array aligned to probe_index, True for the probes that sesame's qualityMask excludes.
+
+    The array is cached with the index it was built for, so processing many samples against the same
+    manifest costs one isin() in total; later samples only check that their probe index is unchanged.
+    Raises ValueError for array types without a quality mask (27k, custom)."""
+    if array_type not in QUALITY_MASK_ARRAY_TYPES:
+        raise ValueError(f"Quality masking is not supported for {array_type}.")
+    name = QUALITY_MASK_ARRAY_TYPES[array_type]
+    cached = _aligned_masks.get(name)
+    if cached is not None and (cached[0] is probe_index or cached[0].equals(probe_index)):
+        return cached[1]
+    excluded = np.asarray(probe_index.isin(load_quality_mask(name)))
+    excluded.setflags(write=False) # shared by every sample
+    _aligned_masks[name] = (probe_index, excluded)
+    return excluded
+
 
+def __getattr__(name):
+    """ PEP 562: qualityMask450, qualityMaskEPIC, qualityMaskEPICPLUS and qualityMaskmouse load on first access. """
+    if name in QUALITY_MASK_FILES:
+        return load_quality_mask(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 """
 def sketchy_probes_warning(filepath):
@@ -1,11 +1,28 @@
 from .pipeline import SampleDataContainer, run_pipeline, make_pipeline
-from .preprocess import preprocess_noob
-from .postprocess import consolidate_values_for_sheet
+from .preprocess import preprocess_noob, preprocess_noob_arrays
+from .postprocess import consolidate_values_for_sheet, rethreshold, rethreshold_values
+from .p_value_probe_detection import detect_probes
+from .outputs import MatrixWriter, ProcessedOutputs, load_matrix
+from .plan import PipelinePlan
+from .cache import StageCache
+from .results import ProcessedSample
+from .watch import watch_pipeline
 
 __all__ = [
     'SampleDataContainer',
     'preprocess_noob',
+    'preprocess_noob_arrays',
     'run_pipeline',
     'make_pipeline,',
-    'consolidate_values_for_sheet'
+    'consolidate_values_for_sheet',
+    'detect_probes',
+    'rethreshold',
+    'rethreshold_values',
+    'ProcessedOutputs',
+    'MatrixWriter',
+    'load_matrix',
+    'PipelinePlan',
+    'StageCache',
+    'ProcessedSample',
+    'watch_pipeline',
 ]
@@ -0,0 +1,135 @@
+# Lib
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import pickle
+import weakref
+import pandas as pd
+# App
+from .checkpoint import idat_checksum
+from .memory import parse_memory
+from ..models import Channel
+from ..version import __version__
+
+__all__ = ['StageCache', 'manifest_fingerprint']
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = '20G'
+_PROCESSING_COLUMNS = ['AddressA_ID', 'AddressB_ID', 'Infinium_Design_Type', 'Color_Channel']
+# one fingerprint per Manifest object; entries go away with the manifest.
+_FINGERPRINTS = weakref.WeakKeyDictionary()
+
+
+def manifest_fingerprint(manifest):
+    """ sha256 of the parts of a Manifest that processing reads: array type, probe names, addresses, designs and
+    channels, and the control and snp probes. A new manifest version changes it. """
+    digest = hashlib.sha256(str(manifest.array_type).encode())
+    frames = (
+        manifest.data_frame[[column for column in _PROCESSING_COLUMNS if column in manifest.data_frame.columns]],
+        manifest.control_data_frame,
+        manifest.snp_data_frame,
+    )
+    for frame in frames:
+        digest.update(pd.util.hash_pandas_object(frame, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+class StageCache():
+    """On-disk cache of per-sample intermediate results, shared by every run that points to the same folder
+    (run_pipeline(cache_dir=...) / methylprep process --cache_dir).
+
+    Each stage is saved under a key made of the sha256 of the sample's Grn and Red IDATs, the manifest's
+    fingerprint, the methylprep version and the parameters of every stage up to that one. Stages, deepest first:
+        - 'processed': the processed sample (after NOOB and dye-bias correction), with its control probes
+        - 'pvalues': the poobah / pNegECDF detection p-values, calculated after infer_channel_switch
+    so a run that only changes late settings (estimator, exports, file format) reuses 'processed', and one
+    that changes poobah_sig or the NOOB / dye-bias steps still reuses 'pvalues'. bit is an early setting:
+    IDAT intensities are read at that precision.
+
+    Entries are pickles in {cache_dir}/{stage}/{key}.pkl, written to a temporary file and renamed. Reading an entry
+    updates its modification time; evict() deletes the least recently used entries until the cache fits in max_size
+    (bytes, or '20G'). run_pipeline calls it after each batch.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_CACHE_SIZE):
+        self.path = Path(path)
+        self.max_size = parse_memory(max_size)
+        self._checksums = {} # IDAT path -> sha256, for samples looked up in this process
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def __getstate__(self): # sent to pool workers without this process's memos
+        return dict(self.__dict__, _checksums={})
+
+    def key(self, stage, sample, manifest, params):
+        if manifest not in _FINGERPRINTS:
+            _FINGERPRINTS[manifest] = manifest_fingerprint(manifest)
+        idats = []
+        for channel in (Channel.GREEN, Channel.RED):
+            filepath = str(sample.get_filepath('idat', channel))
+            if filepath not in self._checksums:
+                self._checksums[filepath] = idat_checksum(filepath)
+            idats.append(self._checksums[filepath])
+        key = {'stage': stage, 'idats': idats, 'manifest': _FINGERPRINTS[manifest], 'params': params,
+            'methylprep_version': __version__}
+        return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _entry(self, stage, key):
+        return Path(self.path, stage, f"{key}.pkl")
+
+    def load(self, stage, key):
+        """ the cached result, or None """
+        entry = self._entry(stage, key)
+        try:
+            with open(entry, 'rb') as f:
+                result = pickle.load(f)
+            os.utime(entry) # most recently used
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            LOGGER.warning(f"Ignoring unreadable cache entry {entry} ({e})")
+            return None
+        return result
+
+    def save(self, stage, key, result):
+        entry = self._entry(stage, key)
+        entry.parent.mkdir(exist_ok=True)
+        temp = entry.with_name(f".{entry.name}.{os.getpid()}.tmp")
+        with open(temp, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, entry)
+
+    def size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        entries = []
+        for entry in self.path.glob('*/*.pkl'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError: # evicted by another worker
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        return entries
+
+    def evict(self):
+        """ deletes the least recently used entries until the cache fits in max_size """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_size:
+                break
+            try:
+                entry.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, entry in self._entries():
+            try:
+                entry.unlink()
+            except FileNotFoundError:
+                pass
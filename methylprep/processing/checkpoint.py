@@ -0,0 +1,134 @@
+# Lib
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import pickle
+import shutil
+# App
+from ..models import Channel
+from ..version import __version__
+
+__all__ = ['Checkpoint']
+
+LOGGER = logging.getLogger(__name__)
+
+CHECKPOINT_DIR = '.methylprep_checkpoint'
+
+
+def idat_checksum(filepath, chunk_size=1 << 20):
+    """ sha256 of an IDAT file (or its .gz), read in chunks """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Checkpoint():
+    """The journal behind run_pipeline(checkpoint=True): each processed sample is saved as soon as it finishes,
+    so a run that dies (out of memory, a preempted node) picks up where it left off.
+
+    Everything lives in data_dir/.methylprep_checkpoint:
+        - params.json: a hash of the processing parameters (and methylprep version) the samples were processed with
+        - journal.jsonl: one line per completed sample, with the sha256 of its Grn and Red IDATs
+        - samples/{sentrix_id}_{sentrix_position}.pkl: what processing the sample returned
+
+    Each sample's pickle is written to a temporary file, synced and renamed before its journal line is appended
+    (and synced), so a journal line always points to a complete file. On restart, journaled samples are reused only
+    if the IDATs still have the same checksums; if the parameters changed, the whole journal is discarded.
+    run_pipeline removes the checkpoint once the run has saved all its outputs.
+    """
+
+    def __init__(self, data_dir, params):
+        self.path = Path(data_dir, CHECKPOINT_DIR)
+        self.journal_path = Path(self.path, 'journal.jsonl')
+        self.params = dict(params, methylprep_version=__version__)
+        self.params_hash = hashlib.sha256(json.dumps(self.params, sort_keys=True, default=str).encode()).hexdigest()
+        self.entries = {} # sample_id -> journal entry
+        self._checksums = {} # sample_id -> (green, red) sha256, for samples looked up in this run
+        self._open()
+
+    def _open(self):
+        params_path = Path(self.path, 'params.json')
+        if params_path.exists():
+            with open(params_path) as f:
+                saved = json.load(f)
+            if saved.get('hash') != self.params_hash:
+                LOGGER.warning(f"Processing parameters changed since the checkpoint in {self.path} was saved; processing all samples again.")
+                self.clear()
+        if not params_path.exists():
+            Path(self.path, 'samples').mkdir(parents=True, exist_ok=True)
+            self._write_durably(params_path, json.dumps({'hash': self.params_hash, 'params': self.params}, sort_keys=True, default=str).encode())
+            return
+        if self.journal_path.exists():
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue # a line cut short by the crash; that sample is processed again
+                    self.entries[entry['sample_id']] = entry
+        if self.entries:
+            LOGGER.info(f"Resuming from checkpoint: {len(self.entries)} samples already processed.")
+
+    @staticmethod
+    def sample_id(sample):
+        return f"{sample.sentrix_id}_{sample.sentrix_position}"
+
+    def checksums(self, sample):
+        sample_id = self.sample_id(sample)
+        if sample_id not in self._checksums:
+            self._checksums[sample_id] = (
+                idat_checksum(sample.get_filepath('idat', Channel.GREEN)),
+                idat_checksum(sample.get_filepath('idat', Channel.RED)),
+            )
+        return self._checksums[sample_id]
+
+    def load(self, sample):
+        """ returns what processing this sample returned in an earlier run, or None if it has to be processed. """
+        entry = self.entries.get(self.sample_id(sample))
+        if entry is None:
+            return None
+        if (entry['green_sha256'], entry['red_sha256']) != self.checksums(sample):
+            LOGGER.warning(f"IDATs of {sample} changed since they were checkpointed; processing it again.")
+            return None
+        try:
+            with open(Path(self.path, entry['file']), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            LOGGER.warning(f"Could not read the checkpoint of {sample} ({e}); processing it again.")
+            return None
+
+    def array_type(self, sample):
+        entry = self.entries.get(self.sample_id(sample))
+        return entry.get('array_type') if entry else None
+
+    def record(self, sample, result, array_type=None):
+        """ saves one sample's processing result, then journals it. """
+        sample_id = self.sample_id(sample)
+        green, red = self.checksums(sample)
+        filename = Path('samples', f"{sample_id}.pkl")
+        self._write_durably(Path(self.path, filename), pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+        entry = {'sample_id': sample_id, 'green_sha256': green, 'red_sha256': red, 'file': str(filename),
+            'array_type': str(array_type) if array_type else None}
+        with open(self.journal_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[sample_id] = entry
+
+    @staticmethod
+    def _write_durably(filepath, data):
+        temp = filepath.with_name(f".{filepath.name}.tmp")
+        with open(temp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, filepath)
+
+    def clear(self):
+        """ deletes the checkpoint """
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.entries = {}
@@ -1,9 +1,7 @@
 # Lib
 import logging
-import math
 import numpy as np
 import pandas as pd
-import scipy
 # App
 import methylprep
 
@@ -13,83 +11,112 @@ LOGGER = logging.getLogger(__name__)
 
 
 def get_ranks(x):
-    """ get_ranks - Python version of the C function get_ranks() --- part of qnorm_using_target """
-    i = 0
+    """ get_ranks - vectorized version of the C function get_ranks() --- part of qnorm_using_target
+    x must be sorted ascending; returns 1-based ranks, with tied values sharing the average rank of their run."""
+    x = np.asarray(x)
     n = len(x)
-    rank = np.zeros(n)
-    while (i < n):
-        j = i
-        while ((j < n - 1) and (x[j]['data'] == x[j + 1]['data'])):
-            j += 1
-
-        if (i != j):
-            for k in range(i, j+1):
-                rank[k] = (i + j + 2) / 2.0
-        else:
-            rank[i] = i + 1
-        i = j + 1
-
-    return rank
+    if n == 0:
+        return np.zeros(0)
+    # each run of equal values spans sorted positions first..last; rank = (first + last + 2) / 2
+    starts = np.flatnonzero(np.r_[True, x[1:] != x[:-1]])
+    ends = np.r_[starts[1:], n] - 1
+    run_lengths = np.diff(np.r_[starts, n])
+    return np.repeat((starts + ends + 2) / 2.0, run_lengths)
 
 def qnorm_using_target(data, target):
-    """ using_target - Python version of the C function using_target() ;
-    data and target in must be ndarray like np.transpose(np.array([IR1]))"""
+    """ using_target - vectorized version of the C function using_target() ;
+    data and target in must be ndarray like np.transpose(np.array([IR1]))
+    - data is sorted (stable, so ties keep their original order), ranked with get_ranks(),
+      and each value replaced by the target value at the same rank/percentile, in place."""
     nrows = data.shape[0]
     ncols = data.shape[1]
     targetrows = target.shape[0]
     float_eps = np.finfo(np.float32).eps
+    target = target[:, 0] if target.ndim == 2 else target
 
     if nrows != targetrows:
         raise NotImplementedError('Data and target are different lengths')
-    else:
-        for j in range(ncols):
-            non_na = 0
-            dimat = []
-            for i in range(nrows):
-                if ~np.isnan(data[i, j]):
-                    dataitem = {'data': data[i, j], 'rank': i}
-                    dimat.append(dataitem)
-                    non_na += 1
-
-            dimat = sorted(dimat, key=lambda k: k['data'])
-            ranks = get_ranks(dimat)
-            if non_na == nrows:
-                for i in range(nrows):
-                    ind = dimat[i]['rank']
-                    if (ranks[i] - math.floor(ranks[i])) > 0.4:
-                        data[ind, j] = 0.5*(target[int(math.floor(ranks[i])-1)] + target[int(math.floor(ranks[i]))])
-                    else:
-                        data[ind, j] = target[int(math.floor(ranks[i])-1)]
-            else:
-                for i in range(non_na):
-                    samplepercentile = float(ranks[i] - 1)/float(non_na - 1)
-                    target_ind_double = 1.0 + (float(targetrows) - 1.0) * samplepercentile
-                    target_ind_double_floor = math.floor(target_ind_double + 4*float_eps)
-                    target_ind_double = target_ind_double - target_ind_double_floor
-                    if (math.fabs(target_ind_double) <= 4*float_eps):
-                        target_ind_double = 0.0
-
-                    if (target_ind_double  == 0.0):
-                        target_ind = int(math.floor(target_ind_double_floor + 0.5))
-                        ind = dimat[i]['rank']
-                        data[ind, j] = target[target_ind-1]
-                    elif (target_ind_double == 1.0):
-                        target_ind = int(math.floor(target_ind_double_floor + 1.5))
-                        ind = dimat[i]['rank']
-                        data[ind, j] = target[target_ind-1]
-                    else:
-                        target_ind = int(math.floor(target_ind_double_floor + 0.5))
-                        ind = dimat[i]['rank']
-                        if ((target_ind < targetrows) and (target_ind > 0)):
-                             data[ind, j] = (1.0- target_ind_double)*target[target_ind-1] + target_ind_double*target[target_ind]
-                        elif (target_ind >= targetrows):
-                             data[ind, j] = target[targetrows-1]
-                        else:
-                            data[ind, j] = target[0]
+    for j in range(ncols):
+        non_na_rows = np.flatnonzero(~np.isnan(data[:, j]))
+        non_na = len(non_na_rows)
+        if non_na == 0:
+            continue
+        order = non_na_rows[np.argsort(data[non_na_rows, j], kind='stable')] # original row of each sorted value
+        ranks = get_ranks(data[order, j])
+        floor_ranks = np.floor(ranks).astype(int)
+        if non_na == nrows:
+            tied = (ranks - floor_ranks) > 0.4
+            values = target[floor_ranks - 1]
+            # tie-averaged ranks fall halfway between two target values; only index the upper one where needed
+            values[tied] = 0.5*(target[floor_ranks[tied] - 1] + target[floor_ranks[tied]])
+        else:
+            samplepercentile = (ranks - 1) / float(non_na - 1) if non_na > 1 else np.zeros(non_na)
+            target_ind_double = 1.0 + (float(targetrows) - 1.0) * samplepercentile
+            target_ind_double_floor = np.floor(target_ind_double + 4*float_eps)
+            target_ind_double = target_ind_double - target_ind_double_floor
+            target_ind_double[np.fabs(target_ind_double) <= 4*float_eps] = 0.0
+            target_ind = np.floor(target_ind_double_floor + 0.5).astype(int)
+            # exact hits on a target row (0.0) or the next row up (1.0) take that value directly
+            upper = target_ind_double == 1.0
+            target_ind[upper] = np.floor(target_ind_double_floor[upper] + 1.5).astype(int)
+            exact = upper | (target_ind_double == 0.0)
+            lower_ind = np.clip(target_ind - 1, 0, targetrows - 1)
+            upper_ind = np.clip(target_ind, 0, targetrows - 1)
+            values = (1.0 - target_ind_double)*target[lower_ind] + target_ind_double*target[upper_ind]
+            values[exact] = target[lower_ind[exact]]
+            values[~exact & (target_ind >= targetrows)] = target[targetrows-1]
+            values[~exact & (target_ind <= 0)] = target[0]
+        data[order, j] = values
     # assuming I only need to return a single column here
     return np.transpose(data)[0]
 
 
+def _same_N_interpol(values, num):
+    """ stretches a sorted array to `num` points with linear interpolation (sesame's inputs were IR1, target=IG0).
+    - samples positions np.linspace(0, len(values), num), so the last point extrapolates the final segment,
+      as scipy.interpolate.interp1d(fill_value="extrapolate") did before v1.7.2."""
+    length = len(values)
+    positions = np.linspace(0, length, num=num)
+    stretched = np.interp(positions, np.arange(length), values)
+    beyond = positions > length - 1
+    if length > 1 and beyond.any():
+        stretched[beyond] = (values[-1] - values[-2]) * (positions[beyond] - (length - 2)) + values[-2]
+    return stretched
+
+
+def _transfer_curve(x1, xmid, min_x, max_x):
+    """ a channel's dye-bias transfer function: support range and interpolation points, reused for every probe subset. """
+    keep = ~np.isnan(x1) & ~np.isnan(xmid)
+    return {
+        'xp': x1[keep],
+        'fp': xmid[keep],
+        'min': min_x,
+        'max': max_x,
+        'min_mid': np.nanmin(xmid),
+        'max_mid': np.nanmax(xmid),
+    }
+
+
+def _apply_transfer_curve(curve, parts):
+    """ transforms all Series in `parts` with one channel's transfer curve, in a single vectorized pass.
+    - in-support probes (min <= x <= max) are interpolated along the curve (R approx())
+    - over-support probes are shifted so the max maps to the max of the curve
+    - under-support probes are scaled proportionally, avoiding negative or zero values
+    - NaNs stay NaN. Returns rounded Series with the same index and order as each part.
+    Intensities are read as float32 but transformed in float64, as the pandas .loc version did before v1.7.2."""
+    data = np.concatenate([part.to_numpy(dtype='float32') for part in parts]).astype('float64')
+    insupp = (data >= curve['min']) & (data <= curve['max']) # NaN compares False everywhere
+    oversupp = data > curve['max']
+    undersupp = data < curve['min']
+    transformed = data.copy()
+    transformed[insupp] = np.interp(data[insupp], curve['xp'], curve['fp'])
+    transformed[oversupp] = data[oversupp] - curve['max'] + curve['max_mid']
+    transformed[undersupp] = data[undersupp] * (curve['min_mid'] / curve['min'])
+    np.round(transformed, out=transformed)
+    splits = np.cumsum([len(part) for part in parts])[:-1]
+    return [pd.Series(values, index=part.index, name=part.name) for part, values in zip(parts, np.split(transformed, splits))]
+
+
 def nonlinear_dye_bias_correction(container, debug=False):
     """ transforms Red and Green probe intensities to better align with each other.
     - equivalent to sesame's dyeBiasCorrTypeINorm function
@@ -115,8 +142,8 @@ def nonlinear_dye_bias_correction(container, debug=False):
     if debug:
         import matplotlib.pyplot as plt # not required by package for normal users
 
-    # get the IG & IR probes that pass the pvalue qualityMask; drops failed probes
-    if 'poobah_pval' in container._SampleDataContainer__data_frame.columns:
+    # get the IG & IR probes that pass the pvalue qualityMask; drops failed probes (unless the p-values are only exported)
+    if container.poobah_noob and 'poobah_pval' in container._SampleDataContainer__data_frame.columns:
         mask = (container._SampleDataContainer__data_frame['poobah_pval'] < container.poobah_sig)
         if mask.index.duplicated().sum() > 0:
             # equivalent to len(mask.index) > len(set(mask.index))
@@ -130,7 +157,7 @@ def nonlinear_dye_bias_correction(container, debug=False):
     # dye-correct NOOB or RAW intensities, depending on preprocessing flags here.
     columns = {'noob_Meth':'Meth','noob_Unmeth':'Unmeth'} if container.do_noob == True else {'Meth':'Meth','Unmeth':'Unmeth'}
     drop_columns = ['Meth', 'Unmeth', 'poobah_pval', 'used', 'AddressA_ID', 'AddressB_ID'] if container.do_noob == True else ['noob_Meth', 'noob_Unmeth', 'poobah_pval', 'used', 'AddressA_ID', 'AddressB_ID']
-    if container.pval is False:
+    if container.pval is False or not container.poobah_noob: # NOOB only adds poobah_pval to IG/IR when it uses it
         drop_columns.remove('poobah_pval')
 
     if isinstance(mask,pd.Series):
@@ -161,124 +188,37 @@ def nonlinear_dye_bias_correction(container, debug=False):
         LOGGER.error(f"{container.sample.name} one of (maxIG,maxIR,minIG,minIR) was zero; cannot run dye-bias correction")
         return container
 
-    # make Meth + Unmeth a long sorted list of probe values, drop index
-    IR1 = sorted(IR0['Meth'].tolist() + IR0['Unmeth'].tolist())
-    IG1 = sorted(IG0['Unmeth'].tolist() + IG0['Meth'].tolist())
-
-    def same_N_interpol(ig,target):
-        """ stretches  IG to IR's number of points, and visa versa, using linear interpolation., before feeding into qnorm
-        - in: two lists (IG1, IR1)
-        - sesame's inputs were IR1, target=IG0."""
-        ig_length = len(ig); target_length = len(target)
-        # make some linear functions for ir and ig
-        #ig_interp = scipy.interpolate.interp1d(np.arange(np.array(ig).size), np.array(ig), fill_value="extrapolate")
-        target_interp = scipy.interpolate.interp1d(np.arange(np.array(target).size), np.array(target), fill_value="extrapolate")
-        # re-cast as new length of other data set (num= <new size>)
-        #ig_stretch = ig_interp(np.linspace(0, ig_length, num=target_length))
-        ig_stretch = target_interp(np.linspace(0, target_length, num=ig_length))
-        return np.array(ig_stretch) #, np.array(ir_stretch)
-
-    IG_stretch = np.sort(same_N_interpol(IR1, IG1))
-    IR_stretch = np.sort(same_N_interpol(IG1, IR1))
+    # make Meth + Unmeth one long sorted array of probe values, drop index
+    IR1 = np.sort(np.concatenate([IR0['Meth'].to_numpy(dtype='float64'), IR0['Unmeth'].to_numpy(dtype='float64')]))
+    IG1 = np.sort(np.concatenate([IG0['Unmeth'].to_numpy(dtype='float64'), IG0['Meth'].to_numpy(dtype='float64')]))
+
+    # stretch IG to IR's number of points, and visa versa, using linear interpolation, before feeding into qnorm
+    IG_stretch = np.sort(_same_N_interpol(IG1, len(IR1)))
+    IR_stretch = np.sort(_same_N_interpol(IR1, len(IG1)))
 
     if len(IG1) != len(IR_stretch):
         raise ValueError("wrong length")
-    #if debug:
-    #    print(f"{len(IG1)} {len(IR1)} --> {IG_stretch.shape[0]} {IR_stretch.shape[0]}")
-    #    print(f"IG1 {len(IG1)} | IR1 {len(IR1)} --stretched--> IG {len(IG_stretch)} | IR {len(IR_stretch)}")
-    IR2 = qnorm_using_target(np.transpose(np.array([IR1])), np.transpose(np.array([IG_stretch])))
-    IG2 = qnorm_using_target(np.transpose(np.array([IG1])), np.transpose(np.array([IR_stretch])))
-
-    #IRmid = (IR1 + IR2) / 2.0 # avg of IR_meth and qnorm -- interpolated IG_unmeth values
-    IRmid = (np.array(IR1) + IR2) / 2.0
-    maxIRmid = max(IRmid)
-    minIRmid = min(IRmid)
-
-    IGmid = (np.array(IG1) + IG2) / 2.0
-    maxIGmid = max(IGmid)
-    minIGmid = min(IGmid)
-
-    def fit_func_red(data):
-        """ handles II probes that are out of IG, IR range by transforming all proportionally. """
-        #data = data.copy()
-        _IR1 = np.array(IR1)
-        _IRmid = np.array(IRmid)
-        #insupp = (minIR <= data <= maxIR) and not data.isna() # filter of data within allowed range
-        #insupp = data >= minId & data <= maxIR & ~data.isna()
-        insupp = (( data >= np.nanmin( minIR ) ) & ( data <= np.nanmax( maxIR ) ) & ~data.isna())
-        #oversupp = data > maxIR and not data.isna() # a filter of data over max
-        oversupp = (data > maxIR) & ~data.isna()
-        #undersupp = data < minIR and not data.isna() # a filter of data under min
-        undersupp = (data < minIR) & ~data.isna()
-        # approx() Returns a list of points which linearly interpolate given data points, or a function performing the linear (or constant) interpolation.
-        # transform the in-support probes proportionally (probes where function is defined)
-        # data[insupp] <- approx(x=IG1, y=IGmid, xout=data[insupp], ties=mean)$y
-        mask = ~np.isnan(_IR1) & ~np.isnan(_IRmid)
-        yinterp = np.interp(x=data.loc[insupp], xp=_IR1[mask], fp=_IRmid[mask], period=None, left=None, right=None)
-        data.loc[insupp] = yinterp
-        data.loc[oversupp] = data.loc[oversupp] - maxIR + maxIRmid
-        data.loc[undersupp] = data.loc[undersupp] * (minIRmid / minIR)
-        """
-        slope, intercept, r_value, p_value, std_err = scipy.stats.linregress(x=_IR1[mask], y=_IRmid[mask])
-        #print(slope, intercept, r_value, p_value, std_err)
-        # transform insupp using the function, where (x) is insupp prev values
-        data.loc[insupp] = slope*data.loc[insupp] + intercept
-        #data[oversupp] = data[oversupp] - maxIR + maxIRmid
-        data.loc[oversupp] = data.loc[oversupp] - maxIR + maxIRmid
-        # transform low-intensity values, avoiding negative or zero values
-        data.loc[undersupp] = minIRmid / minIR * data.loc[undersupp]
-        #data = data.round(1) # or Int64 with NA
-        """
-        return data
-
-    def fit_func_green(data):
-        #data = data.copy()
-        _IG1 = np.array(IG1)
-        _IGmid = np.array(IGmid)
-        insupp = ( data >= np.nanmin( minIG ) ) & ( data <= np.nanmax( maxIG ) ) & ~data.isna()
-        #oversupp = data > maxIR and not data.isna() # a filter of data over max
-        oversupp = (data > maxIG) & ~data.isna()
-        #undersupp = data < minIR and not data.isna() # a filter of data under min
-        undersupp = (data < minIG) & ~data.isna()
-        # approx() Returns a list of points which linearly interpolate given data points, or a function performing the linear (or constant) interpolation.
-        # transform the in-support probes proportionally (probes where function is defined)
-        # data[insupp] <- approx(x=IG1, y=IGmid, xout=data[insupp], ties=mean)$y
-        mask = ~np.isnan(_IG1) & ~np.isnan(_IGmid)
-        yinterp = np.interp(x=data.loc[insupp], xp=_IG1[mask], fp=_IGmid[mask], period=None, left=None, right=None)
-        data.loc[insupp] = yinterp
-        data.loc[oversupp] = data.loc[oversupp] - maxIG + maxIGmid
-        data.loc[undersupp] = data.loc[undersupp] * (minIGmid / minIG)
-
-        """ previous working method
-        slope, intercept, r_value, p_value, std_err = scipy.stats.linregress(x=_IG1[mask], y=_IGmid[mask])
-        #print(slope, intercept, r_value, p_value, std_err)
-        # transform insupp using the function, where (x) is insupp prev values
-        data.loc[insupp] = slope*data.loc[insupp] + intercept
-        data.loc[oversupp] = data.loc[oversupp] - maxIG + maxIGmid
-        # transform low-intensity values, avoiding negative or zero values
-        data.loc[undersupp] = minIGmid / minIG * data.loc[undersupp]
-        #data = data.round(1)
-        """
-        return data
+    IR2 = qnorm_using_target(IR1.copy()[:, None], IG_stretch[:, None])
+    IG2 = qnorm_using_target(IG1.copy()[:, None], IR_stretch[:, None])
+
+    IRmid = (IR1 + IR2) / 2.0 # avg of IR_meth and qnorm -- interpolated IG_unmeth values
+    IGmid = (IG1 + IG2) / 2.0
+    # transfer curves are computed once per sample, then applied to every probe subset in one pass per channel
+    red_curve = _transfer_curve(IR1, IRmid, minIR, maxIR)
+    green_curve = _transfer_curve(IG1, IGmid, minIG, maxIG)
 
     meth = 'noob_Meth' if container.do_noob else 'Meth'
     unmeth = 'noob_Unmeth' if container.do_noob else 'Unmeth'
-
-    transformed_II_meth = fit_func_green(container.II[meth].astype('float32').copy()).round()
-    transformed_II_unmeth = fit_func_red(container.II[unmeth].astype('float32').copy()).round()
-    transformed_IR_meth = fit_func_red(container.IR[meth].astype('float32').copy()).round()
-    transformed_IR_unmeth = fit_func_red(container.IR[unmeth].astype('float32').copy()).round()
-    transformed_IG_meth = fit_func_green(container.IG[meth].astype('float32').copy()).round()
-    transformed_IG_unmeth = fit_func_green(container.IG[unmeth].astype('float32').copy()).round()
-    #oobR = fit_func_red(container.oobR[meth].astype('float32').copy()) # 2021-03-22 assumed 'mean_value' for red and green MEANT meth and unmeth (OOBS), respectively.
-    #oobG = fit_func_green(container.oobG[unmeth].astype('float32').copy()) # v1.5.0+ uses noob version now, if available.
-
-    if len(container.ctrl_red) == 0 or len(container.ctrl_green) == 0:
-        pass # not correcting these if missing; sesame had this caveat too
-    else:
+    has_controls = len(container.ctrl_red) > 0 and len(container.ctrl_green) > 0 # not correcting these if missing; sesame had this caveat too
+    (transformed_II_meth, transformed_IG_meth, transformed_IG_unmeth) = _apply_transfer_curve(green_curve,
+        [container.II[meth], container.IG[meth], container.IG[unmeth]])
+    # NOTE: ctrl_green has always been corrected with the red curve here; kept for consistency with prior versions.
+    (transformed_II_unmeth, transformed_IR_meth, transformed_IR_unmeth, *controls) = _apply_transfer_curve(red_curve,
+        [container.II[unmeth], container.IR[meth], container.IR[unmeth]] +
+        ([container.ctrl_red['mean_value'], container.ctrl_green['mean_value']] if has_controls else []))
+    if has_controls:
         # THIS IS NOT SAVED BELOW... yet.
-        ctrl_red = fit_func_red(container.ctrl_red['mean_value'].astype('float32').copy()).round()
-        ctrl_green = fit_func_red(container.ctrl_green['mean_value'].astype('float32').copy()).round()
+        ctrl_red, ctrl_green = controls
 
     if debug:
         pass
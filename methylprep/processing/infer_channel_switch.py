@@ -1,5 +1,6 @@
 # Lib
 import logging
+import weakref
 import numpy as np
 import pandas as pd
 # App
@@ -9,94 +10,138 @@ __all__ = ['infer_type_I_probes']
 
 LOGGER = logging.getLogger(__name__)
 
+# one channel plan per Manifest object; entries go away with the manifest.
+_CHANNEL_PLANS = weakref.WeakKeyDictionary()
+
+
+def get_channel_plan(manifest):
+    """ the type-I probe names and addresses that infer_type_I_probes needs, computed once per manifest.
+
+    returns a dict of numpy arrays, all in IlmnID order:
+    - 'IlmnID': type-I probe names (IR and IG)
+    - 'addresses': (2, probes) AddressA_ID and AddressB_ID, as floats so missing addresses stay NaN
+    - 'is_IR': True for type-I-red probes, False for type-I-green
+    the idat positions of those addresses are added by _idat_positions and reused while the idat layout is the same."""
+    plan = _CHANNEL_PLANS.get(manifest)
+    if plan is not None:
+        return plan
+    probe_details_IR = manifest.get_probe_details(probe_type=ProbeType.ONE, channel=Channel.RED)
+    probe_details_IG = manifest.get_probe_details(probe_type=ProbeType.ONE, channel=Channel.GREEN)
+    names = np.concatenate([probe_details_IR.index.to_numpy(), probe_details_IG.index.to_numpy()])
+    addresses = np.vstack([
+        np.concatenate([
+            probe_details_IR[column].to_numpy(dtype='float64', na_value=np.nan),
+            probe_details_IG[column].to_numpy(dtype='float64', na_value=np.nan),
+        ]) for column in ('AddressA_ID', 'AddressB_ID')
+    ])
+    is_IR = np.r_[np.ones(len(probe_details_IR), dtype=bool), np.zeros(len(probe_details_IG), dtype=bool)]
+    order = np.argsort(names, kind='stable')
+    plan = {
+        'IlmnID': names[order],
+        'addresses': addresses[:, order],
+        'is_IR': is_IR[order],
+        'positions': {},
+    }
+    try:
+        _CHANNEL_PLANS[manifest] = plan
+    except TypeError: # not weak-referenceable; the plan is rebuilt for each sample
+        pass
+    return plan
+
+
+def _idat_positions(plan, probe_means):
+    """ (2, probes) row positions of each type-I probe's AddressA_ID and AddressB_ID in an idat's probe_means; -1 if missing.
+    Cached on the plan, because every idat of an array type usually lists the same addresses in the same order."""
+    index = probe_means.index
+    cached = plan['positions'].get(len(index))
+    if cached is not None and (cached[0] is index or cached[0].equals(index)):
+        return cached[1]
+    positions = np.vstack([index.get_indexer(addresses) for addresses in plan['addresses']])
+    plan['positions'][len(index)] = (index, positions)
+    return positions
+
+
 def infer_type_I_probes(container, debug=False):
     """ Adapted from sesaame from https://github.com/zwdzwd/sesame/blob/RELEASE_3_12/R/channel_inference.R.
     -- pass in a SampleDataContainer
     -- runs in SampleDataContainer.__init__ this BEFORE qualityMask step, so NaNs are not present
     -- changes raw_data idat probe_means
-    -- runs on raw_dataset, before meth-dataset is created, so @IR property doesn't exist yet; but get_infer has this"""
-    # this first step combines all I-red and I-green channel intensities, so IG+oobG and IR+oobR.
-    channels = get_infer_channel_probes(container.manifest, container.green_idat, container.red_idat, debug=debug)
-    green_I_channel = channels['green']
-    red_I_channel = channels['red']
-    ## NAN probes occurs when manifest is not complete
+    -- runs on raw_dataset, before meth-dataset is created, so @IR property doesn't exist yet; but get_infer has this
+
+    v1.7.2: works on numpy arrays. The manifest's type-I addresses are looked up once (get_channel_plan),
+    each probe's red and green intensities are read with fancy indexing, and the swap is done on the
+    mean_value arrays directly. Same probes and counts as the get_infer_channel_probes DataFrame version."""
+    plan = get_channel_plan(container.manifest)
+    green_means = container.green_idat.probe_means['mean_value'].to_numpy()
+    red_means = container.red_idat.probe_means['mean_value'].to_numpy()
+    green_pos = _idat_positions(plan, container.green_idat.probe_means)
+    red_pos = _idat_positions(plan, container.red_idat.probe_means)
+    # NAN probes occurs when manifest is not complete: only probes with both addresses in both idats are compared.
+    found = (green_pos >= 0).all(axis=0) & (red_pos >= 0).all(axis=0)
+    green_pos = green_pos[:, found]
+    red_pos = red_pos[:, found]
+    # (channel, address, probe): red and green intensities at AddressA and AddressB of each type-I probe.
+    intensities = np.stack([red_means[red_pos], green_means[green_pos]])
     ## If there are NA in the probe intensity, exclude these probes.
-    n_red = channels['IR'].count() # == container.IR.count() ## nrow(IR(sset)) | here, I am using count() to ignore missing probes
-    green_I_channel = green_I_channel.dropna()
-    red_I_channel = red_I_channel.dropna()
+    complete = ~pd.isna(intensities).any(axis=(0, 1))
+    intensities = intensities[:, :, complete]
+    names = plan['IlmnID'][found][complete]
+    is_IR = plan['is_IR'][found][complete]
 
     # get the higher of each channel per probe (thus there are 4 values per probe compared here; red meth, red unmeth, green meth, green unmeth)
-    red_max = red_I_channel.max(axis=1)
-    green_max = green_I_channel.max(axis=1)
+    red_max = intensities[0].max(axis=0)
+    green_max = intensities[1].max(axis=0)
     red_idx = (red_max > green_max) # TRUE mask; FALSE means the channel will be swapped
 
     # min_ib: take the lower of the channels and calculate quantile score,
     # then exclude if lower than the value where 95% of values would be above this range
-    min_ib = pd.DataFrame(np.minimum(red_I_channel.min(axis=1), green_I_channel.min(axis=1))) .quantile(0.95, axis=0)
     # min_ib is ONE number, the low-cutoff intensity. == 644 in sesame testing
-    min_ib = min_ib.values[0]
+    min_ib = np.quantile(intensities.min(axis=(0, 1)), 0.95) if len(names) else np.nan
     # now compare the higher of each channel and confirm it is always greater than the min_ib
     big_idx = (np.maximum(red_max, green_max) > min_ib) # a TRUE mask, probes that are OK
-    count_probes_to_swap = sum(np.maximum(red_max, green_max) <= min_ib)
-    # goal here: create a mask with TRUE/FALSE for every probe that is swapped or not. Then update data.
-    # print(f"big_idx: {big_idx}")
-    # if test fails, swap the value that corresponds to RED at the original index, using red_max0
-    # red_idx = np.where(big_idx, red_idx, False) # another TRUE mask
-    R2R = sum(np.where(red_I_channel.index.isin(channels['IR'].index) & red_idx & big_idx, True, False))
-    G2G = sum(np.where(green_I_channel.index.isin(channels['IG'].index) & ~red_idx & big_idx, True, False))
-    R2G = sum(np.where(red_I_channel.index.isin(channels['IR'].index) & ~red_idx & big_idx, True, False))
-    G2R = sum(np.where(green_I_channel.index.isin(channels['IG'].index) & red_idx & big_idx, True, False))
-    FailedR = sum(np.where(red_I_channel.index.isin(channels['IR'].index) & ~big_idx, True, False))
-    FailedG = sum(np.where(green_I_channel.index.isin(channels['IG'].index) & ~big_idx, True, False))
+    R2R = int((is_IR & red_idx & big_idx).sum())
+    G2G = int((~is_IR & ~red_idx & big_idx).sum())
+    R2G_mask = is_IR & ~red_idx & big_idx
+    G2R_mask = ~is_IR & red_idx & big_idx
+    R2G = int(R2G_mask.sum())
+    G2R = int(G2R_mask.sum())
+    FailedR = int((is_IR & ~big_idx).sum())
+    FailedG = int((~is_IR & ~big_idx).sum())
 
     if debug:
         if len(red_max) == 0:
             print('No probes were swapped because there are no type-I-ref probes detected!')
         else:
-            percent_probes_ok = 100* sum( np.maximum(red_max, green_max) > min_ib ) / len(red_max)
+            count_probes_to_swap = int((~big_idx).sum())
+            percent_probes_ok = 100 * big_idx.sum() / len(red_max)
             print(f"min_ib: {min_ib}, %swapped: {round(100-percent_probes_ok,3)} ({count_probes_to_swap})")
         print('R2R', R2R, 'G2G', G2G)
         print('R2G', R2G, 'G2R', G2R)
         print('FailedR', FailedR, 'FailedG', FailedG)
 
-    # finally, actually swap these probe values in the container and return nothing.
-    R2G_mask = np.where(red_I_channel.index.isin(channels['IR'].index) & ~red_idx & big_idx, True, False)
-    G2R_mask = np.where(green_I_channel.index.isin(channels['IG'].index) & red_idx & big_idx, True, False)
-
-    # this runs EARLY in processing, so modifying red_idat and green_idat directly.
-    lookup = channels['lookup'] # index are cpg probe names;
-    # Filter lookup to probes that need to be swapped and get a list of all the addresses that belong to them
-    R2G_lookup = lookup[lookup.index.isin(red_I_channel.index[R2G_mask])]
-    R2G_illumina_ids = R2G_lookup["AddressA_ID"].to_list() + R2G_lookup["AddressB_ID"].to_list()
-
-    G2R_lookup = lookup[lookup.index.isin(green_I_channel.index[G2R_mask])]
-    G2R_illumina_ids = G2R_lookup["AddressA_ID"].to_list() + G2R_lookup["AddressB_ID"].to_list()
-    # swap probe values
-    mask = container.red_idat.probe_means.index.isin(R2G_illumina_ids + G2R_illumina_ids)
-    pre_red = container.red_idat.probe_means.copy()
-    pre_green = container.green_idat.probe_means.copy()
-    post_red = container.red_idat.probe_means.copy()
-    post_green = container.green_idat.probe_means.copy()
-
-    # green --> red
-    post_red.loc[mask, 'mean_value'] = pre_green.loc[mask, 'mean_value']
-    # original red --> green
-    post_green.loc[mask, 'mean_value'] = pre_red.loc[mask, 'mean_value']
-
-    container.red_switched = list(red_I_channel.index[R2G_mask])
-    container.green_switched = list(green_I_channel.index[G2R_mask])
-    #print(f"switched {len(container.red_switched)} red and {len(container.green_switched)} green probes")
-    container.red_idat.probe_means = post_red
-    container.green_idat.probe_means = post_green
+    # finally, swap red and green at both addresses of every switched probe. This runs EARLY in processing,
+    # so it modifies red_idat and green_idat directly.
+    switched = R2G_mask | G2R_mask
+    green_switch = green_pos[:, complete][:, switched].ravel()
+    red_switch = red_pos[:, complete][:, switched].ravel()
+    post_green = green_means.copy()
+    post_red = red_means.copy()
+    post_red[red_switch] = green_means[green_switch] # green --> red
+    post_green[green_switch] = red_means[red_switch] # original red --> green
+
+    container.red_switched = list(names[R2G_mask])
+    container.green_switched = list(names[G2R_mask])
+    container.red_idat.probe_means = container.red_idat.probe_means.assign(mean_value=post_red)
+    container.green_idat.probe_means = container.green_idat.probe_means.assign(mean_value=post_green)
     return
 
 
-
 def get_infer_channel_probes(manifest, green_idat, red_idat, debug=False):
     """ like filter_oob_probes, but returns two dataframes for green and red channels with meth and unmeth columns
     effectively criss-crosses the red-oob channels and appends to green, and appends green-oob to red
     returns a dict with 'green' and 'red' channel probes
 
+    infer_type_I_probes no longer calls this (it uses get_channel_plan); kept for inspecting the channels in debugging.
     THIS runs before processing in SampleDataContainer, so that infer_type_I_probes() can modify the IDAT probe_means directly.    """
     probe_details_IR = manifest.get_probe_details(
         probe_type=ProbeType.ONE,
@@ -168,8 +213,8 @@ def get_infer_channel_probes(manifest, green_idat, red_idat, debug=False):
     green_in_band['unmeth'] = oobR_meth
 
     # next, add the green-in-band to oobG and red-in-band to oobR
-    oobG_IG = oobG.append(green_in_band).sort_index()
-    oobR_IR = oobR.append(red_in_band).sort_index()
+    oobG_IG = pd.concat([oobG, green_in_band]).sort_index()
+    oobR_IR = pd.concat([oobR, red_in_band]).sort_index()
 
     # channel swap requires a way to update idats with illumina_ids
     lookupIR = probe_details_IR.merge(
@@ -186,7 +231,7 @@ def get_infer_channel_probes(manifest, green_idat, red_idat, debug=False):
         right_index=True,
         suffixes=(False, False),
     )[['AddressA_ID','AddressB_ID']]
-    lookup = lookupIG.append(lookupIR).sort_index()
+    lookup = pd.concat([lookupIG, lookupIR]).sort_index()
 
     if debug:
         return {'green': oobG_IG, 'red': oobR_IR, 'oobG': oobG, 'oobR':oobR, 'IG': green_in_band, 'IR': red_in_band, 'lookup': lookup}
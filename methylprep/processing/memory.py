@@ -0,0 +1,131 @@
+# Lib
+import logging
+import os
+from pathlib import Path
+import re
+
+__all__ = ['available_memory', 'available_cpus', 'parse_memory', 'plan_batches']
+
+LOGGER = logging.getLogger(__name__)
+
+# Memory model behind batch_size='auto', in bytes per manifest probe (27k: 27,578 ... EPIC+: 868,698 probes).
+WORKER_BYTES_PER_PROBE = 2500 # peak while processing one sample: manifest, both IDATs, SigSet subsets and intermediates
+MAIN_BYTES_PER_PROBE = 1000 # run_pipeline's own manifest and sample sheet, held for the whole run
+CONTAINER_BYTES_PER_PROBE = 80 # a processed SampleDataContainer kept for its batch: ~8 float64 columns and the index
+OUTPUT_BYTES_PER_PROBE = 4 # each float32 matrix output (beta_values, noob_meth_values, ...) per sample
+DEFAULT_MEMORY_FRACTION = 0.8 # of available memory, when no max_memory is given
+FALLBACK_MEMORY = 4 * 1024**3 # if available memory cannot be read on this platform
+_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+
+def parse_memory(value):
+    """ bytes from an int, or a string like '16G', '512M', '1.5T' (powers of 1024; 'B' / 'iB' suffixes allowed) """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)(?:I?B)?\s*', str(value).upper())
+    if not match:
+        raise ValueError(f"max_memory must be a number of bytes or a size like '16G' or '512M'; you said {value}")
+    return int(float(match.group(1)) * _UNITS[match.group(2)])
+
+
+def _read_int(path):
+    try:
+        text = Path(path).read_text().strip()
+    except OSError:
+        return None
+    return int(text) if text.isdigit() else None # cgroup v2 writes 'max' for no limit
+
+
+def _cgroup_memory_available():
+    """ limit minus usage of this process's memory cgroup (v2 or v1), or None if there is no limit """
+    paths = []
+    try:
+        for line in Path('/proc/self/cgroup').read_text().splitlines():
+            hierarchy, controllers, path = line.split(':', 2)
+            if hierarchy == '0': # v2
+                paths.append((Path('/sys/fs/cgroup', path.lstrip('/')), 'memory.max', 'memory.current'))
+            elif 'memory' in controllers.split(','): # v1
+                paths.append((Path('/sys/fs/cgroup/memory', path.lstrip('/')), 'memory.limit_in_bytes', 'memory.usage_in_bytes'))
+    except (OSError, ValueError):
+        pass
+    # inside a container the cgroup is usually mounted as the root of /sys/fs/cgroup
+    paths += [(Path('/sys/fs/cgroup'), 'memory.max', 'memory.current'),
+        (Path('/sys/fs/cgroup/memory'), 'memory.limit_in_bytes', 'memory.usage_in_bytes')]
+    for folder, limit_file, usage_file in paths:
+        limit = _read_int(Path(folder, limit_file))
+        if limit is None or limit >= 2**60: # no limit (v1 reports a huge number)
+            continue
+        usage = _read_int(Path(folder, usage_file)) or 0
+        return max(limit - usage, 0)
+    return None
+
+
+def available_memory():
+    """ bytes of memory this process can still use: MemAvailable, capped by the cgroup limit (docker, kubernetes, slurm).
+    None if it cannot be read on this platform. """
+    available = None
+    try:
+        for line in Path('/proc/meminfo').read_text().splitlines():
+            if line.startswith('MemAvailable:'):
+                available = int(line.split()[1]) * 1024
+                break
+    except (OSError, ValueError, IndexError):
+        pass
+    if available is None:
+        try:
+            import psutil # optional
+            available = psutil.virtual_memory().available
+        except ImportError:
+            pass
+    cgroup = _cgroup_memory_available()
+    if cgroup is not None:
+        available = cgroup if available is None else min(available, cgroup)
+    return available
+
+
+def available_cpus():
+    """ CPUs this process may use: its affinity mask, capped by a cgroup v2 cpu.max quota """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError: # not linux
+        cpus = os.cpu_count() or 1
+    try:
+        quota, period = Path('/sys/fs/cgroup/cpu.max').read_text().split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def plan_batches(n_samples, n_probes, max_memory=None, n_jobs=None, n_outputs=4):
+    """ chooses (batch_size, workers) for batch_size='auto', so processing stays under max_memory.
+
+    - max_memory: bytes (or '16G') the run may use; default: 80% of available memory (see available_memory).
+    - workers: n_jobs if given (reduced if even one batch sample would not fit beside that many workers);
+      otherwise as many as there are CPUs, using at most half of the memory.
+    - batch_size: how many processed samples fit in the rest, or None if all n_samples do (one batch, no parts).
+    The estimates come from the bytes-per-probe model in this module, for arrays of n_probes probes."""
+    if max_memory is None:
+        available = available_memory()
+        if available is None:
+            LOGGER.warning(f"Could not read available memory on this platform; batch_size='auto' assumes {FALLBACK_MEMORY / 1024**3:.0f}GB. Set max_memory to change this.")
+            available = FALLBACK_MEMORY
+        max_memory = int(available * DEFAULT_MEMORY_FRACTION)
+    else:
+        max_memory = parse_memory(max_memory)
+    per_worker = n_probes * WORKER_BYTES_PER_PROBE
+    per_sample = n_probes * (CONTAINER_BYTES_PER_PROBE + OUTPUT_BYTES_PER_PROBE * n_outputs)
+    budget = max_memory - n_probes * MAIN_BYTES_PER_PROBE
+    if n_jobs is None:
+        workers = int(max(1, min(available_cpus(), n_samples, budget // 2 // per_worker)))
+    else:
+        workers = int(max(1, min(n_jobs, (budget - per_sample) // per_worker)))
+        if workers < n_jobs:
+            LOGGER.warning(f"Only {workers} of the {n_jobs} workers fit in {max_memory / 1024**3:.1f}GB; using {workers}.")
+    batch_size = int((budget - workers * per_worker) // per_sample)
+    if batch_size < 1:
+        LOGGER.warning(f"{max_memory / 1024**3:.1f}GB is less than processing one sample needs (~{(n_probes * MAIN_BYTES_PER_PROBE + per_worker + per_sample) / 1024**3:.1f}GB); using batch_size=1.")
+        batch_size = 1
+    LOGGER.info(f"batch_size='auto': {min(batch_size, n_samples)} samples per batch, {workers} workers, for {max_memory / 1024**3:.1f}GB")
+    return (None if batch_size >= n_samples else batch_size), workers
@@ -8,8 +8,10 @@ from pathlib import Path
 import shutil
 from collections import Counter
 # App
+from ..models import ArrayType, Channel
 from ..models.sigset import parse_sample_sheet_into_idat_datasets
-from ..files import find_sample_sheet, create_sample_sheet, SampleSheet
+from ..files import find_sample_sheet, create_sample_sheet, SampleSheet, IdatDataset
+from ..files.sample_sheets import SampleSubset
 
 LOGGER = logging.getLogger(__name__)
 
@@ -36,3 +38,44 @@ def check_array_folders(data_dir, verbose=True):
                 idats_found = list(Path(sample_sheet_file.parent).rglob('*.idat')) + list(Path(sample_sheet_file.parent).rglob('*.idat.gz'))
                 instructions.append(f"For {int(len(idats_found)/2)} {array_type} samples run: `methylprep process -d {sample_sheet_file.parent} --all`")
     return instructions
+
+
+class ArrayPartition(SampleSubset):
+    """The samples of one array type, from one or more of the sample sheets in a mixed-array folder (like a GEO
+    package of 450k and EPIC samples), made by partition_by_array_type()."""
+
+    def __init__(self, array_type):
+        super().__init__()
+        self.array_type = array_type
+
+    @property
+    def label(self):
+        """ the array type as a folder name: '450k', 'epic', 'epic_plus', ... """
+        return str(self.array_type).replace('+', '_plus')
+
+    def __repr__(self):
+        return f"ArrayPartition({self.label}: {len(self.get_samples())} samples from {len(self.sample_sheets)} sample sheets)"
+
+
+def partition_by_array_type(data_dir, sample_sheet_filepaths=None):
+    """Groups the samples of every sample sheet in data_dir (or of sample_sheet_filepaths) by array type, read from
+    the header of each sample's Grn IDAT: only the probe count is read, not the probe data.
+    Each sample's IDATs are found relative to its own sample sheet, as with a single sheet.
+    Returns a list of ArrayPartition, one per array type, in the order they were found."""
+    if sample_sheet_filepaths is None:
+        sample_sheet_filepaths = find_sample_sheet(data_dir, return_all=True)
+        if not isinstance(sample_sheet_filepaths, list):
+            sample_sheet_filepaths = [sample_sheet_filepaths]
+    partitions = {}
+    for sample_sheet_filepath in sample_sheet_filepaths:
+        sample_sheet = SampleSheet(sample_sheet_filepath, Path(sample_sheet_filepath).parent)
+        sheet_partitions = {}
+        for sample in sample_sheet.get_samples():
+            probe_count = IdatDataset.read_probe_count(sample.get_filepath('idat', Channel.GREEN))
+            sheet_partitions.setdefault(ArrayType.from_probe_count(probe_count), []).append(sample)
+        for array_type, samples in sheet_partitions.items():
+            if array_type not in partitions:
+                partitions[array_type] = ArrayPartition(array_type)
+            partitions[array_type].add(sample_sheet, samples)
+        LOGGER.info(f"{sample_sheet_filepath}: " + ', '.join(f"{len(samples)} {array_type} samples" for array_type, samples in sheet_partitions.items()))
+    return list(partitions.values())
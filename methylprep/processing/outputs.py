@@ -0,0 +1,406 @@
+# Lib
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+from pathlib import Path
+import pickle
+import re
+import shutil
+import threading
+import numpy as np
+import pandas as pd
+
+__all__ = ['ProcessedOutputs', 'MatrixWriter', 'ExportWriter', 'load_matrix', 'existing_sample_ids', 'append_outputs', 'merge_outputs']
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ProcessedOutputs(Mapping):
+    """What run_pipeline(..., results='files') returns: handles to the files that the run saved, instead of SampleDataContainers.
+
+    Nothing is loaded until you ask for it; each lookup reads the file(s) again, so keep the returned frame
+    if you need it more than once.
+
+    - keys are output names: 'beta_values', 'm_values', 'noob_meth_values', 'poobah_values', 'control_probes', ...
+    - outputs['beta_values'] loads that output. Matrices saved in several batch parts (batch_size >= 200 is not merged)
+      are joined into one DataFrame; control_probes and mouse_probes load as the dict of DataFrames that was saved.
+    - outputs.paths['beta_values'] is the list of files behind it.
+
+    Example:
+        outputs = methylprep.run_pipeline(data_dir, betas=True, results='files')
+        betas = outputs['beta_values']
+    """
+
+    def __init__(self, paths=None, formats=None):
+        self.paths = {} # name -> [Path, ...]
+        self.formats = {} # name -> 'pickle' | 'parquet' | 'npy'
+        for name, files in (paths or {}).items():
+            self.add(name, files, (formats or {}).get(name, 'pickle'))
+
+    def add(self, name, files, file_format='pickle'):
+        """ registers saved file(s) under an output name; used by run_pipeline as it saves each output. """
+        files = [files] if isinstance(files, (str, Path)) else list(files)
+        self.paths[name] = [Path(file) for file in files]
+        self.formats[name] = file_format if file_format in ('parquet', 'npy') else 'pickle'
+
+    def load(self, name):
+        if name not in self.paths:
+            raise KeyError(f"{name} was not saved by this run; available outputs: {list(self.paths)}")
+        read = {'parquet': pd.read_parquet, 'npy': load_matrix}.get(self.formats[name], pd.read_pickle)
+        parts = [read(path) for path in self.paths[name]]
+        if len(parts) == 1:
+            return parts[0]
+        if all(isinstance(part, dict) for part in parts):
+            return {key: value for part in parts for key, value in part.items()}
+        return pd.concat(parts, axis='columns', join='inner')
+
+    def __getitem__(self, name):
+        return self.load(name)
+
+    def __contains__(self, name):
+        return name in self.paths # without loading anything
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __repr__(self):
+        return f"ProcessedOutputs({', '.join(self.paths)})"
+
+
+class MatrixWriter():
+    """A probes x samples output matrix (beta_values, noob_meth_values, ...) that is filled one sample at a time.
+
+    The matrix is a memory-mapped .npy file in data_dir, sized up front for every sample in the run, with each
+    sample's column contiguous on disk. run_pipeline(stream_outputs=True) writes a sample's column as soon as the
+    sample is processed, so memory use doesn't grow with the number of samples and batches need no merge step.
+    finalize() saves the same file that run_pipeline would otherwise save (probes and sample_ids sorted):
+        - 'pickle' or 'parquet': {file_stem}.pkl / {file_stem}.parquet, a DataFrame (this loads the matrix once)
+        - 'npy': {file_stem}.npy plus {file_stem}.index.json (probe and sample names), kept on disk as it is;
+          read it with load_matrix(), which memory-maps it instead of loading it.
+    """
+
+    def __init__(self, data_dir, file_stem, probes, sample_ids, dtype='float32'):
+        self.data_dir = Path(data_dir)
+        self.file_stem = file_stem
+        self.probes = pd.Index(probes) # in the order write() receives values
+        self._order = np.asarray(self.probes.argsort()) # output probe order: sorted, like DataFrame.sort_index()
+        self.sample_ids = sorted(sample_ids)
+        self._columns = {}
+        for column, sample_id in enumerate(self.sample_ids):
+            self._columns.setdefault(sample_id, []).append(column)
+        self._written = np.zeros(len(self.sample_ids), dtype=bool)
+        self.has_nan = False
+        self.temp_path = Path(data_dir, f".{file_stem}.partial.npy")
+        self._matrix = np.lib.format.open_memmap(self.temp_path, mode='w+', dtype=dtype,
+            shape=(len(self.probes), len(self.sample_ids)), fortran_order=True)
+
+    def write(self, sample_id, values, probes=None):
+        """ stores one sample's values, in `self.probes` order; or pass the sample's own `probes` to realign them. """
+        if probes is not None and not (probes is self.probes or probes.equals(self.probes)):
+            values = pd.Series(values, index=probes).reindex(self.probes).to_numpy()
+        if not self._columns.get(sample_id):
+            raise ValueError(f"{sample_id} is not an unwritten sample of {self.file_stem}")
+        column = self._columns[sample_id].pop(0)
+        values = np.asarray(values)[self._order]
+        self.has_nan = self.has_nan or bool(np.isnan(values).any())
+        self._matrix[:, column] = values
+        self._written[column] = True
+
+    def finalize(self, file_format='pickle', uint16=False):
+        """ saves the matrix as {file_stem}.pkl / .parquet / .npy in data_dir; returns that path.
+        Samples never written are left out (pickle, parquet) or all-NaN (npy).
+        uint16 (pickle only): saves integers when no value is missing, like run_pipeline's intensity outputs."""
+        self._matrix.flush()
+        probes = self.probes[self._order]
+        if file_format == 'npy':
+            if not self._written.all():
+                self._matrix[:, ~self._written] = np.nan
+                self._matrix.flush()
+            del self._matrix
+            path = Path(self.data_dir, f"{self.file_stem}.npy")
+            index_path = path.with_suffix('.index.json')
+            temp_index = index_path.with_name(f".{index_path.name}.tmp")
+            with open(temp_index, 'w') as f:
+                json.dump({'probes': [str(probe) for probe in probes], 'samples': self.sample_ids, 'index_name': probes.name}, f)
+            self.temp_path.replace(path)
+            os.replace(temp_index, index_path) # never a partly written index next to the matrix
+            return path
+
+        df = self.frame()
+        if uint16 and file_format != 'parquet' and not self.has_nan:
+            df = df.astype('uint16')
+        else:
+            df = df.astype('float32', copy=False) # saved as float32 like run_pipeline's batch outputs, whatever the dtype
+        if df.shape[1] > df.shape[0]:
+            df = df.transpose() # put probes as columns for faster loading.
+        if file_format == 'parquet':
+            path = Path(self.data_dir, f"{self.file_stem}.parquet")
+            df.to_parquet(path)
+        else:
+            path = Path(self.data_dir, f"{self.file_stem}.pkl")
+            df.to_pickle(path)
+        del df
+        del self._matrix
+        self.temp_path.unlink()
+        return path
+
+    def frame(self):
+        """ the written samples as an in-memory probes x samples DataFrame (probes and sample_ids sorted) """
+        written = np.flatnonzero(self._written)
+        data = self._matrix if len(written) == len(self.sample_ids) else self._matrix[:, written]
+        return pd.DataFrame(np.array(data), index=self.probes[self._order], columns=[self.sample_ids[i] for i in written])
+
+    def discard(self):
+        """ removes the partial matrix without saving it """
+        if hasattr(self, '_matrix'):
+            del self._matrix
+        self.temp_path.unlink(missing_ok=True)
+
+
+class ExportWriter():
+    """Saves the per-sample export files (processed CSV or parquet) in background threads, so that run_pipeline
+    processes the next sample while the last one is written.
+
+    - submit(func, *args) runs func(*args) in one of `workers` threads. At most `max_pending` writes are queued or in
+      progress; submit() waits for one to finish before queueing another, so a slow disk holds back processing
+      instead of filling memory with frames waiting to be written.
+    - the first write that fails raises its error in the calling thread, at the next submit(), wait() or close().
+    - wait() returns once every queued write is saved; close() also stops the threads, and cancel() stops them
+      without saving the queued writes.
+    """
+
+    def __init__(self, workers=2, max_pending=4):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='methylprep-export')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures = []
+
+    def submit(self, func, *args, **kwargs):
+        self._raise_errors()
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(func, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+        return future
+
+    def _raise_errors(self):
+        pending = []
+        for future in self._futures:
+            if future.done():
+                future.result() # raises the write's error
+            else:
+                pending.append(future)
+        self._futures = pending
+
+    def wait(self):
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self._pool.shutdown(wait=True)
+
+    def cancel(self):
+        """ for a run that is already failing: drops the queued writes, lets the ones in progress finish and stops the
+        threads, without raising their errors (which would hide the run's) """
+        for future in self._futures:
+            future.cancel()
+        self._futures = []
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.cancel()
+        return False
+
+
+def load_matrix(path, mmap_mode='r'):
+    """ reads a MatrixWriter 'npy' output ({file_stem}.npy and {file_stem}.index.json) as a DataFrame with probes
+    in rows and samples in columns. The values stay memory-mapped (read-only) unless mmap_mode=None. """
+    path = Path(path)
+    with open(path.with_suffix('.index.json')) as f:
+        index = json.load(f)
+    values = np.load(path, mmap_mode=mmap_mode)
+    return pd.DataFrame(values, index=pd.Index(index['probes'], name=index.get('index_name')), columns=index['samples'], copy=False)
+
+
+def _read(path, file_format):
+    if file_format == 'npy':
+        return load_matrix(path)
+    if file_format == 'parquet' and Path(path).suffix == '.parquet':
+        return pd.read_parquet(path)
+    return pd.read_pickle(path)
+
+
+_SAMPLE_ID = re.compile(r'\d+_R\d{2}C\d{2}') # sentrix_id_position, how matrix outputs name samples
+
+
+def _samples_in_columns(df):
+    """ matrix outputs are saved with probes in rows, unless there were more samples than probes; the probe axis is
+    named IlmnID either way. A frame without that name is read as probes in rows unless its rows are sample ids. """
+    if df.columns.name == 'IlmnID' or df.index.name == 'IlmnID':
+        return df.index.name == 'IlmnID'
+    return len(df.index) == 0 or not all(_SAMPLE_ID.fullmatch(str(label)) for label in df.index)
+
+
+def existing_sample_ids(data_dir, file_stems, file_format='pickle'):
+    """ the sample ids (sentrix_id_position) that have a column in every one of the matrix outputs (file_stems)
+    already saved in data_dir; None if there are none of these files. """
+    suffix = {'parquet': 'parquet', 'npy': 'npy'}.get(file_format, 'pkl')
+    found = None
+    for file_stem in file_stems:
+        path = Path(data_dir, f"{file_stem}.{suffix}")
+        if not path.exists():
+            continue
+        if file_format == 'npy':
+            with open(path.with_suffix('.index.json')) as f:
+                sample_ids = set(json.load(f)['samples'])
+        else:
+            df = _read(path, file_format)
+            sample_ids = set(df.columns if _samples_in_columns(df) else df.index)
+            del df
+        found = sample_ids if found is None else found & sample_ids
+    return found
+
+
+def append_outputs(staged, data_dir, uint16=()):
+    """ adds the samples of a run's outputs (`staged`, a ProcessedOutputs of files saved in a staging folder) to the
+    outputs of the same name in data_dir, as run_pipeline(append=True) does; returns a ProcessedOutputs of data_dir files.
+
+    - matrices (beta_values, poobah_values, ...) get the new sample columns, replacing any column of the same sample,
+      with the union of probes (NaN where a sample lacks one); uint16 lists the outputs saved as integers when complete.
+    - control_probes and mouse_probes (dicts of per-sample frames, or parquet rows per Sentrix_ID) get the new samples.
+    - sample_sheet_meta_data gets the new samples' rows, replacing any row of the same Sample_ID.
+    Each combined file is saved next to its original and only renamed over it once every output is combined.
+    The staging folder is removed afterwards."""
+    combined = ProcessedOutputs()
+    replacements = [] # (combined temp file, final path)
+    for name in staged:
+        file_format = staged.formats[name]
+        parts = staged.paths[name]
+        final = Path(data_dir, f"{name}{parts[0].suffix}")
+        if file_format == 'npy':
+            replacements.extend(_append_matrix_npy(name, final, parts, data_dir))
+        elif not final.exists():
+            replacements.append((parts[0], final) if len(parts) == 1 else (_save_temp(staged.load(name), final, file_format), final))
+        else:
+            new = staged.load(name)
+            if isinstance(new, dict):
+                with open(final, 'rb') as f:
+                    old = pickle.load(f)
+                new = {**old, **new}
+            elif name == 'control_probes': # parquet: one row per sample and probe
+                old = _read(final, file_format)
+                new = pd.concat([old[~old['Sentrix_ID'].isin(new['Sentrix_ID'])], new], ignore_index=True)
+            elif name == 'sample_sheet_meta_data':
+                old = _read(final, file_format)
+                if 'Sample_ID' in old.columns and 'Sample_ID' in new.columns:
+                    new = pd.concat([old[~old['Sample_ID'].isin(new['Sample_ID'])], new], ignore_index=True)
+            else:
+                new = _append_matrix(_read(final, file_format), new, file_format, uint16=(name in uint16))
+            replacements.append((_save_temp(new, final, file_format), final))
+            del new
+        combined.add(name, final, file_format)
+    for temp, final in replacements:
+        os.replace(temp, final)
+    if staged.paths:
+        staging_dirs = {path.parent for paths in staged.paths.values() for path in paths}
+        for staging_dir in staging_dirs:
+            if Path(staging_dir).resolve() != Path(data_dir).resolve():
+                shutil.rmtree(staging_dir, ignore_errors=True)
+    return combined
+
+
+def merge_outputs(runs, data_dir, uint16=()):
+    """ combines the outputs of runs over different samples (a list of ProcessedOutputs, like the shards of
+    run_pipeline(shard='auto')) into one file per output in data_dir, in the order given; returns a ProcessedOutputs.
+
+    - matrices get every run's sample columns, with the union of probes (NaN where a run lacks one); uint16 lists the
+      outputs saved as integers when complete.
+    - control_probes and mouse_probes get every run's samples, and sample_sheet_meta_data every run's rows.
+    Each file is saved under a temporary name and renamed. npy matrices are not supported. """
+    merged = ProcessedOutputs()
+    names = list(dict.fromkeys(name for run in runs for name in run))
+    for name in names:
+        parts = [run for run in runs if name in run]
+        file_format = parts[0].formats[name]
+        if file_format == 'npy':
+            raise ValueError(f"{name}: npy outputs can't be merged; use pickle or parquet")
+        frames = [part.load(name) for part in parts]
+        if all(isinstance(frame, dict) for frame in frames):
+            new = {key: value for frame in frames for key, value in frame.items()}
+        elif name in ('sample_sheet_meta_data', 'control_probes'): # rows per sample (control_probes as parquet)
+            new = pd.concat(frames, ignore_index=True)
+        else:
+            new = _combine_matrices([frame if _samples_in_columns(frame) else frame.transpose() for frame in frames],
+                file_format, uint16=(name in uint16))
+        del frames
+        final = Path(data_dir, f"{name}{parts[0].paths[name][0].suffix}")
+        os.replace(_save_temp(new, final, file_format), final)
+        del new
+        merged.add(name, final, file_format)
+    return merged
+
+
+def _append_matrix(old, new, file_format, uint16=False):
+    old = old if _samples_in_columns(old) else old.transpose()
+    new = new if _samples_in_columns(new) else new.transpose()
+    return _combine_matrices([old.drop(columns=new.columns, errors='ignore'), new], file_format, uint16=uint16)
+
+
+def _combine_matrices(frames, file_format, uint16=False):
+    """ probes x samples frames side by side (the union of probes), saved as run_pipeline saves one matrix """
+    df = pd.concat(frames, axis='columns')
+    if uint16 and file_format != 'parquet' and not df.isna().any().any():
+        df = df.astype('uint16')
+    else:
+        df = df.astype('float32')
+    if df.shape[1] > df.shape[0]:
+        df = df.transpose() # put probes as columns for faster loading.
+    return df.sort_index().reindex(sorted(df.columns), axis=1)
+
+
+def _append_matrix_npy(name, final, parts, data_dir):
+    """ the npy version of _append_matrix, one sample column at a time through a MatrixWriter. The combined matrix and
+    its index are saved as .{name}.append.npy / .index.json; returns their (temp file, final path) replacements. """
+    if not final.exists():
+        return [(parts[0], final), (parts[0].with_suffix('.index.json'), final.with_suffix('.index.json'))]
+    old = load_matrix(final)
+    new = load_matrix(parts[0])
+    kept = [sample_id for sample_id in old.columns if sample_id not in set(new.columns)]
+    writer = MatrixWriter(data_dir, f".{name}.append", old.index.union(new.index, sort=False), kept + list(new.columns),
+        dtype=old.dtypes.iloc[0])
+    for frame, sample_ids in ((old, kept), (new, new.columns)):
+        for sample_id in sample_ids:
+            writer.write(sample_id, frame[sample_id].to_numpy(), probes=frame.index)
+    del old, new
+    temp = writer.finalize('npy')
+    return [(temp, final), (temp.with_suffix('.index.json'), final.with_suffix('.index.json'))]
+
+
+def _save_temp(df, final, file_format):
+    temp = final.with_name(f".{final.name}.append")
+    if isinstance(df, dict):
+        with open(temp, 'wb') as f:
+            pickle.dump(df, f)
+    elif file_format == 'parquet' and final.suffix == '.parquet':
+        df.to_parquet(temp)
+    else:
+        df.to_pickle(temp)
+    return temp
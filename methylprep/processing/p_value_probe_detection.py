@@ -1,10 +1,4 @@
-try:
-    from methylcheck import mean_beta_compare
-except ImportError:
-    mean_beta_compare = None
-import types
-from scipy import stats
-from statsmodels.distributions.empirical_distribution import ECDF
+from scipy import stats, special
 import pandas as pd
 import numpy as np
 
@@ -16,240 +10,227 @@ def _pval_sesame_preprocess(data_container, combine_neg=True):
     - output: index are probes (IlmnID or illumina_id); one column [poobah_pval] contains the sample p-values.
     - called by pipeline CLI --poobah option.
     - confirmed that this version produces identical results to the pre-v1.5.0 version on 2021-06-16
+    - v1.7.2: background ECDFs are sorted arrays evaluated with np.searchsorted (identical to statsmodels ECDF)
     """
-    if data_container.debug == True: 
+    if data_container.debug == True:
         print("DEBUG: running 1.6.2 poobah method instead")
         # 2021-03-22 assumed 'mean_value' for red and green MEANT meth and unmeth (OOBS), respectively.
         # oob[G/R]['Unmeth'] is the out of band signal from the probe capturing the unmethylated state
         # oob[G/R]['Meth'] is the out of band signal from the probe capturing the methylated state
-        funcG = ECDF(data_container.oobG['Unmeth'].values)
-        funcR = ECDF(data_container.oobR['Meth'].values)
+        bgG = data_container.oobG['Unmeth'].to_numpy()
+        bgR = data_container.oobR['Meth'].to_numpy()
     else:
-        bgG = (
-            list(data_container.oobG['Unmeth'].values)
-            + list(data_container.oobG['Meth'].values)
-        )
-        bgR = (
-            list(data_container.oobR['Unmeth'].values)
-            + list(data_container.oobR['Meth'].values)
-        )
+        bgG = [data_container.oobG['Unmeth'].to_numpy(), data_container.oobG['Meth'].to_numpy()]
+        bgR = [data_container.oobR['Unmeth'].to_numpy(), data_container.oobR['Meth'].to_numpy()]
         # SeSAMe by default includes negative controls as a part of the background green and red intensities
         if combine_neg:
             # Add green signal from negative controls to background green intensities
-            dfG = data_container.ctrl_green
-            dfG = dfG[dfG['Control_Type']=='NEGATIVE']
-            dfG = dfG[['Extended_Type','mean_value']]
-            bgG += list(dfG['mean_value'].values)
+            bgG.append(_negative_controls(data_container.ctrl_green))
             # Add reg signal from negative controls to background red intensitites
-            dfR = data_container.ctrl_red
-            dfR = dfR[dfR['Control_Type']=='NEGATIVE']
-            dfR = dfR[['Extended_Type','mean_value']]
-            bgR += list(dfR['mean_value'].values)
-        # Build empirical cumulative distribution functions
-        funcG = ECDF(bgG)
-        funcR = ECDF(bgR)
-
+            bgR.append(_negative_controls(data_container.ctrl_red))
+        bgG = np.concatenate(bgG)
+        bgR = np.concatenate(bgR)
     # Apply function of background red intensity to red probes and background green intensity to green probes
-    pIR = pd.DataFrame(
-        index=data_container.IR.index,
-        data=1-np.maximum(funcR(data_container.IR['Meth']), funcR(data_container.IR['Unmeth'])),
-        columns=['poobah_pval'])
-    pIG = pd.DataFrame(
-        index=data_container.IG.index,
-        data=1-np.maximum(funcG(data_container.IG['Meth']), funcG(data_container.IG['Unmeth'])),
-        columns=['poobah_pval'])
-    pII = pd.DataFrame(
-        index=data_container.II.index,
-        data=1-np.maximum(funcG(data_container.II['Meth']), funcR(data_container.II['Unmeth'])),
-        columns=['poobah_pval'])
     # pval output: index is IlmnID; and threre's one column, 'poobah_pval' with p-values
-    pval = pd.concat([pIR,pIG,pII])
-    return pval
+    return _ecdf_pval_frame(data_container, bgG, bgR, 'poobah_pval')
 
 def _pval_neg_ecdf(data_container):
-    dfR = data_container.ctrl_red
-    dfR = dfR[dfR['Control_Type']=='NEGATIVE']
-    dfR = dfR[['Extended_Type','mean_value']]
-    funcR = ECDF(dfR['mean_value'].values)
-    dfG = data_container.ctrl_green
-    dfG = dfG[dfG['Control_Type']=='NEGATIVE']
-    dfG = dfG[['Extended_Type','mean_value']]
-    funcG = ECDF(dfG['mean_value'].values)
-    pIR = pd.DataFrame(
-        index=data_container.IR.index,
-        data=1-np.maximum(funcR(data_container.IR['Meth']), funcR(data_container.IR['Unmeth'])),
-        columns=['pNegECDF_pval'])
-    pIG = pd.DataFrame(
-        index=data_container.IG.index,
-        data=1-np.maximum(funcG(data_container.IG['Meth']), funcG(data_container.IG['Unmeth'])),
-        columns=['pNegECDF_pval'])
-    pII = pd.DataFrame(
-        index=data_container.II.index,
-        data=1-np.maximum(funcG(data_container.II['Meth']), funcR(data_container.II['Unmeth'])),
-        columns=['pNegECDF_pval'])
-    # concat and sort
-    pval = pd.concat([pIR, pIG, pII])
-    return pval
-
-
-
-""" DEPRECATED FUNCTIONS (<v1.5.0)
-def detect_probes(data_containers, method='sesame', save=False, silent=True):
-    '''
+    bgR = _negative_controls(data_container.ctrl_red)
+    bgG = _negative_controls(data_container.ctrl_green)
+    return _ecdf_pval_frame(data_container, bgG, bgR, 'pNegECDF_pval')
+
+
+def _negative_controls(ctrl):
+    """ mean_value intensities of NEGATIVE control probes in one channel, as an array """
+    return ctrl['mean_value'].to_numpy()[ (ctrl['Control_Type'] == 'NEGATIVE').to_numpy() ]
+
+
+def _ecdf(background):
+    """ empirical CDF of background intensities, as a (sorted background, step levels) pair for _ecdf_eval.
+    - same steps as statsmodels' ECDF: levels[k] is the fraction of background values <= the k-th smallest value
+    - NaNs are kept and sort to the end, so they count towards the total, as in statsmodels."""
+    background = np.sort(np.asarray(background))
+    levels = np.concatenate([[0.0], np.linspace(1./len(background), 1, len(background))])
+    return background, levels
+
+def _ecdf_eval(ecdf, values):
+    """ evaluates an _ecdf() at each value: fraction of the background <= value (right-continuous step function) """
+    background, levels = ecdf
+    return levels[np.searchsorted(background, values, side='right')]
+
+def _ecdf_pval_frame(data_container, bgG, bgR, column):
+    """ one sample's p-values, aligned to IR, IG, II probe order, as a single-column DataFrame """
+    index = data_container.IR.index.append(data_container.IG.index).append(data_container.II.index)
+    return pd.DataFrame({column: _ecdf_pval_vector(data_container, bgG, bgR)}, index=index)
+
+def _ecdf_pval_vector(data_container, bgG, bgR, out=None):
+    """ 1 - max(ECDF(meth), ECDF(unmeth)) for every IR, IG, II probe (in that order), using each probe's channel background """
+    funcG = _ecdf(bgG)
+    funcR = _ecdf(bgR)
+    sections = [
+        (data_container.IR, funcR, funcR),
+        (data_container.IG, funcG, funcG),
+        (data_container.II, funcG, funcR), # type II: meth is read in green, unmeth in red
+    ]
+    if out is None:
+        out = np.empty(sum(len(probes) for probes, _, _ in sections), dtype='float64')
+    start = 0
+    for probes, func_meth, func_unmeth in sections:
+        stop = start + len(probes)
+        np.maximum(_ecdf_eval(func_meth, probes['Meth'].to_numpy()), _ecdf_eval(func_unmeth, probes['Unmeth'].to_numpy()), out=out[start:stop])
+        np.subtract(1, out[start:stop], out=out[start:stop])
+        start = stop
+    return out
+
+
+def pval_ecdf_batch(meth, unmeth, red_meth, red_unmeth, bg_green, bg_red, out=None):
+    """ batched poobah / pNegECDF p-values for a whole (samples x probes) matrix.
+
+    meth, unmeth
+        (samples x probes) intensity arrays, with the same probe columns for every sample.
+    red_meth, red_unmeth
+        boolean (probes,) arrays: True where that intensity is read in the red channel (IR probes: both;
+        II probes: unmeth only; IG probes: neither).
+    bg_green, bg_red
+        background intensities for each sample: a (samples x n) array, or a list of 1-D arrays when samples
+        have different numbers of background probes. For poobah, these are out-of-band (+ NEGATIVE control)
+        intensities; for pNegECDF, only NEGATIVE controls.
+    out
+        optional preallocated (samples x probes) float array to write into.
+
+    Returns (samples x probes) p-values, 1 - max(ECDF(meth), ECDF(unmeth)), matching _pval_sesame_preprocess per sample.
+    """
+    meth = np.asarray(meth)
+    unmeth = np.asarray(unmeth)
+    red_meth = np.asarray(red_meth, dtype=bool)
+    red_unmeth = np.asarray(red_unmeth, dtype=bool)
+    if meth.shape != unmeth.shape or meth.ndim != 2:
+        raise ValueError(f"meth and unmeth must be (samples x probes) arrays of the same shape; got {meth.shape} and {unmeth.shape}")
+    if len(bg_green) != meth.shape[0] or len(bg_red) != meth.shape[0]:
+        raise ValueError("bg_green and bg_red need one row of background intensities per sample")
+    if out is None:
+        out = np.empty(meth.shape, dtype='float64')
+    # each intensity is only looked up in its own channel's background
+    columns = [(values, np.flatnonzero(red), np.flatnonzero(~red)) for values, red in ((meth, red_meth), (unmeth, red_unmeth))]
+    p_meth, p_unmeth = np.empty(meth.shape[1]), np.empty(meth.shape[1])
+    for i in range(meth.shape[0]):
+        funcG = _ecdf(bg_green[i])
+        funcR = _ecdf(bg_red[i])
+        for (values, red, green), p in zip(columns, (p_meth, p_unmeth)):
+            p[red] = _ecdf_eval(funcR, values[i, red])
+            p[green] = _ecdf_eval(funcG, values[i, green])
+        np.maximum(p_meth, p_unmeth, out=out[i])
+        np.subtract(1, out[i], out=out[i])
+    return out
+
+
+def detect_probes(data_containers, method='sesame', manifest=None, chunk_size=100):
+    """
 About:
-    a wrapper for the p-value probe detection methods. Tries to check inputs and rationalize them
-    with methyl-suite's standard data objects.
+    a wrapper for the p-value probe detection methods, for many samples at once. Stacks every sample's
+    intensities into (samples x probes) numpy matrices and computes all p-values with broadcasting,
+    `chunk_size` samples at a time, so memory stays bounded for cohorts of thousands of samples.
 
 Inputs:
-    a list of sample data_containers. The dataframe must have a 'IlMnID' for the index of probe names.
-    And probe names should be `cgxxxxxx` format to work with other methylcheck functions
-
-    To create this, use:
+    a list of sample data_containers. Each container's data frame must be indexed by IlmnID and include
+    uncorrected 'meth' and 'unmeth' columns. To create these, use:
 
-    data_containers = methylprep.run_pipeline(data_dir,
-            save_uncorrected=True,
-            betas=True)
-    (if there are more than 200 samples, you'll need to load the data from disk instead, as nothing will be returned)
+    data_containers = methylprep.run_pipeline(data_dir, save_uncorrected=True)
 
     method:
-        sesame -- use the sesame ported algorithm
-        minfi -- use the minfi ported algorithm
-
-Checks:
-    data_containers must have 'meth' and 'unmeth' columns (uncorrected data)
-    the values for these columns should be between 0 and 10000s
-    (beta: 0 to 1; m_value: -neg to pos+ range)
+        sesame -- pOOBAH: out-of-band (+ NEGATIVE control) background ECDF; needs containers' oobG/oobR,
+                  so run with low_memory=False.
+        minfi -- normal distribution fit to NEGATIVE controls (detectionP).
+    manifest:
+        methylprep Manifest used to find each probe's design type and color channel. Defaults to the first
+        container's manifest data, if it is still attached (low_memory=False).
+    chunk_size:
+        number of samples stacked into one matrix at a time.
 
 Returns:
-    dataframe of p-value filtered probes
-    '''
-    if not ('unmeth' in data_containers[0]._SampleDataContainer__data_frame.columns and
-            'meth' in data_containers[0]._SampleDataContainer__data_frame.columns):
-            raise ValueError("Provide a list of data_containers that includes uncorrected data (with 'meth' and 'unmeth' columns, using the 'save_uncorrected' option in run_pipeline)")
-    if method == 'minfi':
-        pval = pval_minfi(data_containers)
+    dataframe of p-values: probes (IlmnID) in rows, samples in columns.
+    Probes that are not IR, IG or II in the manifest get NaN. Channels come from the manifest, so unlike the
+    pipeline's poobah_pval, per-sample inferred channel switches are not applied here.
+    """
+    if method not in ('sesame', 'minfi'):
+        raise ValueError(f"method must be 'sesame' or 'minfi', not {method}")
+    if len(data_containers) == 0:
+        raise ValueError("Provide a list of data_containers")
+    frames = [c._SampleDataContainer__data_frame for c in data_containers]
+    if not ('unmeth' in frames[0].columns and 'meth' in frames[0].columns):
+        raise ValueError("Provide a list of data_containers that includes uncorrected data (with 'meth' and 'unmeth' columns, using the 'save_uncorrected' option in run_pipeline)")
+    if method == 'sesame' and not all(hasattr(c, 'oobG') and hasattr(c, 'oobR') for c in data_containers):
+        raise ValueError("method='sesame' needs out-of-band probes; run the pipeline with low_memory=False, or use method='minfi'")
+    if manifest is not None:
+        man = manifest.data_frame
+    elif hasattr(data_containers[0], 'man'):
+        man = data_containers[0].man
     else:
-        pval = pval_sesame(data_containers)
-
-    if silent == False and type(mean_beta_compare) is types.FunctionType:
-        # plot it
-        # df1 and df2 are probe X sample_id matrices
-        mean_beta_compare(df1, df2, save=save, verbose=False, silent=silent)
-    return pval
-
-
-def _pval_minfi(data_containers):
-    # negative control p-value
-    # Pull M and U values
-    meth = pd.DataFrame(data_containers[0]._SampleDataContainer__data_frame.index)
-    unmeth = pd.DataFrame(data_containers[0]._SampleDataContainer__data_frame.index)
-
-    for i,c in enumerate(data_containers):
-        sample = data_containers[i].sample
-        m = c._SampleDataContainer__data_frame.rename(columns={'meth':sample})
-        u = c._SampleDataContainer__data_frame.rename(columns={'unmeth':sample})
-        meth = pd.merge(left=meth,right=m[sample],left_on='IlmnID',right_on='IlmnID',)
-        unmeth = pd.merge(left=unmeth,right=u[sample],left_on='IlmnID',right_on='IlmnID')
-
-    # Create empty dataframes for red and green negative controls
-    negctlsR = pd.DataFrame(data_containers[0].ctrl_red['Extended_Type'])
-    negctlsG = pd.DataFrame(data_containers[0].ctrl_green['Extended_Type'])
-
-    # Fill red and green dataframes
-    for i,c in enumerate(data_containers):
-        sample = str(data_containers[i].sample)
-        dfR = c.ctrl_red
-        dfR = dfR[dfR['Control_Type']=='NEGATIVE']
-        dfR = dfR[['Extended_Type','mean_value']].rename(columns={'mean_value':sample})
-        dfG = c.ctrl_green
-        dfG = dfG[dfG['Control_Type']=='NEGATIVE']
-        dfG = dfG[['Extended_Type','mean_value']].rename(columns={'mean_value':sample})
-        negctlsR = pd.merge(left=negctlsR,right=dfR,on='Extended_Type')
-        negctlsG = pd.merge(left=negctlsG,right=dfG,on='Extended_Type')
-
-    # Reset index on dataframes
-    negctlsG = negctlsG.set_index('Extended_Type')
-    negctlsR = negctlsR.set_index('Extended_Type')
-
-    # Get M and U values for IG, IR and II
-
-    # first pull out sections of manifest (will be used to identify which probes belong to each IG, IR, II)
-    manifest = data_containers[0].manifest.data_frame[['Infinium_Design_Type','Color_Channel']]
-    IG = manifest[(manifest['Color_Channel']=='Grn') & (manifest['Infinium_Design_Type']=='I')]
-    IR = manifest[(manifest['Color_Channel']=='Red') & (manifest['Infinium_Design_Type']=='I')]
-    II = manifest[manifest['Infinium_Design_Type']=='II']
-
-    # second merge with meth and unmeth dataframes
-    IG_meth = pd.merge(left=IG,right=meth,on='IlmnID').drop(columns=['Infinium_Design_Type','Color_Channel']).set_index('IlmnID')
-    IG_unmeth = pd.merge(left=IG,right=unmeth,on='IlmnID').drop(columns=['Infinium_Design_Type','Color_Channel']).set_index('IlmnID')
-    IR_meth = pd.merge(left=IR,right=meth,on='IlmnID').drop(columns=['Infinium_Design_Type','Color_Channel']).set_index('IlmnID')
-    IR_unmeth = pd.merge(left=IR,right=unmeth,on='IlmnID').drop(columns=['Infinium_Design_Type','Color_Channel']).set_index('IlmnID')
-    II_meth = pd.merge(left=II,right=meth,on='IlmnID').drop(columns=['Infinium_Design_Type','Color_Channel']).set_index('IlmnID')
-    II_unmeth = pd.merge(left=II,right=unmeth,on='IlmnID').drop(columns=['Infinium_Design_Type','Color_Channel']).set_index('IlmnID')
-
-    # Calcuate parameters
-    sdG = stats.median_absolute_deviation(negctlsG)
-    muG = np.median(negctlsG,axis=0)
-    sdR = stats.median_absolute_deviation(negctlsR)
-    muR = np.median(negctlsR,axis=0)
-
-    # calculate p values for type 1 Red
-    pIR = pd.DataFrame(index=IR_meth.index,
-                   data=1 - stats.norm.cdf(IR_meth+IR_unmeth,2*muR,2*sdR),
-                   columns=IR_meth.columns)
-
-    # calculate p values for type 1 Green
-    pIG = pd.DataFrame(index=IG_meth.index,
-                   data=1 - stats.norm.cdf(IG_meth+IG_unmeth,2*muG,2*sdG),
-                   columns=IG_meth.columns)
-
-    # calculat4e p values for type II
-    pII = pd.DataFrame(index=II_meth.index,
-                  data=1-stats.norm.cdf(II_meth+II_unmeth,muR+muG,sdR+sdG),
-                  columns=II_meth.columns)
-    # concat and sort
-    pval = pd.concat([pIR, pIG, pII])
-    pval = pval.sort_values(by='IlmnID')
-    return pval
-
-def _pval_sesame(data_containers):
-    # pOOHBah, called using ___ in sesame
-    # Pull M and U values
-    meth = pd.DataFrame(data_containers[0]._SampleDataContainer__data_frame.index)
-    unmeth = pd.DataFrame(data_containers[0]._SampleDataContainer__data_frame.index)
-
-    for i,c in enumerate(data_containers):
-        sample = data_containers[i].sample
-        m = c._SampleDataContainer__data_frame.rename(columns={'meth':sample})
-        u = c._SampleDataContainer__data_frame.rename(columns={'unmeth':sample})
-        meth = pd.merge(left=meth, right=m[sample], left_on='IlmnID', right_on='IlmnID',)
-        unmeth = pd.merge(left=unmeth, right=u[sample], left_on='IlmnID', right_on='IlmnID')
-
-    # Separate M and U values for IG, IR and II
-    # first pull out sections of manifest (will be used to identify which probes belong to each IG, IR, II)
-    manifest = data_containers[0].manifest.data_frame[['Infinium_Design_Type','Color_Channel']]
-    IG = manifest[(manifest['Color_Channel']=='Grn') & (manifest['Infinium_Design_Type']=='I')]
-    IR = manifest[(manifest['Color_Channel']=='Red') & (manifest['Infinium_Design_Type']=='I')]
-    II = manifest[manifest['Infinium_Design_Type']=='II']
-
-    # second merge with meth and unmeth dataframes
-    IG_meth = pd.merge(left=IG,right=meth,on='IlmnID').drop(columns=['Infinium_Design_Type','Color_Channel']).set_index('IlmnID')
-    IG_unmeth = pd.merge(left=IG,right=unmeth,on='IlmnID').drop(columns=['Infinium_Design_Type','Color_Channel']).set_index('IlmnID')
-    IR_meth = pd.merge(left=IR,right=meth,on='IlmnID').drop(columns=['Infinium_Design_Type','Color_Channel']).set_index('IlmnID')
-    IR_unmeth = pd.merge(left=IR,right=unmeth,on='IlmnID').drop(columns=['Infinium_Design_Type','Color_Channel']).set_index('IlmnID')
-    II_meth = pd.merge(left=II,right=meth,on='IlmnID').drop(columns=['Infinium_Design_Type','Color_Channel']).set_index('IlmnID')
-    II_unmeth = pd.merge(left=II,right=unmeth,on='IlmnID').drop(columns=['Infinium_Design_Type','Color_Channel']).set_index('IlmnID')
-
-    pval = pd.DataFrame(data=manifest.index, columns=['IlmnID'])
-    for i,c in enumerate(data_containers):
-        # 2021-03-22 assumed 'mean_value' for red and green MEANT meth and unmeth (OOBS), respectively.
-        funcG = ECDF(data_containers[i].oobG['unmeth'].values)
-        funcR = ECDF(data_containers[i].oobR['meth'].values)
-        sample = data_containers[i].sample
-        pIR = pd.DataFrame(index=IR_meth.index,data=1-np.maximum(funcR(IR_meth[sample]), funcR(IR_unmeth[sample])),columns=[sample])
-        pIG = pd.DataFrame(index=IG_meth.index,data=1-np.maximum(funcG(IG_meth[sample]), funcG(IG_unmeth[sample])),columns=[sample])
-        pII = pd.DataFrame(index=II_meth.index,data=1-np.maximum(funcG(II_meth[sample]), funcR(II_unmeth[sample])),columns=[sample])
-        p = pd.concat([pIR,pIG,pII]).reset_index()
-        pval = pd.merge(pval,p)
-    return pval
-"""
+        raise ValueError("Provide the manifest used to process these samples (containers were run with low_memory=True)")
+
+    probes = frames[0].index
+    design = man['Infinium_Design_Type'].reindex(probes).to_numpy()
+    color = man['Color_Channel'].reindex(probes).to_numpy()
+    is_IR = (design == 'I') & (color == 'Red')
+    is_IG = (design == 'I') & (color == 'Grn')
+    is_II = design == 'II'
+
+    pval = np.full((len(probes), len(data_containers)), np.nan)
+    for start in range(0, len(data_containers), chunk_size):
+        chunk = data_containers[start:start + chunk_size]
+        meth = _stack_columns(frames[start:start + chunk_size], 'meth', probes)
+        unmeth = _stack_columns(frames[start:start + chunk_size], 'unmeth', probes)
+        if method == 'minfi':
+            p = _pval_minfi(chunk, meth, unmeth, is_IR, is_IG, is_II)
+        else:
+            p = _pval_sesame(chunk, meth, unmeth, is_IR, is_II)
+        p[:, ~(is_IR | is_IG | is_II)] = np.nan
+        pval[:, start:start + len(chunk)] = p.T
+    return pd.DataFrame(pval, index=probes, columns=[str(c.sample) for c in data_containers])
+
+
+def _stack_columns(frames, column, probes):
+    """ one column from each sample's data frame, aligned to `probes`, as a (samples x probes) float64 matrix """
+    stacked = np.empty((len(frames), len(probes)))
+    for i, frame in enumerate(frames):
+        values = frame[column] if frame.index.equals(probes) else frame[column].reindex(probes)
+        stacked[i] = values.to_numpy(dtype='float64')
+    return stacked
+
+
+def _pval_minfi(data_containers, meth, unmeth, is_IR, is_IG, is_II):
+    """ minfi detectionP for a chunk of samples: 1 - normal CDF of total intensity (M + U), with mean and
+    scale from each sample's NEGATIVE controls. Type I probes use twice their channel's parameters;
+    type II probes use the sum of the red and green parameters. Returns (samples x probes). """
+    negG = _stack_negative_controls([c.ctrl_green for c in data_containers])
+    negR = _stack_negative_controls([c.ctrl_red for c in data_containers])
+    # (samples x 1) parameters, broadcast across probes
+    muG = np.median(negG, axis=1)[:, None]
+    muR = np.median(negR, axis=1)[:, None]
+    sdG = stats.median_abs_deviation(negG, axis=1, scale='normal')[:, None]
+    sdR = stats.median_abs_deviation(negR, axis=1, scale='normal')[:, None]
+    # per-probe weights on the red and green parameters: IR = 2*red, IG = 2*green, II = red + green
+    red_weight = np.where(is_IR, 2.0, np.where(is_II, 1.0, 0.0))
+    green_weight = np.where(is_IG, 2.0, np.where(is_II, 1.0, 0.0))
+    total = meth + unmeth
+    total -= red_weight * muR + green_weight * muG
+    total /= red_weight * sdR + green_weight * sdG
+    return 1 - special.ndtr(total, out=total)
+
+
+def _stack_negative_controls(ctrls):
+    """ NEGATIVE control intensities for each sample, aligned by Extended_Type, as a (samples x controls) matrix """
+    negative = [ctrl.loc[ctrl['Control_Type'] == 'NEGATIVE'].set_index('Extended_Type')['mean_value'] for ctrl in ctrls]
+    shared = negative[0].index
+    for neg in negative[1:]:
+        shared = shared.intersection(neg.index, sort=False)
+    return np.vstack([neg.loc[shared].to_numpy(dtype='float64') for neg in negative])
+
+
+def _pval_sesame(data_containers, meth, unmeth, is_IR, is_II):
+    """ pOOBAH for a chunk of samples, the same background as _pval_sesame_preprocess (out-of-band + NEGATIVE controls).
+    Returns (samples x probes). """
+    bg_green = [np.concatenate([c.oobG['Unmeth'].to_numpy(), c.oobG['Meth'].to_numpy(), _negative_controls(c.ctrl_green)]) for c in data_containers]
+    bg_red = [np.concatenate([c.oobR['Unmeth'].to_numpy(), c.oobR['Meth'].to_numpy(), _negative_controls(c.ctrl_red)]) for c in data_containers]
+    # IR probes are read in red; type II probes read unmeth in red and meth in green; IG probes are green.
+    return pval_ecdf_batch(meth, unmeth, is_IR, is_IR | is_II, bg_green, bg_red)
@@ -3,12 +3,17 @@ import logging
 import numpy as np
 import pandas as pd
 from ..utils.progress_bar import * # checks environment and imports tqdm appropriately.
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+import os
 from pathlib import Path
 import pickle
+import shutil
 import sys
+import time
 # App
-from ..files import Manifest, get_sample_sheet, create_sample_sheet
+from ..files import Manifest, IdatDataset, get_sample_sheet, create_sample_sheet, find_sample_sheet
+from ..files.sample_sheets import SampleSubset
 from ..models import (
     Channel,
     #MethylationDataset,
@@ -23,30 +28,55 @@ from .postprocess import (
     calculate_m_value,
     calculate_copy_number,
     consolidate_values_for_sheet,
+    consolidate_values,
     one_sample_control_snp,
     consolidate_mouse_probes,
     merge_batches,
 )
 from ..utils import ensure_directory_exists, is_file_like
-from .preprocess import preprocess_noob, _apply_sesame_quality_mask
+from ..utils.profiling import (
+    active_profiler,
+    peak_rss_mb,
+    profile_stage,
+    profiling_sample,
+    start_profiling,
+    stop_profiling,
+)
+from .preprocess import preprocess_noob_arrays, _apply_sesame_quality_mask
 from .p_value_probe_detection import _pval_sesame_preprocess, _pval_neg_ecdf
 from .infer_channel_switch import infer_type_I_probes
 from .dye_bias import nonlinear_dye_bias_correction
-from .multi_array_idat_batches import check_array_folders
+from .multi_array_idat_batches import check_array_folders, partition_by_array_type
+from .outputs import MatrixWriter, ExportWriter, ProcessedOutputs, append_outputs, merge_outputs, existing_sample_ids
+from .shards import ShardQueue, DEFAULT_SHARD_SIZE, DEFAULT_LEASE
+from .checkpoint import Checkpoint
+from .cache import StageCache
+from .results import ProcessedSample, SharedProbeIndex
+from .memory import plan_batches
+from .plan import build_plan
 
 
 __all__ = ['SampleDataContainer', 'run_pipeline', 'consolidate_values_for_sheet', 'make_pipeline']
 
 LOGGER = logging.getLogger(__name__)
 
+# SampleDataContainer parts that run_pipeline(low_memory=True) deletes once a sample is processed and exported
+_LOW_MEMORY_DROPPED = ('man', 'snp_man', 'ctl_man', 'green_idat', 'red_idat', 'data_channel',
+    'methylated', 'unmethylated', 'oobG', 'oobR', 'ibG', 'ibR')
+
 
 def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None,
                  sample_sheet_filepath=None, sample_name=None,
                  betas=False, m_value=False, make_sample_sheet=False, batch_size=None,
                  save_uncorrected=False, save_control=True, meta_data_frame=True,
-                 bit='float32', poobah=False, export_poobah=False,
+                 bit='float32', poobah=None, export_poobah=False,
                  poobah_decimals=3, poobah_sig=0.05, low_memory=True,
-                 sesame=True, quality_mask=None, pneg_ecdf=False, file_format='pickle', **kwargs):
+                 sesame=True, quality_mask=None, pneg_ecdf=False, file_format='pickle',
+                 n_jobs=None, max_memory=None, concurrent_arrays=False, # parallelism and memory
+                 results=None, stream_outputs=False, append=False, # how outputs are returned and saved
+                 checkpoint=False, cache_dir=None, cache_size='20G', # reusing earlier work
+                 shard=None, shard_lease=DEFAULT_LEASE, # multi-node runs
+                 profile=False, plan_only=False, **kwargs):
     """The main CLI processing pipeline. This does every processing step and returns a data set.
 
     Required Arguments:
@@ -65,6 +95,26 @@ def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None
         sample_name [optional, list]
             if you don't want to process all samples, you can specify individual samples as a list.
             if sample_names are specified, this will not also do batch sizes (large batches must process all samples)
+        mixed-array folders
+            if data_dir has several sample sheets (like a GEO package with GPL13534 and GPL21145 folders), their
+            samples are grouped by the array type in each Grn IDAT's header, and each array type is processed on its
+            own, with its manifest loaded once. If there is more than one, each array type's outputs are saved in
+            data_dir/{array type}/ (450k/beta_values.pkl, epic/beta_values.pkl, ...), and run_pipeline returns
+            {array type: what it returned for those samples}.
+        concurrent_arrays [default: False]
+            if True, the array types of a mixed-array folder are processed at the same time, in separate processes
+            (each with n_jobs workers); otherwise one after another.
+        shard [default: None]
+            'auto' makes this run one of any number of workers -- on one machine or on cluster nodes that share
+            data_dir -- that process data_dir's samples together. The first worker splits the samples into shards of
+            batch_size samples (16 if batch_size is not an integer); each worker claims a shard at a time with a lock
+            file in data_dir/.methylprep_shards, saves its outputs there, and moves on to the next unclaimed shard.
+            The worker that finds every shard done merges the shards' outputs into data_dir, as one run would have
+            saved them, and returns a ProcessedOutputs of them; the other workers return None. Every worker must be
+            run with the same processing options. Not with append=True or file_format='npy'.
+        shard_lease [default: 1800]
+            with shard='auto', the seconds after which a shard claimed by a worker that stopped renewing its claim
+            (every shard_lease/4 seconds, while it runs) is claimed again by another worker.
 
     Optional processing arguments:
         sesame [default: True]
@@ -78,6 +128,12 @@ def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None
             if set to any integer, samples will be processed and saved in batches no greater than
             the specified batch size. This will yield multiple output files in the format of
             "beta_values_1.pkl ... beta_values_N.pkl".
+            'auto' chooses the batch size -- and the number of workers, unless n_jobs is set -- from the array type
+            and the memory available to this process (including container / cgroup limits), to stay under max_memory.
+            If all samples fit, there is one batch, as with batch_size=None; otherwise the chosen size works like
+            that integer (including the >=200 rule for returned data below). The choice is logged.
+        max_memory [default: 80% of available memory]
+            with batch_size='auto', the most memory (bytes, or a string like '16G') the run should use.
         bit [default: float32]
             You can change the processed output files to one of: {float16, float32, float64}.
             This will make files & memory usage smaller, often with no loss in precision.
@@ -86,6 +142,11 @@ def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None
             If False, pipeline will not remove intermediate objects and data sets during processing.
             This provides access to probe subsets, foreground, and background probe sets in the
             SampleDataContainer object returned when this is run in a notebook (not CLI).
+        n_jobs [default: None, which is 1 unless batch_size='auto' chooses]
+            Number of worker processes that process samples in parallel (-1 uses every CPU).
+            Each worker receives the manifest once; samples come back in sample sheet order, so all outputs
+            are the same as with n_jobs=1. If samples fail, the others in the batch still finish, then a
+            RuntimeError lists every failed sample and its error.
         quality_mask [default: None]
             If False, process will NOT remove sesame's list of unreliable probes.
             If True, removes probes.
@@ -96,10 +157,43 @@ def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None
             if True, saves a file, "sample_sheet_meta_data.pkl" with samplesheet info.
         export [default: False]
             if True, exports a CSV of the processed data for each idat file in sample.
-        file_format [default: pickle; optional: parquet]
+        file_format [default: pickle; optional: parquet, npy]
             Matrix style files are faster to load and process than CSVs, and python supports two
             types of binary formats: pickle and parquet. Parquet is readable by other languages,
             so it is an option starting v1.7.0.
+            'npy' (requires stream_outputs) keeps each matrix as the memory-mapped numpy file it was written to,
+            with probe and sample names in {name}.index.json; load it with methylprep.processing.load_matrix.
+        append [default: False]
+            if True, samples that already have a column in every matrix output in data_dir (beta_values.pkl,
+            noob_meth_values.pkl, poobah_values.pkl, ...; whichever this run saves) are skipped. Only the new samples
+            are processed, and their outputs are added to the existing files: new sample columns in each matrix, new
+            samples in control_probes, mouse_probes and sample_sheet_meta_data. Outputs are saved in
+            data_dir/.methylprep_append first, and each existing file is only replaced once all are combined.
+            Returned containers or frames only include the new samples.
+        checkpoint [default: False]
+            if True, each sample's processing result is saved in data_dir/.methylprep_checkpoint as soon as the
+            sample finishes. If the run is interrupted, running it again with checkpoint=True reuses every
+            saved sample whose IDATs (sha256) and processing parameters are unchanged, and only processes the rest.
+            The checkpoint is removed once all outputs are saved.
+        stream_outputs [default: False]
+            if True, each matrix output (beta_values, noob_meth_values, poobah_values, ...) is a memory-mapped
+            probes x samples file, sized for every sample in the sample sheet, and each sample's column is written
+            as soon as that sample is processed. Containers are not kept for the batch, so memory use does not grow
+            with the number of samples, and batches are never saved in parts or merged: there is one file per output.
+        cache_dir [default: None]
+            a folder for an on-disk cache of each sample's intermediate results, shared by every run that uses it.
+            Samples are cached after processing (NOOB and dye-bias corrected), and their poobah / pNegECDF
+            p-values after infer_channel_switch, keyed by the sha256 of the IDATs, the manifest and the settings of
+            those stages. A run that changes only the estimator, exports or file_format reuses each processed
+            sample; one that changes poobah_sig or the NOOB / dye-bias steps still reuses the p-values.
+        cache_size [default: '20G']
+            the cache_dir size budget; after each batch, the least recently used entries are deleted to stay under it.
+        profile [default: False]
+            if True, records the wall time, CPU time and peak memory of each processing stage (reading IDATs, noob,
+            poobah, dye bias, consolidating and saving outputs, ...) for each sample, including those processed
+            by n_jobs workers, and saves a report as data_dir/methylprep_profile.json (per-stage totals and
+            percentiles, per-sample totals, every record) and methylprep_profile.csv (every record).
+            A path saves the report there instead. Each batch logs a one-line timing summary either way.
         save_uncorrected [default: False]
             if True, adds two additional columns to the processed.csv per sample (meth and unmeth),
             representing the raw fluorescence intensities for all probes.
@@ -108,10 +202,12 @@ def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None
             if True, adds all Control and SnpI type probe values to a separate pickled dataframe,
             with probes in rows and sample_name in the first column.
             These non-CpG probe names are excluded from processed data and must be stored separately.
-        poobah [default: False]
-            If specified as True, the pipeline will run Sesame's p-value probe detection method (poobah)
+        poobah [default: None, which is True with sesame=True and False otherwise]
+            If True, the pipeline will run Sesame's p-value probe detection method (poobah)
             on samples to remove probes that fail the signal/noise ratio on their fluorescence channels.
-            These will appear as NaNs in the resulting dataframes (beta_values.pkl or m_values.pkl).
+            These will appear as NaNs in the resulting dataframes (beta_values.pkl or m_values.pkl), and are left
+            out of the NOOB background. If False, no probes are filtered; p-values are still calculated (but not
+            used) if export_poobah saves them.
             All probes, regardless of p-value cutoff, will be retained in CSVs, but there will be a 'poobah_pval'
             column in CSV files that methylcheck.load uses to exclude failed probes upon import at a later step.
         poobah_sig [default: 0.05]
@@ -134,6 +230,18 @@ def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None
             processed CSV output.
 
     Returns:
+        results [default: None; optional: 'files', 'samples']
+            'files' never keeps SampleDataContainers: each batch's containers are dropped once its outputs are
+            written, and a ProcessedOutputs mapping is returned instead, with lazily loaded outputs
+            (outputs['beta_values'] reads beta_values.pkl) and their file paths (outputs.paths).
+            The CLI uses this mode.
+            'samples' returns a list of ProcessedSample objects instead of SampleDataContainers: each holds only
+            the sample's final per-probe arrays and its Sample, with one probe index shared by all samples;
+            .data_frame builds the DataFrame on demand. Each container is converted as soon as it is processed.
+        plan_only [default: False]
+            if True, returns the PipelinePlan of this run -- the stages, per-sample columns and outputs that it would
+            compute, and what it would return -- without reading any samples. make_pipeline(..., plan_only=True) too.
+
         By default, if called as a function, a list of SampleDataContainer objects is returned, with the following execptions:
 
         betas
@@ -161,6 +269,7 @@ def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None
         """
     #local_vars = list(locals().items())
     #print([(key,val) for key,val in local_vars])
+    run_args = dict(locals()) # each array type of a mixed-array folder is processed with these arguments
     # support for the make_pipeline wrapper function here; a more structured way to pass in args like sklearn.
     # unexposed flags all start with 'do_': (None will retain default settings)
     do_infer_channel_switch = None # defaults to sesame(True)
@@ -168,7 +277,7 @@ def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None
     do_nonlinear_dye_bias = True # defaults to sesame(True), but can be False (linear) or None (omit step)
     do_save_noob = None
     do_mouse = True
-    hidden_kwargs = ['pipeline_steps', 'pipeline_exports', 'debug']
+    hidden_kwargs = ['pipeline_steps', 'pipeline_exports', 'debug', 'sample_sheet', 'manifest']
     if kwargs != {}:
         for kwarg in kwargs:
             if kwarg not in hidden_kwargs:
@@ -176,8 +285,8 @@ def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None
                     raise SystemExit(f"One of your parameters ({kwarg}) was not recognized. Did you misspell it?")
                 else:
                     raise KeyError(f"One of your parameters ({kwarg}) was not recognized. Did you misspell it?")
-    if sesame == True:
-        poobah = True # if sesame is True and poobah is False, it hangs forever.
+    if poobah is None:
+        poobah = (sesame == True) # sesame's pipeline filters failed probes; an explicit poobah=False is kept
     if sesame == False and 'pipeline_steps' not in kwargs:
         do_nonlinear_dye_bias = False # FORCE minfi to do linear
 
@@ -227,26 +336,67 @@ def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None
         except AttributeError():
             LOGGER.error("parquet is not installed in your environment; reverting to pickle format")
             file_format = 'pickle'
-    suffix = 'parquet' if file_format == 'parquet' else 'pkl'
 
     LOGGER.info('Running pipeline in: %s', data_dir)
     if bit not in ('float64','float32','float16'):
         raise ValueError("Input 'bit' must be one of ('float64','float32','float16') or ommitted.")
+    workers = _resolve_n_jobs(n_jobs)
+    if results not in (None, 'files', 'samples'):
+        raise ValueError(f"results must be None (return containers or a DataFrame), 'files' or 'samples'; you said {results}")
+    if file_format == 'npy' and not stream_outputs:
+        raise ValueError("file_format='npy' saves the memory-mapped outputs of stream_outputs=True; set stream_outputs=True or use pickle/parquet")
+    table_format = 'parquet' if file_format == 'parquet' else 'pickle' # for outputs that are not matrices
+    if shard not in (None, 'auto'):
+        raise ValueError(f"shard must be None or 'auto'; you said {shard}")
+    if shard and (append or file_format == 'npy'):
+        raise ValueError("shard='auto' can't be combined with append=True or file_format='npy'")
     if sample_name:
         LOGGER.info('Sample names: {0}'.format(sample_name))
 
-    if make_sample_sheet:
-        create_sample_sheet(data_dir)
-    try:
-        sample_sheet = get_sample_sheet(data_dir, filepath=sample_sheet_filepath)
-    except Exception as e:
-        # e will be 'Too many sample sheets in this directory.'
-        instructions = check_array_folders(data_dir, verbose=True) # prints instructions for GEO multi-array data packages.
-        if instructions != []:
-            instructions = '\n'.join(instructions)
-            print(f"This folder contains idats for multiple types of arrays. Run each array separately:\n{instructions}")
-            sys.exit(0)
-        raise Exception(e)
+    matrix_outputs = _matrix_outputs(betas=betas, m_value=m_value, save_noob=(do_save_noob is not False),
+        save_uncorrected=save_uncorrected, export_poobah=export_poobah, poobah=poobah)
+    uint16_outputs = [file_stem for file_stem, _, uint16 in matrix_outputs.values() if uint16]
+
+    # only the stages, columns and outputs that something saves or returns are computed
+    if results == 'files':
+        returns = 'files'
+    elif isinstance(batch_size, int) and batch_size >= 200:
+        returns = None
+    else:
+        returns = 'beta_values' if betas else 'm_values' if m_value else results or 'containers'
+    plan = build_plan(matrix_outputs,
+        switch_probes=bool(do_infer_channel_switch or sesame),
+        poobah=poobah,
+        pneg_ecdf=pneg_ecdf,
+        quality_mask=bool(quality_mask or sesame),
+        do_noob=(do_noob if do_noob != None else True),
+        dye_bias=do_nonlinear_dye_bias,
+        export=export,
+        export_poobah=export_poobah,
+        save_control=save_control,
+        meta_data_frame=meta_data_frame,
+        do_mouse=do_mouse,
+        returns=returns,
+        poobah_step=('pipeline_steps' not in kwargs or poobah),
+    )
+    if plan_only:
+        return plan
+    LOGGER.debug(plan)
+
+    sample_sheet = kwargs.get('sample_sheet') # a SampleSubset: one array type of a mixed-array folder, or a shard
+    if sample_sheet is None:
+        sample_sheet, partitions = _read_sample_sheet(data_dir, sample_sheet_filepath, make_sample_sheet)
+        if partitions:
+            return _run_array_partitions(data_dir, partitions, run_args, concurrent=concurrent_arrays)
+    if shard:
+        return _run_shard_worker(data_dir, sample_sheet, run_args, uint16_outputs)
+
+    # append: samples already in the saved outputs are skipped, and this run's outputs are staged until combined with them.
+    output_dir, appended = _start_append(data_dir, matrix_outputs, file_format) if append else (data_dir, set())
+
+    stop_profiling() # a run that raised may have left one behind
+    profiler = start_profiling() if profile else None
+    run_started = time.perf_counter()
 
     samples = sample_sheet.get_samples()
     if sample_sheet.renamed_fields != {}:
@@ -267,227 +417,467 @@ def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None
             unmatched_samples = [_sample for _sample in sample_name if _sample not in possible_sample_names]
             raise SystemExit(f"Your sample_name filter does not match the samplesheet; these samples were not found: {unmatched_samples}")
 
-    batches = []
-    batch = []
-    sample_id_counter = 1
-    if batch_size:
-        if type(batch_size) != int or batch_size < 1:
-            raise ValueError('batch_size must be an integer greater than 0')
-        for sample in samples:
-            if sample_name and sample.name not in sample_name:
-                continue
+    if batch_size == 'auto':
+        run_samples = [sample for sample in samples if not (sample_name and sample.name not in sample_name)
+            and f"{sample.sentrix_id}_{sample.sentrix_position}" not in appended]
+        if run_samples:
+            n_probes = _array_probe_count(run_samples[0], array_type)
+            batch_size, workers = plan_batches(len(run_samples), n_probes, max_memory=max_memory,
+                n_jobs=(None if n_jobs is None else workers), n_outputs=len(matrix_outputs))
+        else:
+            batch_size = None
+    if batch_size and (type(batch_size) != int or batch_size < 1):
+        raise ValueError('batch_size must be an integer greater than 0')
+    batches = _make_batches(samples, sample_name, batch_size, skip=appended)
+    if append and not any(batches):
+        LOGGER.info(f"append: all {len(appended)} samples in the saved outputs are up to date; nothing to process.")
+        shutil.rmtree(output_dir, ignore_errors=True)
+        if results == 'files':
+            return _saved_outputs(data_dir, matrix_outputs, file_format)
+        return
 
-            # batch uses Sample_Name, so ensure these exist
-            if sample.name in (None,''):
-                sample.name = f'Sample_{sample_id_counter}'
-                sample_id_counter += 1
-            # and are unique.
-            if Counter((s.name for s in samples)).get(sample.name) > 1:
-                sample.name = f'{sample.name}_{sample_id_counter}'
-                sample_id_counter += 1
-
-            if len(batch) < batch_size:
-                batch.append(sample.name)
-            else:
-                batches.append(batch)
-                batch = []
-                batch.append(sample.name)
-        batches.append(batch)
-    else:
-        for sample in samples:
-            if sample_name and sample.name not in sample_name:
-                continue
+    container_kwargs = dict(
+        retain_uncorrected_probe_intensities=save_uncorrected,
+        bit=bit,
+        switch_probes=(do_infer_channel_switch or sesame), # this applies all sesame-specific options
+        quality_mask= (quality_mask or sesame or False), # this applies all sesame-specific options (beta / noob offsets too)
+        do_noob=(do_noob if do_noob != None else True), # None becomes True, but make_pipeline can override with False
+        pval=('poobah' in plan.stages), # to filter probes, or to export the p-values
+        poobah_noob=poobah, # failed probes are left out of the NOOB background only if they are filtered
+        poobah_decimals=poobah_decimals,
+        poobah_sig=poobah_sig,
+        do_nonlinear_dye_bias=do_nonlinear_dye_bias, # start of run_pipeline sets this to True, False, or None
+        debug=kwargs.get('debug',False),
+        sesame=sesame,
+        pneg_ecdf=('pneg_ecdf' in plan.stages),
+        file_format=file_format,
+        value_columns=plan.columns,
+    )
+    cache = StageCache(cache_dir, cache_size) if cache_dir else None
+    sample_kwargs = dict(container_kwargs=container_kwargs, export=export, file_format=file_format,
+        save_control=save_control, low_memory=low_memory, cache=cache)
+    journal = None
+    if checkpoint:
+        journal = Checkpoint(data_dir, dict(container_kwargs, array_type=array_type, manifest_filepath=manifest_filepath,
+            export=export, save_control=save_control, low_memory=low_memory))
+    stream_ids = None
+    if stream_outputs: # the matrices are sized for every sample of the run
+        run_samples = {name for batch in batches for name in batch}
+        stream_ids = [f"{sample.sentrix_id}_{sample.sentrix_position}" for sample in samples if sample.name in run_samples]
+
+    # large batches only save files, and results='files' returns handles to them; otherwise the returned
+    # containers (or beta/m_value frames) are kept in memory as batches finish.
+    keep = None
+    if results != 'files' and not (batch_size and batch_size >= 200):
+        keep = 'beta_value' if betas else 'm_value' if m_value else 'containers'
+    # v1.7.2: no more _temp_data_{batch}.pkl pickles of every container; outputs go to disk as each batch finishes.
+    outputs, control_snps, kept = _run_batches(batches, sample_sheet, sample_kwargs, matrix_outputs, output_dir,
+        array_type=array_type, manifest_filepath=manifest_filepath, manifest=kwargs.get('manifest'), workers=workers,
+        journal=journal, keep=keep, results=results, numbered=bool(batch_size), stream_ids=stream_ids,
+        do_mouse=do_mouse, profiler=profiler)
 
-            # batch uses Sample_Name, so ensure these exist
-            if sample.name in (None,''):
-                sample.name = f'Sample_{sample_id_counter}'
-                sample_id_counter += 1
-            # and are unique.
-            if Counter((s.name for s in samples)).get(sample.name) > 1:
-                sample.name = f'{sample.name}_{sample_id_counter}'
-                sample_id_counter += 1
+    if meta_data_frame == True:
+        outputs.add('sample_sheet_meta_data', _save_meta_data(sample_sheet, samples, output_dir, file_format), table_format)
+    # FIXED in v1.3.0
+    if save_control:
+        outputs.add('control_probes', _save_control_probes(control_snps, output_dir, file_format), table_format)
+    # batch processing done; consolidate and return data. This uses much more memory, but not called if in batch mode.
+    if batch_size and batch_size < 200 and not stream_outputs:
+        _merge_batch_parts(outputs, len(batches), output_dir, file_format)
+    if append:
+        outputs = append_outputs(outputs, data_dir, uint16=uint16_outputs)
+        LOGGER.info(f"appended {sum(len(batch) for batch in batches)} samples to the outputs in {data_dir}")
+    if journal: # every output is saved
+        journal.clear()
+    if profiler:
+        stop_profiling()
+        report_path = Path(data_dir, 'methylprep_profile') if profile is True else Path(profile)
+        json_path, csv_path = profiler.write_report(report_path)
+        LOGGER.info(f"Processed {sum(len(batch) for batch in batches)} samples in {time.perf_counter() - run_started:.1f}s; profile saved to {json_path} and {csv_path}")
+    if batch_size and batch_size >= 200 and results != 'files':
+        LOGGER.warning("Because the batch size was >=200 samples, files are saved but no data objects are returned.")
+        return
 
-            batch.append(sample.name)
-        batches.append(batch)
+    if results == 'files':
+        return outputs
+    if betas or m_value:
+        return pd.concat(kept, axis=1) if len(kept) > 1 else kept[0]
+    return kept
 
-    temp_data_pickles = []
+
+def _matrix_outputs(betas=False, m_value=False, save_noob=True, save_uncorrected=False, export_poobah=False, poobah=True):
+    """ {data frame column: (output file stem, apply poobah filter, uint16 file)} for the matrix files that run_pipeline
+    saves. The p-value outputs are only saved if every sample has them; see _available_matrix_outputs. """
+    matrix_outputs = {}
+    if betas:
+        matrix_outputs['beta_value'] = ('beta_values', poobah, False)
+    if m_value:
+        matrix_outputs['m_value'] = ('m_values', poobah, False)
+    if save_noob or betas or m_value:
+        matrix_outputs['noob_meth'] = ('noob_meth_values', poobah, True)
+        matrix_outputs['noob_unmeth'] = ('noob_unmeth_values', poobah, True)
+    if save_uncorrected:
+        matrix_outputs['meth'] = ('meth_values', False, True)
+        matrix_outputs['unmeth'] = ('unmeth_values', False, True)
+    if export_poobah:
+        # this option will save pvalues for all samples, with sample_ids in the column headings and probe names in index.
+        matrix_outputs['poobah_pval'] = ('poobah_values', False, False)
+        # negative control based pvalues for all samples, with sample_ids in the column headings and probe names in index.
+        matrix_outputs['pNegECDF_pval'] = ('pNegECDF_values', False, False)
+    return matrix_outputs
+
+
+def _available_matrix_outputs(matrix_outputs, containers):
+    """ matrix_outputs without the p-value outputs that some of these processed samples do not have """
+    return {column: output for column, output in matrix_outputs.items()
+        if column not in ('poobah_pval', 'pNegECDF_pval') or all(column in container.data_frame.columns for container in containers)}
+
+
+def _read_sample_sheet(data_dir, sample_sheet_filepath=None, make_sample_sheet=False):
+    """ returns (data_dir's sample sheet, None), or (None, the ArrayPartitions of its samples) for a folder with several
+    sample sheets, like a GEO package with one folder per array type; see partition_by_array_type. """
+    if make_sample_sheet:
+        create_sample_sheet(data_dir)
+    try:
+        return get_sample_sheet(data_dir, filepath=sample_sheet_filepath), None
+    except Exception as e:
+        # e will be 'Too many sample sheets in this directory.', as in GEO multi-array data packages.
+        try:
+            sample_sheet_filepaths = find_sample_sheet(data_dir, return_all=True)
+        except FileNotFoundError:
+            sample_sheet_filepaths = None
+        if not isinstance(sample_sheet_filepaths, list) or len(sample_sheet_filepaths) < 2:
+            check_array_folders(data_dir, verbose=True) # creates a sample sheet if there is none
+            raise Exception(e)
+        return None, partition_by_array_type(data_dir, sample_sheet_filepaths)
+
+
+def _start_append(data_dir, matrix_outputs, file_format):
+    """ run_pipeline(append=True): returns (an empty staging folder for this run's outputs, the sample ids already in
+    data_dir's matrix outputs) """
+    appended = existing_sample_ids(data_dir, [file_stem for file_stem, _, _ in matrix_outputs.values()], file_format) or set()
+    if not appended:
+        LOGGER.warning(f"append: found no {file_format} outputs to add samples to in {data_dir}; processing all samples.")
+    output_dir = Path(data_dir, '.methylprep_append')
+    if output_dir.exists():
+        shutil.rmtree(output_dir) # left by an interrupted append; these were never combined
+    output_dir.mkdir()
+    return output_dir, appended
+
+
+def _saved_outputs(data_dir, matrix_outputs, file_format):
+    """ a ProcessedOutputs of the matrix outputs already saved in data_dir """
+    suffix = {'parquet': 'parquet', 'npy': 'npy'}.get(file_format, 'pkl')
+    saved = ProcessedOutputs()
+    for file_stem, _, _ in matrix_outputs.values():
+        path = Path(data_dir, f"{file_stem}.{suffix}")
+        if path.exists():
+            saved.add(file_stem, path, file_format)
+    return saved
+
+
+def _make_batches(samples, sample_name=None, batch_size=None, skip=()):
+    """ splits the names of the samples to process -- those in sample_name (or all), except the sentrix ids in skip --
+    into lists of batch_size names, or one list without a batch_size. Samples without a unique name are given one. """
+    batches = []
+    batch = []
+    sample_id_counter = 1
+    for sample in samples:
+        if sample_name and sample.name not in sample_name:
+            continue
+        if f"{sample.sentrix_id}_{sample.sentrix_position}" in skip:
+            continue
+
+        # batch uses Sample_Name, so ensure these exist
+        if sample.name in (None,''):
+            sample.name = f'Sample_{sample_id_counter}'
+            sample_id_counter += 1
+        # and are unique.
+        if Counter((s.name for s in samples)).get(sample.name) > 1:
+            sample.name = f'{sample.name}_{sample_id_counter}'
+            sample_id_counter += 1
+
+        if batch_size and len(batch) == batch_size:
+            batches.append(batch)
+            batch = []
+        batch.append(sample.name)
+    batches.append(batch)
+    return batches
+
+
+def _run_batches(batches, sample_sheet, sample_kwargs, matrix_outputs, output_dir, array_type=None,
+                 manifest_filepath=None, manifest=None, workers=1, journal=None, keep=None, results=None,
+                 numbered=False, stream_ids=None, do_mouse=True, profiler=None):
+    """ run_pipeline's batch loop: processes each batch of sample names (see _make_batches) and saves its matrix
+    outputs and mouse probes in output_dir.
+
+    - manifest: loaded with the first batch if None, from manifest_filepath or for the array type of its IDATs.
+    - keep: what is returned of the processed samples: 'containers', the 'beta_value' or 'm_value' frames, or None.
+    - numbered: each batch's files are saved as {file_stem}_{batch number} parts, which run_pipeline merges.
+    - stream_ids: with stream_outputs, every sample id of the run. Each sample is written to the matrix outputs as soon
+      as it is processed, and they are saved once every batch is done.
+    On any error (or Ctrl-C), exports stop and the partial stream_outputs matrices are deleted.
+    Returns (a ProcessedOutputs of the saved files, {sample id: control probes}, the kept containers or frames)."""
+    export = sample_kwargs['export']
+    file_format = sample_kwargs['file_format']
+    container_kwargs = sample_kwargs['container_kwargs']
+    bit = container_kwargs['bit']
+    suffix = 'parquet' if file_format == 'parquet' else 'pkl'
+    outputs = ProcessedOutputs()
     control_snps = {}
-    #data_containers = [] # returned when this runs in interpreter, and < 200 samples
-    # v1.3.0 memory fix: save each batch_data_containers object to disk as temp, then load and combine at end.
-    # 200 samples still uses 4.8GB of memory/disk space (float64)
+    kept = []
+    shared_probes = SharedProbeIndex() # results='samples': one probe index for every sample
     missing_probe_errors = {'noob': [], 'raw':[]}
-
-    for batch_num, batch in enumerate(batches, 1):
-        idat_datasets = parse_sample_sheet_into_idat_datasets(sample_sheet, sample_name=batch, from_s3=None, meta_only=False, bit=bit) # replaces get_raw_datasets
-        # idat_datasets are a list; each item is a dict of {'green_idat': ..., 'red_idat':..., 'array_type', 'sample'} to feed into SigSet
-        #--- pre v1.5 --- raw_datasets = get_raw_datasets(sample_sheet, sample_name=batch)
-        if array_type is None: # use must provide either the array_type or manifest_filepath.
-            array_type = get_array_type(idat_datasets)
-        manifest = Manifest(array_type, manifest_filepath) # this allows each batch to be a different array type; but not implemented yet. common with older GEO sets.
-
-        batch_data_containers = []
-        export_paths = set() # inform CLI user where to look
-        for idat_dataset_pair in tqdm(idat_datasets, total=len(idat_datasets), desc="Processing samples"):
-            data_container = SampleDataContainer(
-                idat_dataset_pair=idat_dataset_pair,
-                manifest=manifest,
-                retain_uncorrected_probe_intensities=save_uncorrected,
-                bit=bit,
-                switch_probes=(do_infer_channel_switch or sesame), # this applies all sesame-specific options
-                quality_mask= (quality_mask or sesame or False), # this applies all sesame-specific options (beta / noob offsets too)
-                do_noob=(do_noob if do_noob != None else True), # None becomes True, but make_pipeline can override with False
-                pval=poobah, #defaults to False as of v1.4.0
-                poobah_decimals=poobah_decimals,
-                poobah_sig=poobah_sig,
-                do_nonlinear_dye_bias=do_nonlinear_dye_bias, # start of run_pipeline sets this to True, False, or None
-                debug=kwargs.get('debug',False),
-                sesame=sesame,
-                pneg_ecdf=pneg_ecdf,
-                file_format=file_format,
-            )
-            data_container.process_all()
-
-            if export: # as CSV or parquet
-                suffix = 'parquet' if file_format == 'parquet' else 'csv'
-                output_path = data_container.sample.get_export_filepath(extension=suffix)
-                data_container.export(output_path)
-                export_paths.add(output_path)
-                # this tidies-up the tqdm by moving errors to end of batch warning.
-                if data_container.noob_processing_missing_probe_errors != []:
-                    missing_probe_errors['noob'].extend(data_container.noob_processing_missing_probe_errors)
-                if data_container.raw_processing_missing_probe_errors != []:
-                    missing_probe_errors['raw'].extend(data_container.raw_processing_missing_probe_errors)
-
-            if save_control: # Process and consolidate now. Keep in memory. These files are small.
+    # export: each sample's file is saved in background threads while the next sample is processed (n_jobs workers
+    # save their own samples' files)
+    export_writer = ExportWriter() if export else None
+    stream = None
+    if stream_ids is not None:
+        stream = _StreamWriters(output_dir, stream_ids, matrix_outputs, bit, container_kwargs['poobah_sig'])
+    try:
+        for batch_num, batch in enumerate(batches, 1):
+            batch_started = time.perf_counter()
+            if profiler:
+                profiler.batch = batch_num
+            resumed, idat_datasets = _read_batch(batch, sample_sheet, bit, journal)
+            if manifest is None: # loaded once: mixed-array folders are split by array type before this
+                if array_type is None: # use must provide either the array_type or manifest_filepath.
+                    array_type = get_array_type(idat_datasets) if idat_datasets else ArrayType(journal.array_type(sample_sheet.get_sample(batch[0])))
+                with profile_stage('manifest'):
+                    manifest = Manifest(array_type, manifest_filepath)
+
+            batch_data_containers = []
+            export_paths = set() # inform CLI user where to look
+            for data_container, output_path, control_df in _batch_results(batch, resumed, idat_datasets, manifest,
+                workers, sample_kwargs, export_writer, journal):
+                if export: # as CSV or parquet
+                    export_paths.add(output_path)
+                    # this tidies-up the tqdm by moving errors to end of batch warning.
+                    if data_container.noob_processing_missing_probe_errors != []:
+                        missing_probe_errors['noob'].extend(data_container.noob_processing_missing_probe_errors)
+                    if data_container.raw_processing_missing_probe_errors != []:
+                        missing_probe_errors['raw'].extend(data_container.raw_processing_missing_probe_errors)
+
+                if results == 'samples':
+                    data_container = ProcessedSample.from_container(data_container, shared_probes)
                 sample_id = f"{data_container.sample.sentrix_id}_{data_container.sample.sentrix_position}"
-                control_df = one_sample_control_snp(data_container)
-                control_snps[sample_id] = control_df
-
-            # now I can drop all the unneeded stuff from each SampleDataContainer (400MB per sample becomes 92MB)
-            # these are stored in SampleDataContainer.__data_frame for processing.
-            if low_memory is True:
-                # use data_frame values instead of these class objects, because they're not in sesame SigSets.
-                del data_container.man
-                del data_container.snp_man
-                del data_container.ctl_man
-                del data_container.green_idat
-                del data_container.red_idat
-                del data_container.data_channel
-                del data_container.methylated
-                del data_container.unmethylated
-                del data_container.oobG
-                del data_container.oobR
-                del data_container.ibG
-                del data_container.ibR
-            batch_data_containers.append(data_container)
-
-            #if str(data_container.sample) == '200069280091_R01C01':
-            #    print(f"200069280091_R01C01 -- cg00035864 -- meth -- {data_container._SampleDataContainer__data_frame['meth']['cg00035864']}")
-            #    print(f"200069280091_R01C01 -- cg00035864 -- unmeth -- {data_container._SampleDataContainer__data_frame['unmeth']['cg00035864']}")
-
-        if kwargs.get('debug'): LOGGER.info('[finished SampleDataContainer processing]')
-
-        def _prepare_save_out_file(df, file_stem, uint16=False):
-            out_name = f"{file_stem}_{batch_num}" if batch_size else file_stem
-            if uint16 and file_format != 'parquet':
-                df = df.astype('float32') if df.isna().sum().sum() > 0 else df.astype('uint16')
-            else:
-                df = df.astype('float32')
-            if df.shape[1] > df.shape[0]:
-                df = df.transpose() # put probes as columns for faster loading.
-            # sort sample names
-            df = df.sort_index().reindex(sorted(df.columns), axis=1)
-            if file_format == 'parquet':
-                # put probes in rows; format is optimized for same-type storage so it won't really matter
-                df.to_parquet(Path(data_dir,f"{out_name}.parquet"))
-            else:
-                df.to_pickle(Path(data_dir, f"{out_name}.pkl"))
-            LOGGER.info(f"saved {out_name}")
-
-        if betas:
-            df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='beta_value', bit=bit, poobah=poobah, exclude_rs=True)
-            _prepare_save_out_file(df, 'beta_values')
-        if m_value:
-            df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='m_value', bit=bit, poobah=poobah, exclude_rs=True)
-            _prepare_save_out_file(df, 'm_values')
-        if (do_save_noob is not False) or betas or m_value:
-            df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='noob_meth', bit=bit, poobah=poobah, exclude_rs=True)
-            _prepare_save_out_file(df, 'noob_meth_values', uint16=True)
-            df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='noob_unmeth', bit=bit, poobah=poobah, exclude_rs=True)
-            _prepare_save_out_file(df, 'noob_unmeth_values', uint16=True)
-        if save_uncorrected:
-            df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='meth', bit=bit, poobah=False, exclude_rs=True)
-            _prepare_save_out_file(df, 'meth_values', uint16=True)
-            df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='unmeth', bit=bit, poobah=False, exclude_rs=True)
-            _prepare_save_out_file(df, 'unmeth_values', uint16=True)
-
-        if manifest.array_type == ArrayType.ILLUMINA_MOUSE and do_mouse:
-            # save mouse specific probes
-            if not batch_size:
-                mouse_probe_filename = f'mouse_probes.{suffix}'
-            else:
-                mouse_probe_filename = f'mouse_probes_{batch_num}.{suffix}'
-            consolidate_mouse_probes(batch_data_containers, Path(data_dir, mouse_probe_filename), file_format)
-            LOGGER.info(f"saved {mouse_probe_filename}")
-
-        if export:
-            export_path_parents = list(set([str(Path(e).parent) for e in export_paths]))
-            LOGGER.info(f"[!] Exported results ({file_format}) to: {export_path_parents}")
-
-        if export_poobah:
-            if all(['poobah_pval' in e._SampleDataContainer__data_frame.columns for e in batch_data_containers]):
-                # this option will save pvalues for all samples, with sample_ids in the column headings and probe names in index.
-                # this sets poobah to false in kwargs, otherwise some pvalues would be NaN I think.
-                df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='poobah_pval', bit=bit, poobah=False, poobah_sig=poobah_sig, exclude_rs=True)
-                _prepare_save_out_file(df, 'poobah_values')
+                if sample_kwargs['save_control']: # Process and consolidate now. Keep in memory. These files are small.
+                    control_snps[sample_id] = control_df
+                if stream:
+                    stream.write(data_container, sample_id)
+                    # containers are only kept when they are returned, or for the mouse probes file
+                    if not (keep == 'containers' or (manifest.array_type == ArrayType.ILLUMINA_MOUSE and do_mouse)):
+                        continue
+                batch_data_containers.append(data_container)
+
+            if container_kwargs['debug']: LOGGER.info('[finished SampleDataContainer processing]')
+
+            if not stream:
+                # v1.7.2: every matrix output of the batch is built in one pass over the containers.
+                batch_outputs = _available_matrix_outputs(matrix_outputs, batch_data_containers)
+                with profile_stage('consolidate'):
+                    consolidated = consolidate_values(batch_data_containers,
+                        {column: apply_poobah for column, (_, apply_poobah, _) in batch_outputs.items()}, bit=bit,
+                        poobah_sig=container_kwargs['poobah_sig'], exclude_rs=True)
+                with profile_stage('save_outputs'):
+                    for column, (file_stem, _, uint16) in batch_outputs.items():
+                        out_name = f"{file_stem}_{batch_num}" if numbered else file_stem
+                        parts = outputs.paths.get(file_stem, []) if numbered else []
+                        outputs.add(file_stem, parts + [_save_matrix(consolidated[column], output_dir, out_name,
+                            file_format, uint16=uint16)], file_format)
+                if keep in ('beta_value', 'm_value'):
+                    kept.append(consolidated[keep])
+                del consolidated
+
+            if manifest.array_type == ArrayType.ILLUMINA_MOUSE and do_mouse:
+                # save mouse specific probes
+                mouse_probe_filename = f'mouse_probes_{batch_num}.{suffix}' if numbered else f'mouse_probes.{suffix}'
+                consolidate_mouse_probes(batch_data_containers, Path(output_dir, mouse_probe_filename), file_format)
+                LOGGER.info(f"saved {mouse_probe_filename}")
+                mouse_parts = outputs.paths.get('mouse_probes', [])
+                outputs.add('mouse_probes', mouse_parts + [Path(output_dir, mouse_probe_filename)], 'pickle') # always pickled
+
+            if export:
+                with profile_stage('export'):
+                    export_writer.wait() # raises the error of any export that failed
+                export_path_parents = list(set([str(Path(e).parent) for e in export_paths]))
+                LOGGER.info(f"[!] Exported results ({file_format}) to: {export_path_parents}")
+
+            if keep == 'containers':
+                kept.extend(batch_data_containers)
+            del batch_data_containers
+            if sample_kwargs['cache'] is not None: # once per batch: evict() reads the size of every cache entry
+                sample_kwargs['cache'].evict()
+
+            batch_seconds = time.perf_counter() - batch_started
+            LOGGER.info(f"Batch {batch_num}/{len(batches)}: {len(batch)} samples in {batch_seconds:.1f}s "
+                f"({batch_seconds / max(len(batch), 1):.2f}s per sample); peak memory {peak_rss_mb(children=True):.0f}MB")
+            if profiler:
+                LOGGER.info(f"Batch {batch_num} stages: {profiler.batch_summary(batch_num)}")
+
+        if profiler:
+            profiler.batch = None
+        if export_writer:
+            export_writer.close()
+        if stream:
+            frame = stream.finalize(outputs, file_format, keep=keep)
+            if frame is not None:
+                kept.append(frame)
+    except BaseException: # including Ctrl-C
+        if export_writer:
+            export_writer.cancel() # no sample's export is written after the run has failed
+        if stream:
+            stream.discard() # the partial matrices are sized for the whole run
+        raise
+    _log_missing_probe_errors(missing_probe_errors)
+    return outputs, control_snps, kept
+
+
+def _read_batch(batch, sample_sheet, bit, journal=None):
+    """ returns ({sample name: checkpointed result} for the batch's samples that an earlier run processed, with
+    unchanged IDATs and saved exports; the idat datasets of the others) """
+    resumed = {}
+    if journal:
+        for name in batch:
+            result = journal.load(sample_sheet.get_sample(name))
+            if result is not None and (result[1] is None or Path(result[1]).exists()): # and its export was saved
+                resumed[name] = result
+    to_process = [name for name in batch if name not in resumed]
+    if not to_process:
+        return resumed, []
+    # idat_datasets are a list; each item is a dict of {'green_idat': ..., 'red_idat':..., 'array_type', 'sample'} to feed into SigSet
+    #--- pre v1.5 --- raw_datasets = get_raw_datasets(sample_sheet, sample_name=batch)
+    return resumed, parse_sample_sheet_into_idat_datasets(sample_sheet, sample_name=to_process, from_s3=None, meta_only=False, bit=bit) # replaces get_raw_datasets
+
+
+def _batch_results(batch, resumed, idat_datasets, manifest, workers, sample_kwargs, export_writer=None, journal=None):
+    """ yields (data_container, export path, control probes) for each sample of the batch, in batch order: processed
+    here or by a pool of workers, and recorded in the checkpoint journal, or resumed from it. """
+    def _record(idat_dataset_pair, result):
+        if journal:
+            journal.record(idat_dataset_pair['sample'], result, array_type=manifest.array_type)
+        return result
+    if workers > 1 and len(idat_datasets) > 1:
+        processed = _process_samples_in_pool(idat_datasets, manifest, workers, sample_kwargs, on_result=_record)
+    else:
+        processed = (_record(idat_dataset_pair, _process_sample(idat_dataset_pair, manifest, writer=export_writer, **sample_kwargs))
+            for idat_dataset_pair in tqdm(idat_datasets, total=len(idat_datasets), desc="Processing samples"))
+    if resumed:
+        processed = _in_batch_order(batch, resumed, processed)
+    return processed
+
+
+class _StreamWriters():
+    """run_pipeline(stream_outputs=True): one memory-mapped MatrixWriter per matrix output, sized for every sample of
+    the run (sample_ids) and created with the first sample, whose probes (without snps) are the rows of every output.
+    Each sample's values are written as soon as it is processed."""
+
+    def __init__(self, output_dir, sample_ids, matrix_outputs, bit='float32', poobah_sig=0.05):
+        self.output_dir = output_dir
+        self.sample_ids = sample_ids
+        self.matrix_outputs = matrix_outputs # narrowed to the outputs the first sample has
+        self.bit = bit
+        self.poobah_sig = poobah_sig
+        self.writers = {}
+
+    def write(self, data_container, sample_id):
+        if not self.writers:
+            self.matrix_outputs = _available_matrix_outputs(self.matrix_outputs, [data_container])
+        with profile_stage('consolidate', sample_id):
+            sample_values = consolidate_values([data_container],
+                {column: apply_poobah for column, (_, apply_poobah, _) in self.matrix_outputs.items()}, bit=self.bit,
+                poobah_sig=self.poobah_sig, exclude_rs=True)
+        with profile_stage('save_outputs', sample_id):
+            if not self.writers:
+                self.writers = {column: MatrixWriter(self.output_dir, file_stem, sample_values[column].index,
+                    self.sample_ids, dtype=self.bit)
+                    for column, (file_stem, _, _) in self.matrix_outputs.items()}
+            for column, matrix_writer in self.writers.items():
+                matrix_writer.write(sample_id, sample_values[column].iloc[:, 0].to_numpy(), probes=sample_values[column].index)
+
+    def finalize(self, outputs, file_format, keep=None):
+        """ saves each output as file_format and adds it to outputs; returns the frame of the `keep` column, if any """
+        kept = None
+        for column, matrix_writer in self.writers.items():
+            if column == keep:
+                kept = matrix_writer.frame()
+            file_stem, _, uint16 = self.matrix_outputs[column]
+            with profile_stage('save_outputs'):
+                outputs.add(file_stem, matrix_writer.finalize(file_format, uint16=uint16), file_format)
+            LOGGER.info(f"saved {file_stem}")
+        return kept
+
+    def discard(self):
+        for matrix_writer in self.writers.values():
+            matrix_writer.discard()
+
+
+def _save_matrix(df, output_dir, out_name, file_format='pickle', uint16=False):
+    """ saves a batch's matrix output as output_dir/{out_name}.pkl (or .parquet); returns its path """
+    if uint16 and file_format != 'parquet':
+        df = df.astype('float32') if df.isna().sum().sum() > 0 else df.astype('uint16')
+    else:
+        df = df.astype('float32')
+    if df.shape[1] > df.shape[0]:
+        df = df.transpose() # put probes as columns for faster loading.
+    # sort sample names
+    df = df.sort_index().reindex(sorted(df.columns), axis=1)
+    if file_format == 'parquet':
+        # put probes in rows; format is optimized for same-type storage so it won't really matter
+        path = Path(output_dir, f"{out_name}.parquet")
+        df.to_parquet(path)
+    else:
+        path = Path(output_dir, f"{out_name}.pkl")
+        df.to_pickle(path)
+    LOGGER.info(f"saved {out_name}")
+    return path
 
-            if all(['pNegECDF_pval' in e._SampleDataContainer__data_frame.columns for e in batch_data_containers]):
-                # this option will save negative control based pvalues for all samples, with
-                # sample_ids in the column headings and probe names in index.
-                df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='pNegECDF_pval', bit=bit, poobah=False, poobah_sig=poobah_sig, exclude_rs=True)
-                _prepare_save_out_file(df, 'pNegECDF_values')
 
-        # v1.3.0 fixing mem problems: pickling each batch_data_containers object then reloading it later.
+def _save_meta_data(sample_sheet, samples, output_dir, file_format='pickle'):
+    meta_frame = sample_sheet.build_meta_data(samples)
+    if file_format == 'parquet':
+        meta_frame_filename = f'sample_sheet_meta_data.parquet'
+        meta_frame.to_parquet(Path(output_dir, meta_frame_filename))
+    else:
+        meta_frame_filename = f'sample_sheet_meta_data.pkl'
+        meta_frame.to_pickle(Path(output_dir, meta_frame_filename))
+    LOGGER.info(f"saved {meta_frame_filename}")
+    return Path(output_dir, meta_frame_filename)
 
-        # consolidating data_containers this will break with really large sample sets, so skip here.
-        #if batch_size and batch_size >= 200:
-        #    continue
-        #data_containers.extend(batch_data_containers)
 
-        pkl_name = f"_temp_data_{batch_num}.pkl"
-        with open(Path(data_dir,pkl_name), 'wb') as temp_data:
-            pickle.dump(batch_data_containers, temp_data)
-            temp_data_pickles.append(pkl_name)
+def _save_control_probes(control_snps, output_dir, file_format='pickle'):
+    if file_format == 'parquet':
+        control_filename = f'control_probes.parquet'
+        control = pd.concat(control_snps) # creates multiindex
+        (control.reset_index()
+            .rename(columns={'level_0': 'Sentrix_ID', 'level_1': 'IlmnID'})
+            .astype({'IlmnID':str})
+            .to_parquet(Path(output_dir, control_filename))
+        )
+    else:
+        control_filename = f'control_probes.pkl'
+        with open(Path(output_dir, control_filename), 'wb') as control_file:
+            pickle.dump(control_snps, control_file)
+    LOGGER.info(f"saved {control_filename}")
+    return Path(output_dir, control_filename)
 
-    del batch_data_containers
 
-    if meta_data_frame == True:
-        meta_frame = sample_sheet.build_meta_data(samples)
-        if file_format == 'parquet':
-            meta_frame_filename = f'sample_sheet_meta_data.parquet'
-            meta_frame.to_parquet(Path(data_dir, meta_frame_filename))
-        else:
-            meta_frame_filename = f'sample_sheet_meta_data.pkl'
-            meta_frame.to_pickle(Path(data_dir, meta_frame_filename))
-        LOGGER.info(f"saved {meta_frame_filename}")
+def _merge_batch_parts(outputs, n_batches, output_dir, file_format='pickle'):
+    """ merges each output's batch parts into one file, and points outputs to it """
+    suffix = 'parquet' if file_format == 'parquet' else 'pkl'
+    # consolidate batches and delete parts, if possible
+    for file_type in ['beta_values', 'm_values', 'meth_values', 'unmeth_values',
+        'noob_meth_values', 'noob_unmeth_values', 'mouse_probes', 'poobah_values']: # control_probes.pkl not included yet
+        # only this run's parts (file_type_1 ... file_type_N in output_dir) are merged; not the outputs of other
+        # runs in sub-folders (array types of a mixed folder, .methylprep_shards, ...) or parts left by other runs.
+        if file_type in outputs: #--- if the batch size was larger than the number of total samples, this will still drop the _1
+            with profile_stage('merge_batches'):
+                merge_batches(n_batches, output_dir, file_type, file_format)
+            outputs.add(file_type, Path(output_dir, f"{file_type}.{suffix}"), outputs.formats[file_type])
 
-    # FIXED in v1.3.0
-    if save_control:
-        if file_format == 'parquet':
-            control_filename = f'control_probes.parquet'
-            control = pd.concat(control_snps) # creates multiindex
-            (control.reset_index()
-                .rename(columns={'level_0': 'Sentrix_ID', 'level_1': 'IlmnID'})
-                .astype({'IlmnID':str})
-                .to_parquet('control_probes.parquet')
-            )
-        else:
-            control_filename = f'control_probes.pkl'
-            with open(Path(data_dir, control_filename), 'wb') as control_file:
-                pickle.dump(control_snps, control_file)
-        LOGGER.info(f"saved {control_filename}")
 
-    # summarize any processing errors
+def _log_missing_probe_errors(missing_probe_errors):
+    """ summarize any processing errors """
     if missing_probe_errors['noob'] != []:
         avg_missing_per_sample = int(round(sum([item[1] for item in missing_probe_errors['noob']])/len(missing_probe_errors['noob'])))
         samples_affected = len(set([item[0] for item in missing_probe_errors['noob']]))
@@ -497,43 +887,273 @@ def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None
         samples_affected = len(set([item[0] for item in missing_probe_errors['raw']]))
         LOGGER.warning(f"{samples_affected} samples were missing (or had infinite values) RAW meth/unmeth probe values (average {avg_missing_per_sample} per sample)")
 
-    # batch processing done; consolidate and return data. This uses much more memory, but not called if in batch mode.
-    if batch_size and batch_size >= 200:
-        LOGGER.warning("Because the batch size was >=200 samples, files are saved but no data objects are returned.")
-        del batch_data_containers
-        for temp_data in temp_data_pickles:
-            temp_file = Path(data_dir, temp_data)
-            temp_file.unlink(missing_ok=True) # delete it
-        return
-
-    # consolidate batches and delete parts, if possible
-    for file_type in ['beta_values', 'm_values', 'meth_values', 'unmeth_values',
-        'noob_meth_values', 'noob_unmeth_values', 'mouse_probes', 'poobah_values']: # control_probes.pkl not included yet
-        test_parts = list([str(temp_file) for temp_file in Path(data_dir).rglob(f'{file_type}*.{suffix}')])
-        num_batches = len(test_parts)
-        # ensures that only the file_types that appear to be selected get merged.
-        #print(f"DEBUG num_batches {num_batches}, batch_size {batch_size}, file_type {file_type}")
-        if batch_size and num_batches >= 1: #--- if the batch size was larger than the number of total samples, this will still drop the _1
-            merge_batches(num_batches, data_dir, file_type, file_format)
-
-    # reload all the big stuff -- after everything important is done.
-    # attempts to consolidate all the batch_files below, if they'll fit in memory.
-    data_containers = []
-    for temp_data in temp_data_pickles:
-        temp_file = Path(data_dir, temp_data)
-        if temp_file.exists(): #possibly user deletes file while processing, since these are big
-            with open(temp_file,'rb') as _file:
-                batch_data_containers = pickle.load(_file)
-                data_containers.extend(batch_data_containers)
-                del batch_data_containers
-            temp_file.unlink() # delete it after loading.
-
-    if betas:
-        return consolidate_values_for_sheet(data_containers, postprocess_func_colname='beta_value', poobah=poobah, exclude_rs=True)
-    elif m_value:
-        return consolidate_values_for_sheet(data_containers, postprocess_func_colname='m_value', poobah=poobah, exclude_rs=True)
+def _run_array_partitions(data_dir, partitions, run_args, concurrent=False):
+    """ runs the pipeline on each ArrayPartition of a folder with several sample sheets, with run_pipeline's original
+    arguments (run_args). If they are all one array type, this is a single run over every sheet's samples. Otherwise
+    each array type's outputs are saved in data_dir/{array type}/ (450k/beta_values.pkl, epic/beta_values.pkl, ...)
+    and this returns {array type: what run_pipeline returned for its samples}.
+    concurrent=True runs the array types in parallel processes (each with run_pipeline's n_jobs workers). """
+    if len(partitions) > 1 and (run_args.get('manifest_filepath') or run_args['kwargs'].get('manifest')):
+        raise ValueError(f"{data_dir} contains samples of several array types ({', '.join(p.label for p in partitions)}); "
+            "manifest_filepath can only be used for one. Omit it, or process each array type's folder separately.")
+    LOGGER.info(f"{data_dir} has sample sheets with {len(partitions)} array types: "
+        f"{', '.join(f'{len(p.get_samples())} {p.label}' for p in partitions)} samples")
+    args = {key: value for key, value in run_args.items() if key != 'kwargs'}
+    args.update(run_args.get('kwargs', {}), make_sample_sheet=False, sample_sheet_filepath=None)
+    if len(partitions) == 1:
+        return run_pipeline(**dict(args, sample_sheet=partitions[0], array_type=(args['array_type'] or partitions[0].array_type)))
+    partition_args = {}
+    for partition in partitions:
+        output_dir = Path(data_dir, partition.label)
+        output_dir.mkdir(exist_ok=True)
+        partition_args[partition.label] = dict(args, data_dir=output_dir, sample_sheet=partition, array_type=partition.array_type)
+    if concurrent:
+        with ProcessPoolExecutor(max_workers=len(partitions)) as pool:
+            futures = {label: pool.submit(run_pipeline, **kwargs) for label, kwargs in partition_args.items()}
+            return {label: future.result() for label, future in futures.items()}
+    return {label: run_pipeline(**kwargs) for label, kwargs in partition_args.items()}
+
+
+def _run_shard_worker(data_dir, sample_sheet, run_args, uint16_outputs):
+    """ run_pipeline(shard='auto'): processes unclaimed shards of the sample sheet's samples until none are left, then
+    merges every shard's outputs into data_dir if all are done. See ShardQueue for how workers share the shards. """
+    args = {key: value for key, value in run_args.items() if key != 'kwargs'}
+    args.update(run_args.get('kwargs', {}))
+    sample_name = args['sample_name']
+    samples = [sample for sample in sample_sheet.get_samples() if not (sample_name and sample.name not in sample_name)]
+    # names must be unique across shards, as in one run
+    sample_id_counter = 1
+    for sample in samples:
+        if sample.name in (None, ''):
+            sample.name = f'Sample_{sample_id_counter}'
+            sample_id_counter += 1
+        if Counter((s.name for s in samples)).get(sample.name) > 1:
+            sample.name = f'{sample.name}_{sample_id_counter}'
+            sample_id_counter += 1
+    by_id = {f"{sample.sentrix_id}_{sample.sentrix_position}": sample for sample in samples}
+    shard_size = args['batch_size'] if isinstance(args['batch_size'], int) else DEFAULT_SHARD_SIZE
+    sample_ids = list(by_id)
+    shards = [sample_ids[i:i + shard_size] for i in range(0, len(sample_ids), shard_size)]
+    # options that may differ between nodes without changing the outputs
+    node_options = ('data_dir', 'n_jobs', 'max_memory', 'profile', 'cache_dir', 'cache_size', 'shard_lease', 'debug', 'concurrent_arrays', 'results')
+    queue = ShardQueue(data_dir, lease=args['shard_lease'])
+    queue.open(shards, {key: value for key, value in args.items() if key not in node_options + ('sample_sheet', 'manifest')})
+
+    finished = queue.finished()
+    if finished is not None:
+        LOGGER.info(f"shard: all {len(shards)} shards in {data_dir} are already merged")
+        return finished
+    shard_args = dict(args, shard=None, batch_size=None, sample_name=None, append=False, make_sample_sheet=False,
+        sample_sheet_filepath=None, results='files')
+    for number, shard_ids in enumerate(queue.shards):
+        if queue.is_done(number):
+            continue
+        claim = queue.claim(queue.shard_name(number))
+        if claim is None:
+            continue
+        if queue.is_done(number): # finished by another worker while this one was claiming it
+            continue
+        LOGGER.info(f"shard: processing {queue.shard_name(number)} ({len(shard_ids)} samples) as worker {queue.worker}")
+        subset = SampleSubset([(sample_sheet, [by_id[sample_id] for sample_id in shard_ids])])
+        output_dir = queue.output_dir(claim)
+        with queue.heartbeat(claim):
+            outputs = run_pipeline(**dict(shard_args, data_dir=output_dir, sample_sheet=subset))
+        if not queue.mark_done(number, claim, outputs):
+            shutil.rmtree(output_dir, ignore_errors=True)
+    if not queue.all_done():
+        LOGGER.info(f"shard: no unclaimed shards left in {data_dir}; the other workers are still processing theirs")
+        return None
+    claim = queue.claim('finalize')
+    if claim is None:
+        LOGGER.info(f"shard: all shards are done; another worker is merging their outputs")
+        return None
+    with queue.heartbeat(claim):
+        finished = queue.finished() # a worker that took over an expired 'finalize' claim finds the merge done
+        if finished is None:
+            with profile_stage('merge_batches'):
+                finished = merge_outputs(queue.done_outputs(), data_dir, uint16=uint16_outputs)
+            queue.finish(finished)
+    LOGGER.info(f"shard: merged the outputs of {len(shards)} shards into {data_dir}")
+    return finished
+
+
+def _array_probe_count(sample, array_type=None):
+    """ manifest probes of array_type, or of the array that this sample's IDATs come from, for batch_size='auto' """
+    if array_type is not None:
+        try:
+            probes = ArrayType(str(array_type).lower()).num_probes
+        except ValueError:
+            probes = None
+        if probes:
+            return probes
+    idat_probes = IdatDataset.read_probe_count(sample.get_filepath('idat', Channel.GREEN))
+    return ArrayType.from_probe_count(idat_probes).num_probes or idat_probes
+
+
+def _resolve_n_jobs(n_jobs):
+    """ n_jobs=None or 1 processes samples in this process; -1 uses every CPU; otherwise the number of worker processes. """
+    if n_jobs is None:
+        return 1
+    if isinstance(n_jobs, bool) or not isinstance(n_jobs, int) or n_jobs == 0 or n_jobs < -1:
+        raise ValueError(f"n_jobs must be a positive integer or -1 (all CPUs); you said {n_jobs}")
+    return (os.cpu_count() or 1) if n_jobs == -1 else n_jobs
+
+
+def _process_sample(idat_dataset_pair, manifest, container_kwargs, export=False, file_format='pickle',
+                    save_control=False, low_memory=True, cache=None, writer=None):
+    """ processes one sample for run_pipeline, in this process or in a pool worker.
+    Exports the CSV/parquet file and extracts the control probes here, because both need parts of the
+    SampleDataContainer that low_memory removes before it is returned.
+    cache: a StageCache to reuse (and save) this sample's processed container or detection p-values.
+    writer: an ExportWriter that saves the export file in the background (in this process only)
+    returns (data_container, export output_path or None, control probes DataFrame or None)"""
+    with profiling_sample(idat_dataset_pair['sample']):
+        return _process_one_sample(idat_dataset_pair, manifest, container_kwargs, export, file_format, save_control, low_memory, cache, writer)
+
+
+# settings that run_pipeline's stage cache applies to a cached processed container, instead of processing again
+# (bit is not one: IDAT intensities are read with that precision)
+_LATE_STAGE_SETTINGS = ('value_columns', 'file_format', 'debug')
+
+
+def _process_one_sample(idat_dataset_pair, manifest, container_kwargs, export, file_format, save_control, low_memory, cache=None, writer=None):
+    sample = idat_dataset_pair['sample']
+    processed_key = cached = None
+    if cache is not None and low_memory is True: # the cache holds low_memory containers
+        processed_key = cache.key('processed', sample, manifest,
+            {key: value for key, value in container_kwargs.items() if key not in _LATE_STAGE_SETTINGS})
+        cached = cache.load('processed', processed_key)
+    if cached is not None:
+        state, control_df = cached
+        data_container = SampleDataContainer._from_cache_state(state, sample,
+            **{key: container_kwargs[key] for key in _LATE_STAGE_SETTINGS if key in container_kwargs})
     else:
-        return data_containers
+        data_container = SampleDataContainer(
+            idat_dataset_pair=idat_dataset_pair,
+            manifest=manifest,
+            **container_kwargs,
+        )
+        pvalues = None
+        if cache is not None: # detection p-values only depend on the IDATs (read at this bit depth), manifest and infer_channel_switch
+            pvalues_key = cache.key('pvalues', sample, manifest,
+                {'switch_probes': container_kwargs.get('switch_probes'), 'bit': container_kwargs.get('bit')})
+            pvalues = cache.load('pvalues', pvalues_key) or {}
+            cached_pvalues = set(pvalues)
+        data_container.process_all(pvalues=pvalues)
+        if cache is not None and set(pvalues) != cached_pvalues:
+            cache.save('pvalues', pvalues_key, pvalues)
+
+        control_df = None
+        if save_control or processed_key: # cached with every processed sample, so any later run can save them
+            with profile_stage('control_snps'):
+                control_df = one_sample_control_snp(data_container)
+        if processed_key: # before export() rounds the data frame
+            cache.save('processed', processed_key, (data_container._cache_state(), control_df))
+
+    output_path = None
+    if export: # as CSV or parquet
+        suffix = 'parquet' if file_format == 'parquet' else 'csv'
+        output_path = data_container.sample.get_export_filepath(extension=suffix)
+        with profile_stage('export'):
+            data_container.export(output_path, writer=writer)
+
+    # now I can drop all the unneeded stuff from each SampleDataContainer (400MB per sample becomes 92MB)
+    # these are stored in SampleDataContainer.__data_frame for processing.
+    if low_memory is True and cached is None:
+        # use data_frame values instead of these class objects, because they're not in sesame SigSets.
+        for attribute in _LOW_MEMORY_DROPPED:
+            delattr(data_container, attribute)
+    return data_container, output_path, (control_df if save_control else None)
+
+
+def _in_batch_order(batch, resumed, processed):
+    """ yields the batch's results in sample sheet order: checkpointed results of `resumed` sample names, and the
+    `processed` results (in order) of the others. """
+    processed = iter(processed)
+    for name in batch:
+        yield resumed[name] if name in resumed else next(processed)
+
+
+_worker_manifest = None # set once in each pool worker by _init_worker
+
+
+def _init_worker(manifest, profile=False):
+    global _worker_manifest
+    _worker_manifest = manifest
+    if profile:
+        start_profiling()
+
+
+def _process_sample_in_worker(idat_dataset_pair, sample_kwargs):
+    """ returns (_process_sample result, this sample's profiling records or None) """
+    result = _process_sample(idat_dataset_pair, _worker_manifest, **sample_kwargs)
+    profiler = active_profiler()
+    return result, (profiler.drain() if profiler else None)
+
+
+def _process_samples_in_pool(idat_datasets, manifest, workers, sample_kwargs, on_result=None):
+    """ runs _process_sample for a batch of samples in a process pool, and yields the results in idat_datasets order
+    as they arrive. The manifest goes to each worker once (the pool initializer), not with every sample.
+    At most two samples per worker are submitted ahead of the one being yielded, so finished containers do not pile
+    up while the caller writes each one out (stream_outputs) or holds the batch in memory.
+    A failing sample does not stop the others; failures are logged per sample, then raised together once the rest
+    are yielded. on_result(idat_dataset_pair, result) is called as each sample's result arrives, and its return value
+    is yielded; its errors are not sample failures, and stop the run."""
+    workers = min(workers, len(idat_datasets))
+    failed = {}
+    profiler = active_profiler()
+    pending = deque()
+    progress = tqdm(total=len(idat_datasets), desc=f"Processing samples ({workers} workers)")
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(manifest, profiler is not None)) as pool:
+        to_submit = iter(idat_datasets)
+        def submit_next():
+            idat_dataset_pair = next(to_submit, None)
+            if idat_dataset_pair is not None:
+                pending.append((idat_dataset_pair, pool.submit(_process_sample_in_worker, idat_dataset_pair, sample_kwargs)))
+        try:
+            for _ in range(2 * workers):
+                submit_next()
+            while pending:
+                idat_dataset_pair, future = pending.popleft()
+                submit_next() # keeps the pool busy while this result is used
+                try:
+                    result, records = future.result()
+                except Exception as e:
+                    failed[str(idat_dataset_pair['sample'])] = e
+                    LOGGER.error(f"Sample {idat_dataset_pair['sample']} failed: {e.__class__.__name__}: {e}")
+                    continue
+                finally:
+                    progress.update()
+                if profiler and records:
+                    profiler.records.extend(dict(record, batch=profiler.batch) for record in records)
+                yield on_result(idat_dataset_pair, result) if on_result else result
+        finally: # the caller failed or stopped early: don't start the samples that were queued
+            for _, future in pending:
+                future.cancel()
+            progress.close()
+    if failed:
+        details = '; '.join(f"{sample}: {e.__class__.__name__}: {e}" for sample, e in failed.items())
+        raise RuntimeError(f"{len(failed)} of {len(idat_datasets)} samples failed processing -- {details}") from next(iter(failed.values()))
+
+
+def _write_export(data_frame, quality_mask_excluded_probes, output_path, file_format):
+    """ saves SampleDataContainer.export()'s file: a copy of the data frame with the noob values of quality_mask
+    excluded probes restored. It is written to a temporary file and renamed, so an export file is always complete. """
+    this = data_frame.copy(deep=True)
+    if quality_mask_excluded_probes is not None:
+        # copy over these failed probes to a dataframe for export
+        this.update({
+            'noob_meth': quality_mask_excluded_probes['noob_meth'],
+            'noob_unmeth': quality_mask_excluded_probes['noob_unmeth']
+            })
+    if 'quality_mask' in this.columns:
+        this['quality_mask'] = this['quality_mask'].fillna(1)
+    temp_path = Path(output_path).with_name(f".{Path(output_path).name}.tmp")
+    if file_format == 'parquet':
+        this.to_parquet(temp_path)
+    else:
+        this.to_csv(temp_path)
+    os.replace(temp_path, output_path)
 
 
 class SampleDataContainer(SigSet):
@@ -546,6 +1166,8 @@ class SampleDataContainer(SigSet):
         pval (default: False) -- whether to apply p-value-detection algorithm to remove
             unreliable probes (based on signal/noise ratio of fluoresence)
             uses the sesame method (pOOBah) based on out of band background levels
+        value_columns (default: both) -- which of 'beta_value' and 'm_value' process_all() calculates;
+            run_pipeline leaves out the ones that are not saved, exported or returned.
 
     Jan 2020: added .snp_(un)methylated property. used in postprocess.consolidate_crontrol_snp()
     Mar 2020: added p-value detection option
@@ -562,10 +1184,11 @@ class SampleDataContainer(SigSet):
     def __init__(self, idat_dataset_pair, manifest=None, retain_uncorrected_probe_intensities=False,
                  bit='float32', pval=False, poobah_decimals=3, poobah_sig=0.05, do_noob=True,
                  quality_mask=True, switch_probes=True, do_nonlinear_dye_bias=True, debug=False, sesame=True,
-                 pneg_ecdf=False, file_format='csv'):
+                 pneg_ecdf=False, file_format='csv', value_columns=('beta_value', 'm_value'), poobah_noob=True):
         self.debug = debug
         self.do_noob = do_noob
         self.pval = pval
+        self.poobah_noob = poobah_noob # with pval: probes that fail poobah are left out of the NOOB background
         self.poobah_decimals = poobah_decimals
         self.poobah_sig = poobah_sig
         self.quality_mask = quality_mask # if True, filters sesame's standard sketchy probes out of 450k, EPIC, EPIC+ arrays.
@@ -580,6 +1203,7 @@ class SampleDataContainer(SigSet):
         self.pneg_ecdf = pneg_ecdf
         self.data_type = 'float32' if bit == None else bit # options: (float64, float32, or float16)
         self.file_format = file_format
+        self.value_columns = value_columns # which of beta_value, m_value process_all calculates
         if debug:
             print(f'DEBUG SDC: sesame {self.sesame} switch {self.switch_probes} noob {self.do_noob} poobah {self.pval} mask {self.quality_mask}, dye {self.do_nonlinear_dye_bias}')
 
@@ -587,9 +1211,11 @@ class SampleDataContainer(SigSet):
         if self.switch_probes:
             # apply inter_channel_switch here; uses raw_dataset and manifest only; then updates self.raw_dataset
             # these are read from idats directly, not SigSet, so need to be modified at source.
-            infer_type_I_probes(self, debug=self.debug)
+            with profile_stage('infer_channel_switch'):
+                infer_type_I_probes(self, debug=self.debug)
 
-        super().__init__(self.sample, self.green_idat, self.red_idat, self.manifest, self.debug)
+        with profile_stage('sigset'):
+            super().__init__(self.sample, self.green_idat, self.red_idat, self.manifest, self.debug)
         # SigSet defines all probe-subsets, then SampleDataContainer adds them with super(); no need to re-define below.
         # mouse probes are processed within the normals meth/unmeth sets, then split at end of preprocessing step.
         del self.manifest
@@ -616,7 +1242,7 @@ class SampleDataContainer(SigSet):
                     print(f"-- {key}: {value}")
             self.check_for_probe_loss()
 
-    def process_all(self):
+    def process_all(self, pvalues=None):
         """Runs all pre and post-processing calculations for the dataset.
         Combines the SigSet methylated and unmethylated parts of SampleDataContainer, and modifies them,
         whilst creating self.__data_frame with noob/dye processed data.
@@ -630,21 +1256,37 @@ class SampleDataContainer(SigSet):
         - reduce memory/bit-depth of data
         - copy over uncorrected values
         - split out mouse probes
+
+    pvalues: optional dict of detection p-value frames ('poobah_pval', 'pNegECDF_pval') to reuse instead of
+        calculating them; the frames calculated here are added to it. run_pipeline's stage cache uses this.
         """
         # self.preprocess -- applies BG_correction and NOOB to .methylated, .unmethylated
         # also creates a self.mouse_data_frame for mouse specific probes with 'noob_meth' and 'noob_unmeth' columns here.
         if self.__data_frame:
             return self.__data_frame
 
-        pval_probes_df = _pval_sesame_preprocess(self) if self.pval == True else None
-        pneg_ecdf_probes_df = _pval_neg_ecdf(self) if self.pneg_ecdf == True else None
+        pvalues = {} if pvalues is None else pvalues
+        pval_probes_df = pneg_ecdf_probes_df = quality_mask_df = None
+        if self.pval == True:
+            if 'poobah_pval' not in pvalues:
+                with profile_stage('poobah'):
+                    pvalues['poobah_pval'] = _pval_sesame_preprocess(self)
+            pval_probes_df = pvalues['poobah_pval']
+        if self.pneg_ecdf == True:
+            if 'pNegECDF_pval' not in pvalues:
+                with profile_stage('pneg_ecdf'):
+                    pvalues['pNegECDF_pval'] = _pval_neg_ecdf(self)
+            pneg_ecdf_probes_df = pvalues['pNegECDF_pval']
         # output: df with one column named 'poobah_pval'
-        quality_mask_df = _apply_sesame_quality_mask(self) if self.quality_mask == True else None
+        if self.quality_mask == True:
+            with profile_stage('quality_mask'):
+                quality_mask_df = _apply_sesame_quality_mask(self)
         # output: df with one column named 'quality_mask' | if not supported array / custom array: returns nothing.
 
         if self.do_noob == True:
             # apply corrections: bg subtract, then noob (in preprocess.py)
-            preprocess_noob(self, pval_probes_df=pval_probes_df, quality_mask_df=quality_mask_df, nonlinear_dye_correction=self.do_nonlinear_dye_bias, debug=self.debug)
+            with profile_stage('noob'):
+                preprocess_noob_arrays(self, pval_probes_df=(pval_probes_df if self.poobah_noob else None), quality_mask_df=quality_mask_df, nonlinear_dye_correction=self.do_nonlinear_dye_bias, debug=self.debug)
             #if self.sesame in (None,True):
                 #preprocess_noob(self, pval_probes_df=pval_probes_df, quality_mask_df=quality_mask_df, nonlinear_dye_correction=self.do_nonlinear_dye_bias, debug=self.debug)
                 #if container.__dye_bias_corrected is False: # process failed, so fallback is linear-dye
@@ -701,7 +1343,8 @@ class SampleDataContainer(SigSet):
             self.__data_frame = self.__data_frame.join(quality_mask_df, how='inner')
 
         if self.do_nonlinear_dye_bias == True:
-            nonlinear_dye_bias_correction(self, debug=self.debug)
+            with profile_stage('dye_bias'):
+                nonlinear_dye_bias_correction(self, debug=self.debug)
             # this step ensures that failed probes are not included in the NOOB calculations.
             # but they MUST be included in CSV exports, so I move the failed probes to another df for storage until pipeline.export() needs them.
             if self.quality_mask == True and 'quality_mask' in self.__data_frame.columns:
@@ -770,8 +1413,11 @@ class SampleDataContainer(SigSet):
                 'noob_meth': self.__quality_mask_excluded_probes['noob_meth'],
                 'noob_unmeth': self.__quality_mask_excluded_probes['noob_unmeth']
                 })
-        self.__data_frame = self.process_beta_value(self.__data_frame)
-        self.__data_frame = self.process_m_value(self.__data_frame)
+        with profile_stage('beta_m_values'):
+            if 'beta_value' in self.value_columns:
+                self.__data_frame = self.process_beta_value(self.__data_frame)
+            if 'm_value' in self.value_columns:
+                self.__data_frame = self.process_m_value(self.__data_frame)
 
         if self.debug:
             self.check_for_probe_loss(f"816 self.check_for_probe_loss(): self.__data_frame = {self.__data_frame.shape}")
@@ -783,6 +1429,33 @@ class SampleDataContainer(SigSet):
 
         return # self.__data_frame
 
+    @property
+    def data_frame(self):
+        """ the processed probes x values DataFrame: noob_meth, noob_unmeth, beta_value, m_value, poobah_pval, ... """
+        return self.__data_frame
+
+    def _cache_state(self):
+        """ what run_pipeline's stage cache saves of a processed container: everything low_memory keeps """
+        return {key: value for key, value in vars(self).items() if key not in _LOW_MEMORY_DROPPED}
+
+    @classmethod
+    def _from_cache_state(cls, state, sample, value_columns=('beta_value', 'm_value'), file_format='csv', debug=False):
+        """ a processed container from _cache_state(), for this run's sample and late-stage settings:
+        the value columns this run needs are calculated again. """
+        container = cls.__new__(cls)
+        container.__dict__.update(state)
+        container.sample = sample
+        container.value_columns = value_columns
+        container.file_format = file_format
+        container.debug = debug
+        frame = container.__data_frame.drop(columns=['beta_value', 'm_value'], errors='ignore')
+        if 'beta_value' in value_columns:
+            frame = container.process_beta_value(frame)
+        if 'm_value' in value_columns:
+            frame = container.process_m_value(frame)
+        container.__data_frame = frame
+        return container
+
     def process_m_value(self, input_dataframe):
         """Calculate M value from methylation data"""
         return self._postprocess(input_dataframe, calculate_m_value, 'm_value')
@@ -801,21 +1474,17 @@ class SampleDataContainer(SigSet):
         return self._postprocess(input_dataframe, calculate_copy_number, 'cm_value')
 
 
-    def export(self, output_path):
-        """Saves a CSV for each sample with all processing intermediate data"""
+    def export(self, output_path, writer=None):
+        """Saves a CSV for each sample with all processing intermediate data.
+        With an ExportWriter, the file is saved in one of its threads and this returns once it is queued;
+        the data frame is rounded here either way."""
         ensure_directory_exists(output_path)
         # ensure smallest possible csv files
         self.__data_frame = self.__data_frame.round({'noob_meth':0, 'noob_unmeth':0, 'm_value':3, 'beta_value':3,
             'meth':0, 'unmeth':0, 'poobah_pval':self.poobah_decimals})
-        this = self.__data_frame.copy(deep=True)
+        excluded_probes = None
         if hasattr(self, '_SampleDataContainer__quality_mask_excluded_probes') and isinstance(self._SampleDataContainer__quality_mask_excluded_probes, pd.DataFrame):
-            # copy over these failed probes to a dataframe for export
-            this.update({
-                'noob_meth': self.__quality_mask_excluded_probes['noob_meth'],
-                'noob_unmeth': self.__quality_mask_excluded_probes['noob_unmeth']
-                })
-        if 'quality_mask' in this.columns:
-            this['quality_mask'] = this['quality_mask'].fillna(1)
+            excluded_probes = self.__quality_mask_excluded_probes
         # noob columns contain NANs now because of sesame (v1.4.0 to v1.4.5); v1.4.6+ CSVs contain all data, but pickles are filtered.
         #try:
         #    self.__data_frame['noob_meth'] = self.__data_frame['noob_meth'].astype(int, copy=False)
@@ -838,10 +1507,10 @@ class SampleDataContainer(SigSet):
         #        else:
         #            num_missing = self.__data_frame['meth'].isna().sum() + self.__data_frame['unmeth'].isna().sum()
         #        self.raw_processing_missing_probe_errors.append((output_path, num_missing))
-        if self.file_format == 'parquet':
-            this.to_parquet(output_path)
-        else:
-            this.to_csv(output_path)
+        if writer is None:
+            _write_export(self.__data_frame, excluded_probes, output_path, self.file_format)
+        else: # the frame is not changed after this, so the writer can copy it later
+            writer.submit(_write_export, self.__data_frame, excluded_probes, output_path, self.file_format)
 
     def _postprocess(self, input_dataframe, postprocess_func, header, offset=None):
         if offset is not None:
@@ -928,11 +1597,17 @@ The rest of these are additional optional kwargs you can include:
     low_memory=True, --- If True, processing deletes intermediate objects. But you can save them in the SampleDataContainer by setting this to False.
     poobah_decimals=3 --- in csv file output
     poobah_sig=0.05
+    profile=False --- True (or a file path) saves the time and peak memory of each stage, per sample; see run_pipeline
 
 [logging] -- how much information do you want on the screen? Default is minimal information.
     verbose=False (True for more)
     debug=False (True for a LOT more info)
 
+[plan] -- the steps, exports and estimator are compiled into a PipelinePlan: only the stages, per-sample columns
+    and outputs that something saves or returns are computed. For example, estimator='beta' without the 'csv'
+    export never calculates m_values.
+    plan_only=True --- returns the PipelinePlan (stages, columns, outputs, returns, skipped) without processing anything.
+
      """
     allowed_steps = ['all', 'infer_channel_switch', 'poobah', 'quality_mask', 'noob', 'dye_bias']
     allowed_exports = ['all', 'csv', 'poobah', 'meth', 'unmeth', 'noob_meth', 'noob_unmeth', 'sample_sheet_meta_data', 'mouse', 'control']
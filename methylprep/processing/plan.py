@@ -0,0 +1,92 @@
+# Lib
+import logging
+
+__all__ = ['PipelinePlan', 'build_plan']
+
+LOGGER = logging.getLogger(__name__)
+
+VALUE_COLUMNS = ('beta_value', 'm_value') # calculated from noob_meth / noob_unmeth at the end of process_all
+
+
+class PipelinePlan():
+    """What one run_pipeline / make_pipeline call will compute, worked out from what it saves and returns.
+
+    Stages, columns and outputs that nothing consumes are left out. For example, betas=True without a CSV export
+    never calculates each sample's m_value column, and pneg_ecdf p-values are only calculated if they are exported
+    or returned. Get the plan without processing anything with make_pipeline(..., plan_only=True).
+
+    - stages: per-sample stages, in the order they run
+    - columns: the value columns each SampleDataContainer calculates (beta_value, m_value)
+    - outputs: the files saved (without file extensions)
+    - returns: 'beta_values', 'm_values', 'containers', 'samples' (ProcessedSamples), 'files' (ProcessedOutputs) or None
+    - skipped: {stage, column or output: why it is not computed}
+    """
+
+    def __init__(self, stages, columns, outputs, returns, skipped):
+        self.stages = stages
+        self.columns = columns
+        self.outputs = outputs
+        self.returns = returns
+        self.skipped = skipped
+
+    def __repr__(self):
+        lines = [
+            'PipelinePlan',
+            f"  per sample: {' > '.join(self.stages)}",
+            f"  outputs: {', '.join(self.outputs) or 'none'}",
+            f"  returns: {self.returns}",
+        ]
+        lines += [f"  skipped {name}: {reason}" for name, reason in self.skipped.items()]
+        return '\n'.join(lines)
+
+
+def build_plan(matrix_outputs, switch_probes=True, poobah=True, pneg_ecdf=False, quality_mask=True, do_noob=True,
+               dye_bias=True, export=False, export_poobah=False, save_control=False, meta_data_frame=True,
+               do_mouse=True, returns='containers', poobah_step=True):
+    """ the PipelinePlan for run_pipeline's resolved settings.
+
+    matrix_outputs: {data frame column: (file stem, apply poobah, uint16)}, as run_pipeline selects them.
+    poobah: filter failed probes from the outputs (and the NOOB background). The poobah stage runs if they are
+        filtered, or if the p-values are saved (poobah_values); otherwise it is skipped.
+    poobah_step: False if make_pipeline's steps leave poobah out; then it never runs, and nothing is filtered or saved.
+    dye_bias: True (nonlinear), False (linear, within noob) or None (omitted).
+    returns: what run_pipeline will return; see PipelinePlan."""
+    skipped = {}
+    outputs = {}
+    for column, (file_stem, _, _) in matrix_outputs.items():
+        if column == 'poobah_pval' and not poobah_step:
+            skipped[file_stem] = "exporting p-values needs the 'poobah' step"
+        elif column == 'pNegECDF_pval' and not pneg_ecdf:
+            continue # only exported along with poobah_values when pneg_ecdf is set
+        else:
+            outputs[column] = file_stem
+    containers = returns in ('containers', 'samples') # every column of each sample is returned
+    columns = [column for column in VALUE_COLUMNS if containers or export or column in outputs]
+    for column in VALUE_COLUMNS:
+        if column not in columns:
+            skipped[column] = 'not saved, exported or returned'
+    if pneg_ecdf and not (containers or export or 'pNegECDF_pval' in outputs):
+        skipped['pneg_ecdf'] = 'not saved, exported or returned'
+        pneg_ecdf = False
+
+    run_poobah = poobah or 'poobah_pval' in outputs
+    if not run_poobah:
+        skipped['poobah'] = 'no output is filtered by or saves the p-values'
+
+    stages = ['read_idats']
+    stages += ['infer_channel_switch'] if switch_probes else []
+    stages += ['poobah'] if run_poobah else []
+    stages += ['pneg_ecdf'] if pneg_ecdf else []
+    stages += ['quality_mask'] if quality_mask else []
+    if do_noob:
+        stages += ['noob'] if dye_bias is not False else ['noob (linear dye bias)']
+    stages += ['dye_bias'] if dye_bias is True else []
+    stages += columns
+    stages += ['export'] if export else []
+    stages += ['control_snps'] if save_control else []
+
+    saved = list(outputs.values())
+    saved += ['control_probes'] if save_control else []
+    saved += ['mouse_probes (mouse arrays)'] if do_mouse else []
+    saved += ['sample_sheet_meta_data'] if meta_data_frame else []
+    return PipelinePlan(stages, columns, saved, returns, skipped)
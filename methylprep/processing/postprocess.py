@@ -7,12 +7,16 @@ from pathlib import Path
 import logging
 # app
 from ..utils import is_file_like
+from ..models import ArrayType
+from ..models.sketchy_probes import quality_mask_excluded
+from .outputs import _samples_in_columns
 #from ..utils.progress_bar import * # context tqdm
 
 os.environ['NUMEXPR_MAX_THREADS'] = "8" # suppresses warning
 
 
-__all__ = ['calculate_beta_value', 'calculate_m_value', 'consolidate_values_for_sheet', 'consolidate_mouse_probes']
+__all__ = ['calculate_beta_value', 'calculate_m_value', 'consolidate_values_for_sheet', 'consolidate_values', 'consolidate_mouse_probes',
+    'rethreshold_values', 'rethreshold']
 
 LOGGER = logging.getLogger(__name__)
 
@@ -74,37 +78,183 @@ def consolidate_values_for_sheet(data_containers, postprocess_func_colname='beta
             If 'quality_mask' is present in df, True filters these probes from pickle output.
         exclude_rs
             as of v1.5.0 SigSet keeps snp ('rs') probes with other probe types (if qualityMask is false); need to separate them here
-            before exporting to file."""
-    poobah_column = 'poobah_pval'
-    quality_mask = 'quality_mask'
-    for idx,sample in enumerate(data_containers):
-        sample_id = f"{sample.sample.sentrix_id}_{sample.sample.sentrix_position}"
+            before exporting to file.
 
-        if poobah == True and poobah_column in sample._SampleDataContainer__data_frame.columns:
-            # remove all failed probes by replacing with NaN before building DF.
-            sample._SampleDataContainer__data_frame.loc[sample._SampleDataContainer__data_frame[poobah_column] >= poobah_sig, postprocess_func_colname] = np.nan
-        elif poobah == True and poobah_column not in sample._SampleDataContainer__data_frame.columns:
-            LOGGER.warning('DEBUG: missing poobah')
+    v1.7.2: a wrapper around consolidate_values(), which builds several of these at once.
+    The containers' data frames are no longer modified; failed probes are only NaN in the returned DataFrame."""
+    return consolidate_values(data_containers, {postprocess_func_colname: poobah}, bit=bit,
+        poobah_sig=poobah_sig, exclude_rs=exclude_rs)[postprocess_func_colname]
 
-        if sample.quality_mask == True and quality_mask in sample._SampleDataContainer__data_frame.columns:
-            # blank there probes where quality_mask == 0
-            sample._SampleDataContainer__data_frame.loc[sample._SampleDataContainer__data_frame[quality_mask] == 0, postprocess_func_colname] = np.nan
 
-        this_sample_values = sample._SampleDataContainer__data_frame[postprocess_func_colname]
+def consolidate_values(data_containers, columns, bit='float32', poobah_sig=0.05, exclude_rs=True):
+    """ builds a probes x samples DataFrame for each data frame column in `columns`, in one pass over the samples.
 
-        if exclude_rs: # dropping rows before exporting
-            mask_snps = (sample._SampleDataContainer__data_frame.index.str.startswith('rs'))
-            this_sample_values = this_sample_values.loc[ ~mask_snps ]
-
-        if idx == 0:
-            merged = pd.DataFrame(this_sample_values, columns=[postprocess_func_colname])
-            merged.rename(columns={postprocess_func_colname: sample_id}, inplace=True)
+    Input:
+        data_containers -- a list of processed SampleDataContainer (or ProcessedSample) objects
+        columns -- a dict of {data frame column: apply the poobah filter (True/False)}, like
+            {'beta_value': True, 'noob_meth': True, 'meth': False, 'poobah_pval': False}
+
+    Each output is one preallocated (probes x samples) array of `bit` (float32 by default), filled a column at a time.
+    Each sample's masks are computed once and reused by every output:
+        - probes with poobah_pval >= poobah_sig are NaN in the outputs that apply the poobah filter
+        - if the sample used the quality_mask, probes with quality_mask == 0 are NaN in every output
+        - exclude_rs drops the snp ('rs') probes
+    Returns a dict of {column: DataFrame}, with sample_ids (sentrix_id_position) as DataFrame columns."""
+    dtype = bit if bit in ('float64', 'float16') else 'float32'
+    poobah_column = 'poobah_pval'
+    quality_mask = 'quality_mask'
+    sample_ids = [f"{sample.sample.sentrix_id}_{sample.sample.sentrix_position}" for sample in data_containers]
+    # a container's frame is read directly, so containers pickled before the data_frame property still work
+    frames = [getattr(sample, '_SampleDataContainer__data_frame', None) for sample in data_containers]
+    frames = [sample.data_frame if frame is None else frame for sample, frame in zip(data_containers, frames)]
+    if not frames:
+        return {column: pd.DataFrame(dtype=dtype) for column in columns}
+
+    def kept_rows(index):
+        return ~index.str.startswith('rs') if exclude_rs else np.ones(len(index), dtype=bool)
+    # samples from one manifest share a probe index: the snp filter is computed once and every column lines up.
+    first_index = frames[0].index
+    first_kept = kept_rows(first_index)
+    probes = first_index[first_kept]
+    layouts = [] # per sample: (kept rows, index of kept rows or None if already in `probes` order)
+    for frame in frames:
+        if frame.index is first_index or (len(frame.index) == len(first_index) and np.array_equal(frame.index.to_numpy(), first_index.to_numpy())):
+            layouts.append((first_kept, None))
             continue
-        merged = pd.concat([merged, this_sample_values], axis=1)
-        merged.rename(columns={postprocess_func_colname: sample_id}, inplace=True)
-    if bit != 'float32' and bit in ('float64','float16'):
-        merged = merged.astype(bit)
-    return merged
+        kept = kept_rows(frame.index)
+        layouts.append((kept, frame.index[kept]))
+        # samples from different manifests: the union of probes, like pd.concat, with NaN for probes a sample lacks
+        probes = probes.union(frame.index[kept], sort=False)
+
+    values = {column: np.empty((len(probes), len(frames)), dtype=dtype) for column in columns}
+    for idx, (sample, frame, (kept, sample_probes)) in enumerate(zip(data_containers, frames, layouts)):
+        failed_qc = np.zeros(int(kept.sum()), dtype=bool)
+        if sample.quality_mask == True and quality_mask in frame.columns:
+            failed_qc |= frame[quality_mask].to_numpy()[kept] == 0
+        failed_poobah = failed_qc.copy()
+        if any(columns.values()):
+            if poobah_column in frame.columns:
+                failed_poobah |= frame[poobah_column].to_numpy()[kept] >= poobah_sig
+            else:
+                LOGGER.warning('DEBUG: missing poobah')
+        for column, apply_poobah in columns.items():
+            column_values = np.where(failed_poobah if apply_poobah else failed_qc, np.nan, frame[column].to_numpy(dtype='float64')[kept])
+            if sample_probes is None and len(probes) == len(column_values):
+                values[column][:, idx] = column_values
+            else:
+                values[column][:, idx] = pd.Series(column_values, index=sample_probes if sample_probes is not None else first_index[first_kept]).reindex(probes).to_numpy()
+    return {column: pd.DataFrame(array, index=probes, columns=sample_ids) for column, array in values.items()}
+
+
+def rethreshold_values(poobah_values, noob_meth_values, noob_unmeth_values, poobah_sig=0.05, quality_mask=False,
+    array_type=None, sesame=True, betas=True, m_value=True, bit='float32', chunk_size=1000, run_poobah_sig=0.05):
+    """ Regenerates beta and/or m_value matrices from saved outputs, with a new poobah threshold,
+    without reprocessing any IDATs.
+
+    Input:
+        poobah_values, noob_meth_values, noob_unmeth_values -- DataFrames, as saved by run_pipeline
+        (poobah_values.pkl, noob_meth_values.pkl, noob_unmeth_values.pkl). Probes in rows, samples in columns;
+        matrices saved with samples in rows (more samples than probes, with the IlmnID probe names as columns)
+        are transposed back.
+
+    Options:
+        poobah_sig
+            probes with a p-value >= poobah_sig are replaced with NaN (same rule as consolidate_values_for_sheet).
+            Pass None to skip the poobah filter.
+        quality_mask
+            If True, also blanks out the sesame quality_mask probes for `array_type`.
+        sesame
+            beta-value offset: 0 for sesame (default), 100 for minfi.
+        betas, m_value
+            which matrices to return.
+        chunk_size
+            number of samples computed at a time, to bound memory for very large cohorts.
+        run_poobah_sig
+            the poobah_sig of the run_pipeline run that saved the inputs (0.05 by default there). Its noob_meth/noob_unmeth
+            matrices are already blank (NaN) for probes at or above it, so a looser poobah_sig (or None) raises a
+            ValueError: those probes cannot be restored. Pass None if the run did not filter them: run_pipeline(
+            poobah=False, export_poobah=True) saves the p-values with unfiltered noob values, which any poobah_sig can use.
+
+    Note: probes blanked by the run's quality_mask cannot be restored either; a warning counts them.
+
+    Returns:
+        a dict with 'beta_values' and/or 'm_values' DataFrames (probes x samples)."""
+    if run_poobah_sig is not None and (poobah_sig is None or poobah_sig > run_poobah_sig):
+        raise ValueError(f"poobah_sig={poobah_sig} is looser than the run's {run_poobah_sig}: probes at or above "
+            f"{run_poobah_sig} were not saved with noob values, so they would stay NaN. Re-run run_pipeline with "
+            "poobah=False and export_poobah=True to rethreshold without that limit (then pass run_poobah_sig=None).")
+    poobah_values = _probes_in_rows(poobah_values)
+    probes = poobah_values.index
+    samples = poobah_values.columns
+    meth = _probes_in_rows(noob_meth_values).reindex(index=probes, columns=samples).to_numpy(dtype='float32')
+    unmeth = _probes_in_rows(noob_unmeth_values).reindex(index=probes, columns=samples).to_numpy(dtype='float32')
+    pvals = poobah_values.to_numpy(dtype='float32')
+    if quality_mask:
+        if array_type is None:
+            raise ValueError("array_type is required to apply the quality_mask")
+        masked_probes = quality_mask_excluded(ArrayType(array_type), probes)
+    else:
+        masked_probes = np.zeros(len(probes), dtype=bool)
+
+    outputs = {}
+    if betas:
+        outputs['beta_values'] = np.empty(meth.shape, dtype='float32')
+    if m_value:
+        outputs['m_values'] = np.empty(meth.shape, dtype='float32')
+    offset = 0 if sesame else 100
+    restored = 0
+    # NaN p-values (masked or missing probes) never fail the threshold
+    for start in range(0, len(samples), chunk_size):
+        cols = slice(start, start + chunk_size)
+        failed = np.zeros(pvals[:, cols].shape, dtype=bool) if poobah_sig is None else pvals[:, cols] >= poobah_sig
+        failed |= masked_probes[:, None]
+        m = np.where(failed, np.nan, meth[:, cols])
+        u = np.where(failed, np.nan, unmeth[:, cols])
+        restored += int((~failed & np.isnan(meth[:, cols])).sum())
+        if betas:
+            outputs['beta_values'][:, cols] = calculate_beta_value(m, u, offset=offset)
+        if m_value:
+            outputs['m_values'][:, cols] = calculate_m_value(m, u)
+    if restored > 0:
+        LOGGER.warning(f"{restored} probe values are kept by the new settings but were not saved by run_pipeline (they failed the original quality_mask filter); these stay NaN.")
+    dtype = bit if bit in ('float16', 'float32', 'float64') else 'float32'
+    return {name: pd.DataFrame(values, index=probes, columns=samples).astype(dtype, copy=False) for name, values in outputs.items()}
+
+
+def rethreshold(data_dir, poobah_sig=0.05, quality_mask=False, array_type=None, sesame=True, betas=True, m_value=True,
+    bit='float32', file_format='pickle', out_dir=None, run_poobah_sig=0.05):
+    """ Loads poobah_values, noob_meth_values and noob_unmeth_values from a run_pipeline output folder,
+    regenerates beta_values and/or m_values with a new poobah_sig (see rethreshold_values), and saves them
+    into out_dir (default: data_dir, replacing the existing beta_values/m_values files).
+
+    run_pipeline must have been run with export_poobah=True and betas or m_value (or save noob) so that these
+    input files exist. poobah_sig can only be stricter than that run's (run_poobah_sig), unless it ran with
+    poobah=False; see rethreshold_values. Returns the list of files written."""
+    suffix = 'parquet' if file_format == 'parquet' else 'pkl'
+    read = pd.read_parquet if file_format == 'parquet' else pd.read_pickle
+    inputs = {}
+    for stem in ('poobah_values', 'noob_meth_values', 'noob_unmeth_values'):
+        filepath = Path(data_dir, f"{stem}.{suffix}")
+        if not filepath.exists():
+            raise FileNotFoundError(f"{filepath} not found; re-threshold needs the poobah_values, noob_meth_values and noob_unmeth_values outputs of run_pipeline (export_poobah=True).")
+        inputs[stem] = read(filepath)
+    outputs = rethreshold_values(inputs['poobah_values'], inputs['noob_meth_values'], inputs['noob_unmeth_values'],
+        poobah_sig=poobah_sig, quality_mask=quality_mask, array_type=array_type, sesame=sesame,
+        betas=betas, m_value=m_value, bit=bit, run_poobah_sig=run_poobah_sig)
+    out_dir = Path(out_dir) if out_dir else Path(data_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    saved = []
+    for stem, df in outputs.items():
+        filepath = Path(out_dir, f"{stem}.{suffix}")
+        df.to_parquet(filepath) if file_format == 'parquet' else df.to_pickle(filepath)
+        LOGGER.info(f"saved {filepath} {df.shape}")
+        saved.append(filepath)
+    return saved
+
+
+def _probes_in_rows(df):
+    """ run_pipeline saves matrices transposed (samples in rows) when there are more samples than probes; undo that. """
+    return df if _samples_in_columns(df) else df.transpose()
 
 
 def one_sample_control_snp(container):
@@ -7,16 +7,18 @@ import logging
 import numpy as np
 import pandas as pd
 from statsmodels import robust
-from scipy.stats import norm, lognorm
+from scipy import special
 # App
 from ..models import ControlType, ArrayType
-from ..models.sketchy_probes import qualityMask450, qualityMaskEPIC, qualityMaskEPICPLUS, qualityMaskmouse
+from ..models.sketchy_probes import quality_mask_excluded
 
 
-__all__ = ['preprocess_noob']
+__all__ = ['preprocess_noob', 'preprocess_noob_arrays']
 
 
 LOGGER = logging.getLogger(__name__)
+_SQRT_HALF = np.sqrt(0.5)
+_SQRT_2_OVER_PI = np.sqrt(2 / np.pi)
 
 
 def preprocess_noob(container, offset=15, pval_probes_df=None, quality_mask_df=None, nonlinear_dye_correction=True, debug=False, unit_test_oob=False): # v1.4.5+
@@ -110,6 +112,85 @@ def preprocess_noob(container, offset=15, pval_probes_df=None, quality_mask_df=N
             'noob_red': noob_red,
         }
 
+    _update_container_noob(container, noob_green, noob_red, params_green, params_red, nonlinear_dye_correction, debug)
+
+
+def preprocess_noob_arrays(container, offset=15, pval_probes_df=None, quality_mask_df=None, nonlinear_dye_correction=True, debug=False, unit_test_oob=False): # v1.7.2+
+    """ array-native NOOB; same inputs and results as preprocess_noob, which is kept as the reference implementation.
+
+    - in-band (ibG, ibR) values are stacked Meth-then-Unmeth straight from the SigSet's numpy columns
+    - poobah and quality_mask exclusions are applied as one boolean mask per out-of-band subset, instead of
+      drop(index=...) and concatenating python lists
+    - clipping and the normexp correction run on numpy arrays; only the final noob_green/noob_red frames
+      (IlmnID, used, bg_corrected) are built for update_probe_means.
+    """
+    if debug:
+        print(f"DEBUG NOOB-arrays {debug} nonlinear_dye_correction={nonlinear_dye_correction}, pval_probes_df={pval_probes_df.shape if isinstance(pval_probes_df,pd.DataFrame) else 'None'}, quality_mask_df={quality_mask_df.shape if isinstance(quality_mask_df,pd.DataFrame) else 'None'}")
+    ibG_ids, ibG_used, ibG_values = _stack_in_band(container.ibG)
+    ibR_ids, ibR_used, ibR_values = _stack_in_band(container.ibR)
+
+    # out-of-band is Green-Unmeth and Red-Meth; exclude failing probes, then drop any missing intensities.
+    failed = pd.Index([])
+    if isinstance(pval_probes_df, pd.DataFrame):
+        failed = failed.append(pval_probes_df.index[ pval_probes_df['poobah_pval'].to_numpy() > container.poobah_sig ])
+    if isinstance(quality_mask_df, pd.DataFrame):
+        failed = failed.append(quality_mask_df.index[ quality_mask_df['quality_mask'].to_numpy() == 0 ])
+    oobR_values = _stack_out_of_band(container.oobR, failed)
+    oobG_values = _stack_out_of_band(container.oobG, failed)
+
+    if debug:
+        print(f"ibG {len(ibG_values)} ibR {len(ibR_values)} oobG {len(oobG_values)} oobR {len(oobR_values)}")
+
+    # set minimum intensity to 1
+    for values in (ibG_values, ibR_values, oobG_values, oobR_values):
+        np.maximum(values, 1, out=values)
+
+    green_corrected, params_green = _normexp_bg_corrected_array(ibG_values, oobG_values, offset, sample_name=container.sample.name)
+    red_corrected, params_red = _normexp_bg_corrected_array(ibR_values, oobR_values, offset, sample_name=container.sample.name)
+    noob_green = pd.DataFrame({'IlmnID': ibG_ids, 'used': ibG_used, 'bg_corrected': green_corrected.round(0)})
+    noob_red = pd.DataFrame({'IlmnID': ibR_ids, 'used': ibR_used, 'bg_corrected': red_corrected.round(0)})
+
+    if unit_test_oob:
+        return {
+            'oobR': pd.DataFrame({'mean_value': oobR_values}),
+            'oobG': pd.DataFrame({'mean_value': oobG_values}),
+            'noob_green': noob_green,
+            'noob_red': noob_red,
+        }
+    _update_container_noob(container, noob_green, noob_red, params_green, params_red, nonlinear_dye_correction, debug)
+
+
+def _stack_in_band(probes):
+    """ flattens an in-band SigSet subset into (IlmnIDs, 'M'/'U' used labels, intensities), Meth then Unmeth, skipping NaNs. """
+    values = np.concatenate([probes['Meth'].to_numpy(), probes['Unmeth'].to_numpy()])
+    keep = ~np.isnan(values)
+    ids = np.concatenate([probes.index.to_numpy(), probes.index.to_numpy()])[keep]
+    used = np.repeat(np.array(['M','U'], dtype=object), len(probes))[keep]
+    return ids, used, values[keep]
+
+
+def _stack_out_of_band(probes, failed):
+    """ flattens an out-of-band SigSet subset into one float64 array (Meth then Unmeth), excluding probes in `failed` and NaNs. """
+    keep = ~probes.index.isin(failed)
+    values = np.concatenate([probes['Meth'].to_numpy(dtype='float64')[keep], probes['Unmeth'].to_numpy(dtype='float64')[keep]])
+    return values[~np.isnan(values)]
+
+
+def _normexp_bg_corrected_array(fg_means, bg_means, offset, sample_name=None):
+    """ numpy version of normexp_bg_corrected: returns (bg_corrected array rounded to 0.1, params) """
+    if fg_means.min() == fg_means.max():
+        LOGGER.error(f"{sample_name}: min and max intensity are same. Sample probably bad.")
+        return np.ones(len(fg_means)), BackgroundCorrectionParams(bg_mean=1.0, bg_mad=1.0, mean_signal=1.0, offset=15)
+    fg_mean, _fg_mad = huber(fg_means)
+    bg_mean, bg_mad = huber(bg_means)
+    mean_signal = np.maximum(fg_mean - bg_mean, 10) # "alpha" in sesame function
+    params = BackgroundCorrectionParams(bg_mean, bg_mad, mean_signal, offset)
+    corrected = apply_bg_correction(fg_means, params)
+    return np.round(corrected, 1, out=corrected), params
+
+
+def _update_container_noob(container, noob_green, noob_red, params_green, params_red, nonlinear_dye_correction, debug=False):
+    """ writes noob_green/noob_red back into the SigSet; shared by both NOOB implementations. """
     # by default, this last step is omitted for sesame
     if nonlinear_dye_correction == True:
         # update() expects noob_red/green to have IlmnIDs in index, and contain bg_corrected for ALL probes.
@@ -179,42 +260,87 @@ def normexp_bg_correct_control(control_probes, params):
     return control_probes
 
 
-def apply_bg_correction(mean_values, params):
-    """ this function won't work with float16 in practice (underflow). limits use to float32 """
+def apply_bg_correction(mean_values, params, out=None):
+    """ this function won't work with float16 in practice (underflow). limits use to float32
+
+    returns a numpy array of background-corrected signal, written into `out` if provided.
+    (see normexp_signal for the closed-form kernel; this wrapper unpacks a BackgroundCorrectionParams) """
     if not isinstance(params, BackgroundCorrectionParams):
         raise ValueError('params is not a BackgroundCorrectionParams instance')
-
-    np.seterr(under='ignore') # 'raise to explore fixing underflow warning here'
-
-    bg_mean = params.bg_mean #mu
-    bg_mad = params.bg_mad #sigma
-    mean_signal = params.mean_signal #alpha
-    offset = params.offset
-
-    mu_sf = mean_values - bg_mean - (bg_mad ** 2) / mean_signal
-
-    #try:
-    #    signal_part_one = mu_sf + (bg_mad ** 2)
-    #    signal_part_two = np.exp(norm(mu_sf, bg_mad).logpdf(0) - norm(mu_sf, bg_mad).logsf(0))
-    #    signal = signal_part_one * signal_part_two
-    #except:
-    #    print(signal_part_one, norm(mu_sf, bg_mad).logpdf(0),  norm(mu_sf, bg_mad).logsf(0))
-    # norm is from scipy.stats
-    signal = mu_sf + (bg_mad ** 2) * np.exp(norm(mu_sf, bg_mad).logpdf(0) - norm(mu_sf, bg_mad).logsf(0))
-
-    """ COMPARE with sesame:
+    return normexp_signal(mean_values, params.bg_mean, params.bg_mad, params.mean_signal, params.offset, out=out)
+
+
+def apply_bg_correction_batch(mean_values, params, out=None):
+    """ batched form of apply_bg_correction for a (samples x probes) matrix of intensities.
+
+    - params is a list of BackgroundCorrectionParams, one per row (sample) of mean_values.
+    - returns a (samples x probes) numpy array, written into `out` if provided. """
+    if any(not isinstance(param, BackgroundCorrectionParams) for param in params):
+        raise ValueError('params must be a list of BackgroundCorrectionParams instances')
+    mean_values = np.asarray(mean_values)
+    if mean_values.ndim != 2 or mean_values.shape[0] != len(params):
+        raise ValueError(f'mean_values must be (samples x probes) with one row per params; got {mean_values.shape} for {len(params)} params')
+    return normexp_signal(mean_values,
+        np.array([param.bg_mean for param in params], dtype='float64'),
+        np.array([param.bg_mad for param in params], dtype='float64'),
+        np.array([param.mean_signal for param in params], dtype='float64'),
+        np.array([param.offset for param in params], dtype='float64'),
+        out=out)
+
+
+def normexp_signal(mean_values, bg_mean, bg_mad, mean_signal, offset, out=None):
+    """ closed-form normal-exponential convolution: the expected true signal given an observed intensity.
+
+    Same math as the scipy.stats version used before v1.7.2, without building frozen norm() distributions:
+        signal = mu_sf + sigma^2 * exp( norm.logpdf(0; mu_sf, sigma) - norm.logsf(0; mu_sf, sigma) )
+    With t = mu_sf / sigma, the exp() term is the inverse Mills ratio phi(t)/Phi(t) / sigma, and
+        phi(t)/Phi(t) == sqrt(2/pi) / erfcx(-t/sqrt(2))
+    which is one scaled complementary error function call, and stays finite for very low/high intensities.
+
+    mean_values
+        1-D array of intensities with scalar parameters, or a 2-D (samples x probes) array where
+        bg_mean, bg_mad, mean_signal and offset are vectors with one value per sample (row).
+    out
+        optional preallocated float32 or float64 array (same shape as mean_values) to write into.
+        Computation runs in the precision of `out`; default is a new float64 array.
+
+    COMPARE with sesame:
     signal <- mu.sf + sigma2 * exp(
         dnorm(0, mean = mu.sf, sd = sigma, log = TRUE) -
             pnorm(
                 0, mean = mu.sf, sd = sigma,
                 lower.tail = FALSE, log.p = TRUE))
     """
-
+    mean_values = np.asarray(mean_values)
+    if out is None:
+        out = np.empty(mean_values.shape, dtype='float64')
+    elif out.dtype not in (np.float32, np.float64):
+        raise ValueError(f'out must be a float32 or float64 array, not {out.dtype}')
+    elif out.shape != mean_values.shape:
+        raise ValueError(f'out has shape {out.shape}; expected {mean_values.shape}')
+    dtype = out.dtype
+    # per-sample parameter vectors broadcast down the rows of a (samples x probes) matrix
+    params = [np.asarray(param, dtype=dtype) for param in (bg_mean, bg_mad, mean_signal, offset)]
+    if mean_values.ndim == 2:
+        params = [param.reshape(-1, 1) if param.ndim == 1 else param for param in params]
+    mu, sigma, alpha, offset = params
+    sigma2 = sigma * sigma
+
+    with np.errstate(under='ignore', over='ignore'): # erfcx overflows to inf for bright probes, where the ratio is 0.
+        # out <- mu_sf
+        np.subtract(mean_values, mu, out=out, dtype=dtype, casting='unsafe')
+        out -= sigma2 / alpha
+        # t <- sigma * phi(t)/Phi(t)
+        t = np.divide(out, sigma, dtype=dtype)
+        t *= -_SQRT_HALF
+        special.erfcx(t, out=t)
+        np.divide(_SQRT_2_OVER_PI * sigma, t, out=t)
+        out += t
     # sesame: "Limit of numerical accuracy reached with very low intensity or very high background:
     # setting adjusted intensities to small value"
-    signal = np.maximum(signal, 1e-6)
-    true_signal = signal + offset
-    return true_signal
+    np.maximum(out, 1e-6, out=out)
+    out += offset
+    return out
 
 
 def huber(vector):
@@ -277,24 +403,11 @@ def _apply_sesame_quality_mask(data_container):
         ArrayType.ILLUMINA_MOUSE):
         LOGGER.info(f"Quality masking is not supported for {data_container.array_type}.")
         return
-    # load set of probes to remove from local file
-    if data_container.array_type == ArrayType.ILLUMINA_450K:
-        probes = qualityMask450
-    elif data_container.array_type == ArrayType.ILLUMINA_EPIC:
-        probes = qualityMaskEPIC
-    elif data_container.array_type == ArrayType.ILLUMINA_EPIC_PLUS:
-        # this is a bit of a hack; probe names don't match epic, so I'm temporarily renaming, then filtering, then reverting.
-        probes = qualityMaskEPICPLUS
-    elif data_container.array_type == ArrayType.ILLUMINA_MOUSE:
-        probes = qualityMaskmouse
-
     # v1.6+: the 1.0s are good probes and the 0.0 are probes to be excluded.
-    cgs = pd.DataFrame( np.zeros((len(data_container.man.index), 1)), index=data_container.man.index, columns=['quality_mask'])
-    cgs['quality_mask'] = 1.0
-    snps = pd.DataFrame( np.zeros((len(data_container.snp_man.index), 1)), index=data_container.snp_man.index, columns=['quality_mask'])
-    snps['quality_mask'] = 1.0
-    df = pd.concat([cgs, snps])
-    df.loc[df.index.isin(probes), 'quality_mask'] = 0
+    # v1.7.2: the mask file is read on first use and cached as a boolean array in manifest probe order.
+    probes = data_container.man.index.append(data_container.snp_man.index)
+    excluded = quality_mask_excluded(data_container.array_type, probes)
+    df = pd.DataFrame({'quality_mask': np.where(excluded, 0.0, 1.0)}, index=probes)
     #LOGGER.info(f"DEBUG quality_mask: {df.shape}, {df['quality_mask'].value_counts()} from {probes.shape} probes")
     return df
 
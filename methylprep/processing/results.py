@@ -0,0 +1,91 @@
+# Lib
+import logging
+import numpy as np
+import pandas as pd
+
+__all__ = ['ProcessedSample', 'SharedProbeIndex']
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SharedProbeIndex():
+    """Hands out one pandas Index object for every sample with the same probes, so a list of ProcessedSamples
+    holds the (large, string) probe names once per array type instead of once per sample."""
+
+    def __init__(self):
+        self._indexes = {} # (length, first, last probe) -> [Index, ...]
+
+    def get(self, index):
+        if len(index) == 0:
+            return index
+        candidates = self._indexes.setdefault((len(index), index[0], index[-1]), [])
+        for shared in candidates:
+            if shared is index or shared.equals(index):
+                return shared
+        candidates.append(index)
+        return index
+
+
+def _compact(values):
+    """ float64 values as float32 (or integers as the smallest unsigned type), only where that is lossless """
+    if values.dtype == np.float64:
+        narrow = values.astype(np.float32)
+        if np.array_equal(narrow, values, equal_nan=True):
+            return narrow
+    elif values.dtype.kind in 'iu' and len(values) and values.min() >= 0:
+        return values.astype(np.min_scalar_type(values.max()))
+    return values
+
+
+class ProcessedSample():
+    """The result of processing one sample: its final per-probe values, without the intermediate SigSet parts that a
+    SampleDataContainer keeps. What run_pipeline(..., results='samples') returns, one per sample.
+
+    - sample: the Sample (sample sheet row: name, sentrix_id, sentrix_position and other metadata)
+    - probes: the probe names (a pandas Index), shared by every sample processed with the same manifest
+    - values: {column: 1-D numpy array aligned to probes} -- noob_meth, noob_unmeth, beta_value, m_value,
+      poobah_pval, quality_mask, and meth / unmeth if saved. float64 columns are kept as float32 where that is exact.
+    - quality_mask: whether the sesame quality mask was applied (consolidate_values filters on it)
+    - mouse_data_frame: mouse-specific probes, for mouse arrays (otherwise None)
+
+    sample.data_frame (or sample['beta_value'] for one column) builds the same DataFrame as a SampleDataContainer's
+    data_frame, on demand. consolidate_values and consolidate_values_for_sheet accept a list of these.
+    """
+    __slots__ = ('sample', 'probes', 'values', 'quality_mask', 'mouse_data_frame')
+
+    def __init__(self, sample, probes, values, quality_mask=False, mouse_data_frame=None):
+        self.sample = sample
+        self.probes = probes
+        self.values = values
+        self.quality_mask = quality_mask
+        self.mouse_data_frame = mouse_data_frame
+
+    @classmethod
+    def from_container(cls, container, shared_index=None):
+        """ a ProcessedSample of a processed SampleDataContainer; pass a SharedProbeIndex to share probe names
+        with the other samples built with it. """
+        frame = container.data_frame
+        probes = shared_index.get(frame.index) if shared_index is not None else frame.index
+        values = {column: _compact(frame[column].to_numpy()) for column in frame.columns}
+        mouse = container.mouse_data_frame if getattr(container, 'mouse_data_frame', None) is not None and len(container.mouse_data_frame) else None
+        return cls(container.sample, probes, values, quality_mask=container.quality_mask == True, mouse_data_frame=mouse)
+
+    @property
+    def sample_id(self):
+        return f"{self.sample.sentrix_id}_{self.sample.sentrix_position}"
+
+    @property
+    def data_frame(self):
+        """ probes x columns DataFrame of this sample's values (built each time it is read) """
+        return pd.DataFrame(self.values, index=self.probes)
+
+    def __getitem__(self, column):
+        return pd.Series(self.values[column], index=self.probes, name=column)
+
+    @property
+    def nbytes(self):
+        """ bytes of the value arrays (not counting the shared probe index) """
+        return sum(values.nbytes for values in self.values.values())
+
+    def __repr__(self):
+        return f"ProcessedSample({self.sample_id}: {len(self.probes)} probes; {', '.join(self.values)})"
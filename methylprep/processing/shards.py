@@ -0,0 +1,189 @@
+# Lib
+from contextlib import contextmanager
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import socket
+import threading
+import uuid
+# App
+from .outputs import ProcessedOutputs
+from ..version import __version__
+
+__all__ = ['ShardQueue']
+
+LOGGER = logging.getLogger(__name__)
+
+SHARD_DIR = '.methylprep_shards'
+DEFAULT_SHARD_SIZE = 16
+DEFAULT_LEASE = 1800 # seconds
+
+
+def _create_atomically(path, text):
+    """ creates path with this text, only if it does not exist yet: True if this call created it.
+    The file is written under a temporary name and hard-linked into place, which is atomic (and fails if the file
+    exists) on local disks, NFS and Lustre alike; readers never see a partly written file. """
+    temp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(temp, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    try:
+        os.link(temp, path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        temp.unlink()
+
+
+class ShardQueue():
+    """The work queue behind run_pipeline(shard='auto') / methylprep process --shard auto: any number of workers, on
+    any nodes that mount data_dir, share a run's samples without a coordinator, through files in data_dir/.methylprep_shards:
+
+        - plan.json: the shards (lists of sample ids) and a hash of the processing parameters, saved by the first
+          worker. Workers with other parameters or samples are refused.
+        - claims/{shard}.g{n}: a worker's claim on a shard (or on 'finalize'), created atomically, so each is won by
+          one worker. The owner touches it every lease/4 seconds; a claim not touched for `lease` seconds belongs to a
+          dead worker, and the next claim (generation n+1) takes the shard over.
+        - outputs/{shard}.g{n}/: the outputs of that claim's run_pipeline.
+        - done/{shard}.json: the finished shard's outputs. The first claim to finish a shard wins; a late copy is discarded.
+        - finished.json: the merged outputs in data_dir, saved by the worker that merged them.
+
+    Ages are measured with the shared filesystem's clock (the modification time of a file just touched), not the
+    worker's, so nodes with skewed clocks agree on when a claim expires.
+    """
+
+    def __init__(self, data_dir, lease=DEFAULT_LEASE):
+        self.data_dir = Path(data_dir)
+        self.path = Path(data_dir, SHARD_DIR)
+        self.lease = lease
+        self.worker = f"{socket.gethostname()}.{os.getpid()}.{uuid.uuid4().hex[:8]}"
+        self.shards = []
+        self.path.mkdir(exist_ok=True)
+
+    def open(self, shards, params):
+        """ joins the queue: saves the plan if this is the first worker, otherwise checks that it is the same.
+        shards is a list of lists of sample ids; params the processing parameters, which must match. """
+        params_hash = hashlib.sha256(json.dumps({'shards': shards, 'params': params, 'methylprep_version': __version__},
+            sort_keys=True, default=str).encode()).hexdigest()
+        plan_path = Path(self.path, 'plan.json')
+        if _create_atomically(plan_path, json.dumps({'hash': params_hash, 'shards': shards})):
+            LOGGER.info(f"Split {sum(len(shard) for shard in shards)} samples into {len(shards)} shards in {self.path}")
+        with open(plan_path) as f:
+            plan = json.load(f)
+        if plan['hash'] != params_hash:
+            raise ValueError(f"The shards in {self.path} were started with other processing parameters or samples. "
+                "Run every worker with the same options, or remove that folder to start over.")
+        self.shards = plan['shards']
+        if not Path(self.path, 'finished.json').exists():
+            for folder in ('claims', 'outputs', 'done'):
+                Path(self.path, folder).mkdir(exist_ok=True)
+        return self.shards
+
+    def shard_name(self, number):
+        return f"shard_{number:05d}"
+
+    def _now(self):
+        clock = Path(self.path, f".clock.{self.worker}")
+        clock.touch()
+        try:
+            return clock.stat().st_mtime
+        finally:
+            clock.unlink()
+
+    def _generations(self, name):
+        return sorted(int(claim.suffix[2:]) for claim in Path(self.path, 'claims').glob(f"{name}.g*") if claim.suffix[2:].isdigit())
+
+    def claim(self, name):
+        """ claims a shard (by shard_name) or 'finalize' for this worker: returns the claim's path, or None if another
+        worker holds a live claim on it or won it first """
+        generations = self._generations(name)
+        generation = 0
+        if generations:
+            current = Path(self.path, 'claims', f"{name}.g{generations[-1]}")
+            try:
+                age = self._now() - current.stat().st_mtime
+            except FileNotFoundError:
+                return None
+            if age <= self.lease:
+                return None
+            with open(current) as f:
+                owner = json.load(f).get('worker')
+            LOGGER.warning(f"Taking over {name} from worker {owner}, which has not renewed its claim for {age:.0f}s")
+            generation = generations[-1] + 1
+        claim = Path(self.path, 'claims', f"{name}.g{generation}")
+        if not _create_atomically(claim, json.dumps({'worker': self.worker})):
+            return None
+        return claim
+
+    def output_dir(self, claim):
+        output_dir = Path(self.path, 'outputs', claim.name)
+        output_dir.mkdir(exist_ok=True)
+        return output_dir
+
+    @contextmanager
+    def heartbeat(self, claim):
+        """ renews the claim every lease/4 seconds, in a thread, while the block runs """
+        stop = threading.Event()
+        def renew():
+            while not stop.wait(self.lease / 4):
+                try:
+                    os.utime(claim)
+                except OSError as e:
+                    LOGGER.warning(f"Could not renew the claim {claim}: {e}")
+        thread = threading.Thread(target=renew, name='methylprep-shard-heartbeat', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def is_done(self, number):
+        return Path(self.path, 'done', f"{self.shard_name(number)}.json").exists()
+
+    def all_done(self):
+        return all(self.is_done(number) for number in range(len(self.shards)))
+
+    def mark_done(self, number, claim, outputs):
+        """ records a shard's outputs (a ProcessedOutputs); False if another claim finished the shard first """
+        record = {
+            'claim': claim.name,
+            'worker': self.worker,
+            'paths': {name: [str(Path(path).relative_to(self.path)) for path in paths] for name, paths in outputs.paths.items()},
+            'formats': outputs.formats,
+        }
+        return _create_atomically(Path(self.path, 'done', f"{self.shard_name(number)}.json"), json.dumps(record))
+
+    def _load_outputs(self, record, root):
+        return ProcessedOutputs({name: [Path(root, path) for path in paths] for name, paths in record['paths'].items()},
+            record['formats'])
+
+    def done_outputs(self):
+        """ a ProcessedOutputs of each shard's outputs, in shard order """
+        runs = []
+        for number in range(len(self.shards)):
+            with open(Path(self.path, 'done', f"{self.shard_name(number)}.json")) as f:
+                runs.append(self._load_outputs(json.load(f), self.path))
+        return runs
+
+    def finished(self):
+        """ the merged outputs, once a worker has saved them; otherwise None """
+        try:
+            with open(Path(self.path, 'finished.json')) as f:
+                return self._load_outputs(json.load(f), self.data_dir)
+        except FileNotFoundError:
+            return None
+
+    def finish(self, merged):
+        """ records the merged outputs (in data_dir), then removes the shards' outputs and claims """
+        record = {'worker': self.worker,
+            'paths': {name: [str(Path(path).relative_to(self.data_dir)) for path in paths] for name, paths in merged.paths.items()},
+            'formats': merged.formats}
+        _create_atomically(Path(self.path, 'finished.json'), json.dumps(record))
+        for folder in ('outputs', 'claims'):
+            shutil.rmtree(Path(self.path, folder), ignore_errors=True)
@@ -0,0 +1,194 @@
+# Lib
+from io import BytesIO
+import json
+import logging
+import os
+from pathlib import Path
+import time
+import pandas as pd
+# App
+from ..files import Manifest, IdatDataset, SampleSheet, find_sample_sheet
+from ..files.sample_sheets import SampleSubset
+from ..models import ArrayType
+from .pipeline import run_pipeline
+
+__all__ = ['watch_pipeline', 'find_ready_samples']
+
+LOGGER = logging.getLogger(__name__)
+
+WATCH_STATE = '.methylprep_watch.json'
+DEFAULT_WATCH_BATCH = 16
+
+
+def find_ready_samples(data_dir, settle=60):
+    """ {sample id (sentrix_id_position): Grn IDAT path} for each sample in data_dir (or sub-folders) that has both
+    channel IDATs, neither of which has been written to for `settle` seconds: a scanner has finished saving them. """
+    now = time.time()
+    ready = {}
+    for grn in Path(data_dir).rglob('*_Grn.idat*'):
+        if grn.suffix not in ('.idat', '.gz'):
+            continue
+        red = grn.with_name(grn.name.replace('_Grn.idat', '_Red.idat'))
+        try:
+            stats = [grn.stat(), red.stat()]
+        except FileNotFoundError:
+            continue
+        if any(stat.st_size == 0 or now - stat.st_mtime < settle for stat in stats):
+            continue
+        parts = grn.name.split('_Grn.idat')[0].split('_')
+        if len(parts) < 2:
+            LOGGER.warning(f"watch: can't tell the Sentrix ID and position of {grn}; expected names like 200000000000_R01C01_Grn.idat")
+            continue
+        ready[f"{parts[-2]}_{parts[-1]}"] = grn
+    return ready
+
+
+def watch_pipeline(data_dir, poll_interval=30, settle=60, idle_timeout=None, batch_size=None, sample_name=None,
+    sample_sheet_filepath=None, array_type=None, manifest_filepath=None, **kwargs):
+    """Processes the IDATs in data_dir as a scanner saves them, adding each sample to the usual outputs in data_dir
+    (beta_values.pkl, ...) as run_pipeline(append=True) does. This is `methylprep process --watch`.
+
+    Every poll_interval seconds, data_dir is searched for samples with both a Grn and a Red IDAT, neither modified for
+    `settle` seconds, that are not in the outputs yet. These are processed in runs of up to batch_size samples (16 by
+    default), so a sample is in the outputs about settle + poll_interval + one run's time after its scan ends. The
+    manifest is loaded once, and cache_dir (if given) is shared by the runs.
+
+    If data_dir has a sample sheet, it is read again each time, and only its samples are processed (with its names and
+    meta data); otherwise samples are named by their sentrix_id_position. Processed and failed samples are listed in
+    data_dir/.methylprep_watch.json, so a restarted watch continues where it stopped; a sample that failed is only
+    retried once its IDATs change. The saved outputs are the record of what is done, so deleting that file is safe.
+
+    Arguments:
+        poll_interval -- seconds between searches of data_dir.
+        settle -- seconds an IDAT must be unchanged to be considered complete.
+        idle_timeout -- if set, stop once no new samples were ready for this many seconds; otherwise run until
+            interrupted (Ctrl-C).
+        everything else is passed to run_pipeline (betas, export, file_format, cache_dir, n_jobs, ...); data_dir should
+            hold one array type.
+
+    Returns the ProcessedOutputs of the last run that added samples (None if there were none)."""
+    for option in ('append', 'shard', 'make_sample_sheet'):
+        if kwargs.pop(option, None):
+            raise ValueError(f"watch_pipeline can't be combined with {option}")
+    kwargs.pop('results', None) # always 'files': the outputs are read back when needed
+    if batch_size is not None and (not isinstance(batch_size, int) or batch_size < 1):
+        raise ValueError('batch_size must be an integer greater than 0')
+    run_size = batch_size or DEFAULT_WATCH_BATCH
+    state = _load_state(data_dir)
+    manifest = None
+    outputs = None
+    last_activity = time.time()
+    LOGGER.info(f"watch: waiting for IDATs in {data_dir} (every {poll_interval}s; files unchanged for {settle}s are complete)")
+    while True:
+        ready = find_ready_samples(data_dir, settle=settle)
+        sample_sheet = _watch_sample_sheet(data_dir, sample_sheet_filepath, ready)
+        new_samples = []
+        for sample in sample_sheet.get_samples():
+            sample_id = f"{sample.sentrix_id}_{sample.sentrix_position}"
+            if (sample_id not in ready or sample_id in state['processed'] or (sample_name and sample.name not in sample_name)
+                or state['failed'].get(sample_id) == _idat_signature(ready[sample_id])):
+                continue
+            if sample.name in (None, ''):
+                sample.name = sample_id # stable across runs, unlike Sample_1, Sample_2, ...
+            new_samples.append(sample)
+        if new_samples:
+            last_activity = time.time()
+            if manifest is None:
+                array_type = array_type or ArrayType.from_probe_count(IdatDataset.read_probe_count(ready[_sample_id(new_samples[0])]))
+                manifest = Manifest(array_type, manifest_filepath)
+            new_samples = _same_array_type(data_dir, new_samples, ready, manifest, state)
+            for start in range(0, len(new_samples), run_size):
+                run_outputs = _process_new_samples(data_dir, sample_sheet, new_samples[start:start + run_size], ready,
+                    state, dict(kwargs, array_type=manifest.array_type, manifest_filepath=manifest_filepath, manifest=manifest))
+                outputs = run_outputs or outputs
+            continue # more may have settled while these were processed
+        if idle_timeout is not None and time.time() - last_activity >= idle_timeout:
+            LOGGER.info(f"watch: no new samples for {idle_timeout}s; stopping")
+            return outputs
+        time.sleep(poll_interval)
+
+
+def _process_new_samples(data_dir, sample_sheet, samples, ready, state, run_kwargs):
+    """ adds these samples to data_dir's outputs in one run; if that fails, each is tried on its own, so one bad scan
+    does not hold back the others. Returns the run's ProcessedOutputs, or None if nothing was added. """
+    try:
+        outputs = run_pipeline(data_dir, append=True, results='files', sample_sheet=SampleSubset([(sample_sheet, samples)]), **run_kwargs)
+    except Exception as e:
+        if len(samples) > 1:
+            LOGGER.warning(f"watch: processing {len(samples)} samples failed ({e}); trying each on its own")
+            outputs = None
+            for sample in samples:
+                outputs = _process_new_samples(data_dir, sample_sheet, [sample], ready, state, run_kwargs) or outputs
+            return outputs
+        sample_id = _sample_id(samples[0])
+        LOGGER.error(f"watch: could not process {samples[0].name} ({sample_id}): {e}; it is retried if its IDATs change")
+        state['failed'][sample_id] = _idat_signature(ready[sample_id])
+        _save_state(data_dir, state)
+        return None
+    for sample in samples:
+        state['processed'].add(_sample_id(sample))
+        state['failed'].pop(_sample_id(sample), None)
+    _save_state(data_dir, state)
+    LOGGER.info(f"watch: added {len(samples)} samples to the outputs in {data_dir} ({len(state['processed'])} in all)")
+    return outputs
+
+
+def _same_array_type(data_dir, samples, ready, manifest, state):
+    """ drops (and records as failed) samples whose IDATs are another array type than the manifest's """
+    kept = []
+    for sample in samples:
+        sample_id = _sample_id(sample)
+        try:
+            sample_type = ArrayType.from_probe_count(IdatDataset.read_probe_count(ready[sample_id]))
+        except ValueError as e:
+            sample_type = e
+        if sample_type == manifest.array_type or manifest.array_type == ArrayType.CUSTOM:
+            kept.append(sample)
+            continue
+        LOGGER.error(f"watch: {sample.name} ({sample_id}) is {sample_type}, not {manifest.array_type} like the other samples; skipping it")
+        state['failed'][sample_id] = _idat_signature(ready[sample_id])
+    if len(kept) < len(samples):
+        _save_state(data_dir, state)
+    return kept
+
+
+def _watch_sample_sheet(data_dir, sample_sheet_filepath, ready):
+    """ data_dir's sample sheet, or a sheet of the ready samples if it has none """
+    if not sample_sheet_filepath:
+        try:
+            sample_sheet_filepath = find_sample_sheet(data_dir)
+        except FileNotFoundError:
+            sample_sheet_filepath = None
+    if sample_sheet_filepath:
+        return SampleSheet(sample_sheet_filepath, Path(sample_sheet_filepath).parent)
+    rows = [{'Sample_Name': sample_id, 'Sentrix_ID': sample_id.split('_')[0], 'Sentrix_Position': sample_id.split('_')[1]}
+        for sample_id in sorted(ready)]
+    sheet_csv = pd.DataFrame(rows, columns=['Sample_Name', 'Sentrix_ID', 'Sentrix_Position']).to_csv(index=False)
+    return SampleSheet(BytesIO(sheet_csv.encode()), data_dir)
+
+
+def _sample_id(sample):
+    return f"{sample.sentrix_id}_{sample.sentrix_position}"
+
+
+def _idat_signature(grn):
+    """ changes whenever either IDAT of the sample is replaced """
+    red = grn.with_name(grn.name.replace('_Grn.idat', '_Red.idat'))
+    return [[path.stat().st_size, path.stat().st_mtime_ns] for path in (grn, red)]
+
+
+def _load_state(data_dir):
+    try:
+        with open(Path(data_dir, WATCH_STATE)) as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        saved = {}
+    return {'processed': set(saved.get('processed', [])), 'failed': saved.get('failed', {})}
+
+
+def _save_state(data_dir, state):
+    path = Path(data_dir, WATCH_STATE)
+    temp = path.with_name(f"{path.name}.tmp")
+    with open(temp, 'w') as f:
+        json.dump({'processed': sorted(state['processed']), 'failed': state['failed']}, f)
+    os.replace(temp, path)
@@ -0,0 +1,227 @@
+# Lib
+from contextlib import contextmanager
+import json
+import logging
+import os
+from pathlib import Path
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+__all__ = [
+    'StageProfiler',
+    'profile_stage',
+    'profiling_sample',
+    'start_profiling',
+    'stop_profiling',
+    'active_profiler',
+    'peak_rss_mb',
+]
+
+LOGGER = logging.getLogger(__name__)
+
+_ACTIVE = None # the StageProfiler of this process, while run_pipeline(profile=...) runs
+
+
+def _read_hwm():
+    """ this process's peak resident memory (bytes) since it started, or since the last _reset_hwm() """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError: # windows
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 # macos reports bytes, linux KB
+
+
+def _reset_hwm():
+    """ restarts the VmHWM peak from the current RSS (linux 4.0+); returns False where that isn't possible """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def peak_rss_mb(children=False):
+    """ peak resident memory of this process (MB) since it started; children=True adds finished child processes' peak """
+    peak = _read_hwm() if _ACTIVE is None else max(_read_hwm(), _ACTIVE.process_peak)
+    if children:
+        try:
+            import resource
+            child = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            peak = max(peak, child if sys.platform == 'darwin' else child * 1024)
+        except ImportError:
+            pass
+    return peak / 2**20
+
+
+class StageProfiler():
+    """Records wall time, CPU time and peak memory of each pipeline stage, for each sample.
+
+    run_pipeline(profile=True) starts one per process (and one in each n_jobs worker, whose records come back with
+    each sample). Stages are marked in the pipeline code with `with profile_stage('noob'):`, which does nothing
+    when profiling is off. Each record is one stage of one sample (or of a batch, for batch-level stages):
+        stage, sample, batch, pid, wall_s, cpu_s, peak_rss_mb, rss_delta_mb
+    peak_rss_mb is the most resident memory the process used during the stage; on linux, the peak is reset at the
+    start of every stage, elsewhere it is the process's peak so far.
+    """
+
+    def __init__(self):
+        self.records = []
+        self.sample = None # set by profiling_sample()
+        self.batch = None
+        self.process_peak = 0 # _reset_hwm() forgets the peak, so it is kept here
+        self._open = [] # peaks of the stages in progress (nested stages)
+        self._started = time.perf_counter()
+
+    def _update_peaks(self):
+        peak = _read_hwm()
+        self.process_peak = max(self.process_peak, peak)
+        for stage in self._open:
+            stage['peak'] = max(stage['peak'], peak)
+
+    @contextmanager
+    def stage(self, name, sample=None):
+        self._update_peaks()
+        _reset_hwm()
+        stage = {'peak': 0}
+        self._open.append(stage)
+        rss = _current_rss()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            cpu = time.process_time() - cpu
+            wall = time.perf_counter() - wall
+            self._update_peaks()
+            self._open.remove(stage)
+            _reset_hwm()
+            self.records.append({
+                'stage': name,
+                'sample': str(sample) if sample is not None else (str(self.sample) if self.sample is not None else None),
+                'batch': self.batch,
+                'pid': os.getpid(),
+                'wall_s': wall,
+                'cpu_s': cpu,
+                'peak_rss_mb': stage['peak'] / 2**20,
+                'rss_delta_mb': (_current_rss() - rss) / 2**20,
+            })
+
+    def drain(self):
+        """ returns and forgets the records so far (pool workers send them back with each sample) """
+        records, self.records = self.records, []
+        return records
+
+    def frame(self):
+        records = pd.DataFrame(self.records, columns=['stage', 'sample', 'batch', 'pid', 'wall_s', 'cpu_s', 'peak_rss_mb', 'rss_delta_mb'])
+        return records.astype({'batch': 'Int64'}) # stages after the last batch have none
+
+    def summary(self, batch=None):
+        """ {stage: count, wall and cpu totals, wall time mean/p50/p90/p99/max, peak_rss_mb max}, in pipeline order;
+        for one batch if given """
+        records = self.frame()
+        if batch is not None:
+            records = records[records['batch'] == batch]
+        summary = {}
+        for stage, rows in records.groupby('stage', sort=False):
+            wall = rows['wall_s'].to_numpy()
+            p50, p90, p99 = np.percentile(wall, [50, 90, 99])
+            summary[stage] = {
+                'count': int(len(rows)),
+                'wall_s_total': float(wall.sum()),
+                'cpu_s_total': float(rows['cpu_s'].sum()),
+                'wall_s_mean': float(wall.mean()),
+                'wall_s_p50': float(p50),
+                'wall_s_p90': float(p90),
+                'wall_s_p99': float(p99),
+                'wall_s_max': float(wall.max()),
+                'peak_rss_mb': float(rows['peak_rss_mb'].max()),
+            }
+        return summary
+
+    def batch_summary(self, batch):
+        """ one line: each stage's share of this batch's stage time """
+        summary = self.summary(batch)
+        total = sum(stage['wall_s_total'] for stage in summary.values()) or 1
+        return ' | '.join(f"{stage} {values['wall_s_total']:.1f}s ({100 * values['wall_s_total'] / total:.0f}%)"
+            for stage, values in sorted(summary.items(), key=lambda item: -item[1]['wall_s_total']))
+
+    def write_report(self, filepath):
+        """ saves the summary and every record as {filepath}.json, and the records as {filepath}.csv; returns both paths """
+        filepath = Path(filepath)
+        if filepath.suffix in ('.json', '.csv'):
+            filepath = filepath.with_suffix('')
+        records = self.frame()
+        samples = records[records['sample'].notna()].groupby('sample', sort=False).agg(
+            wall_s=('wall_s', 'sum'), cpu_s=('cpu_s', 'sum'), peak_rss_mb=('peak_rss_mb', 'max'))
+        report = {
+            'wall_s': time.perf_counter() - self._started,
+            'cpu_s': time.process_time(),
+            'peak_rss_mb': peak_rss_mb(children=True),
+            'stages': self.summary(),
+            'samples': samples.to_dict(orient='index'),
+            'records': self.records,
+        }
+        json_path = Path(f"{filepath}.json")
+        csv_path = Path(f"{filepath}.csv")
+        with open(json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        records.to_csv(csv_path, index=False)
+        return json_path, csv_path
+
+
+def start_profiling():
+    global _ACTIVE
+    _ACTIVE = StageProfiler()
+    return _ACTIVE
+
+
+def stop_profiling():
+    global _ACTIVE
+    profiler, _ACTIVE = _ACTIVE, None
+    return profiler
+
+
+def active_profiler():
+    return _ACTIVE
+
+
+@contextmanager
+def profile_stage(name, sample=None):
+    """ marks a pipeline stage for the active StageProfiler; does nothing when not profiling """
+    if _ACTIVE is None:
+        yield
+        return
+    with _ACTIVE.stage(name, sample):
+        yield
+
+
+@contextmanager
+def profiling_sample(sample):
+    """ attributes the stages inside to this sample """
+    if _ACTIVE is None:
+        yield
+        return
+    previous, _ACTIVE.sample = _ACTIVE.sample, sample
+    try:
+        yield
+    finally:
+        _ACTIVE.sample = previous
@@ -0,0 +1,28 @@
+import subprocess
+import sys
+import pandas as pd
+import pytest
+# App
+from methylprep.models import ArrayType
+from methylprep.models import sketchy_probes
+
+
+def test_quality_masks_are_not_read_at_import():
+    code = "import methylprep; from methylprep.models import sketchy_probes; print(len(sketchy_probes._loaded_masks))"
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == '0'
+
+
+def test_quality_mask_excluded_is_aligned_and_cached():
+    masked = list(sketchy_probes.qualityMask450[:3]) # lazy module attribute
+    index = pd.Index(['cg_not_masked', masked[0], masked[1], 'rs_not_masked', masked[2]], name='IlmnID')
+    excluded = sketchy_probes.quality_mask_excluded(ArrayType.ILLUMINA_450K, index)
+    assert excluded.tolist() == [False, True, True, False, True]
+    # an equal index (as each sample's SigSet builds) reuses the cached array
+    assert sketchy_probes.quality_mask_excluded(ArrayType.ILLUMINA_450K, index.copy()) is excluded
+    other = sketchy_probes.quality_mask_excluded(ArrayType.ILLUMINA_450K, index[:2])
+    assert other.tolist() == [False, True]
+    with pytest.raises(ValueError):
+        sketchy_probes.quality_mask_excluded(ArrayType.ILLUMINA_27K, index)
+    with pytest.raises(AttributeError):
+        sketchy_probes.qualityMask27k
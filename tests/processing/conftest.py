@@ -0,0 +1,163 @@
+from io import BytesIO
+import struct
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+import pytest
+# App
+from methylprep.files import SampleSheet
+from methylprep.models import ArrayType, Channel
+from methylprep.processing import pipeline
+
+
+class FakeSample():
+    """ the parts of a Sample that the checkpoint and the stage cache read: its id and IDAT paths """
+
+    def __init__(self, data_dir, sentrix_id, sentrix_position='R01C01'):
+        self.data_dir = data_dir
+        self.sentrix_id = sentrix_id
+        self.sentrix_position = sentrix_position
+        for channel in ('Grn', 'Red'):
+            path = self.data_dir / f'{self}_{channel}.idat'
+            if not path.exists():
+                path.write_bytes(f'{self} {channel}'.encode())
+
+    def __str__(self):
+        return f'{self.sentrix_id}_{self.sentrix_position}'
+
+    def get_filepath(self, extension, suffix=None):
+        return self.data_dir / f"{self}_{'Grn' if suffix == Channel.GREEN else 'Red'}.{extension}"
+
+
+@pytest.fixture
+def fake_sample(tmp_path):
+    """ fake_sample(sentrix_id, sentrix_position='R01C01'): a FakeSample with small IDAT files in tmp_path """
+    return lambda sentrix_id, sentrix_position='R01C01': FakeSample(tmp_path, sentrix_id, sentrix_position)
+
+
+def fake_processed_container(sample, seed, probes=50):
+    """ the parts of a processed SampleDataContainer that run_pipeline reads, with random values """
+    rng = np.random.default_rng(seed)
+    index = pd.Index([f'cg{i:08d}' for i in range(probes)] + ['rs0001'], name='IlmnID')
+    frame = pd.DataFrame({
+        'meth': rng.integers(100, 5000, len(index)).astype('float64'),
+        'unmeth': rng.integers(100, 5000, len(index)).astype('float64'),
+        'noob_meth': rng.integers(100, 5000, len(index)).astype('float64'),
+        'noob_unmeth': rng.integers(100, 5000, len(index)).astype('float64'),
+        'poobah_pval': rng.uniform(0, 0.2, len(index)),
+        'quality_mask': np.where(rng.uniform(size=len(index)) < 0.1, np.nan, 1.0),
+    }, index=index)
+    frame['beta_value'] = frame['noob_meth'] / (frame['noob_meth'] + frame['noob_unmeth'] + 100)
+    frame['m_value'] = np.log2(frame['noob_meth'] / frame['noob_unmeth'])
+    return SimpleNamespace(data_frame=frame, sample=sample, quality_mask=True, mouse_data_frame=pd.DataFrame(),
+        noob_processing_missing_probe_errors=[], raw_processing_missing_probe_errors=[])
+
+
+@pytest.fixture
+def stub_pipeline(monkeypatch, tmp_path):
+    """ run_pipeline over n fake samples in tmp_path, without IDATs or a manifest: each sample's processing is
+    replaced by fake_processed_container(), and exports go through the run's ExportWriter like real ones.
+    Returns run(n_samples=3, **run_pipeline options). """
+    def process_sample(idat_dataset_pair, manifest, container_kwargs, export=False, file_format='pickle',
+        save_control=False, low_memory=True, cache=None, writer=None):
+        sample = idat_dataset_pair['sample']
+        container = fake_processed_container(sample, seed=int(sample.sentrix_id[-3:]))
+        output_path = None
+        if export:
+            output_path = tmp_path / f'{sample.sentrix_id}_{sample.sentrix_position}_processed.csv'
+            if writer is None:
+                pipeline._write_export(container.data_frame, None, output_path, 'csv')
+            else:
+                writer.submit(pipeline._write_export, container.data_frame, None, output_path, 'csv')
+        return container, output_path, None
+
+    monkeypatch.setattr(pipeline, '_process_sample', process_sample)
+    monkeypatch.setattr(pipeline, 'parse_sample_sheet_into_idat_datasets',
+        lambda sample_sheet, sample_name=None, **kwargs: [{'sample': sample_sheet.get_sample(name)} for name in sample_name])
+
+    def run(n_samples=3, **options):
+        rows = [{'Sample_Name': f'Sample_{i}', 'Sentrix_ID': f'200000000{i:03d}', 'Sentrix_Position': 'R01C01'}
+            for i in range(n_samples)]
+        sheet = SampleSheet(BytesIO(pd.DataFrame(rows).to_csv(index=False).encode()), tmp_path)
+        return pipeline.run_pipeline(tmp_path, array_type='450k', sample_sheet=sheet,
+            manifest=SimpleNamespace(array_type=ArrayType.ILLUMINA_450K), **options)
+    return run
+
+
+def write_idat(path, addresses, means):
+    """ an IDAT with the sections that IdatDataset reads: probe count, addresses, means, bead counts, run info """
+    sections = {
+        402: bytes([7]) + b'BARCODE',
+        403: bytes([13]) + b'BeadChip 12x1',
+        1000: struct.pack('<i', len(addresses)),
+        107: np.full(len(addresses), 10, dtype='<u1').tobytes(),
+        102: np.asarray(addresses, dtype='<i4').tobytes(),
+        104: np.asarray(means, dtype='<u2').tobytes(),
+        300: struct.pack('<L', 1) + b''.join(bytes([1]) + field.encode() for field in 'tepcv'),
+    }
+    offset = 16 + 10 * len(sections)
+    with open(path, 'wb') as f:
+        f.write(b'IDAT' + struct.pack('<q', 3) + struct.pack('<i', len(sections)))
+        for code, data in sections.items():
+            f.write(struct.pack('<H', code) + struct.pack('<q', offset))
+            offset += len(data)
+        for data in sections.values():
+            f.write(data)
+
+
+@pytest.fixture
+def synthetic_idats(monkeypatch, tmp_path):
+    """ a small 450k-like data set that the real pipeline processes: manifest.csv (1,800 CpG and 20 snp probes, 80
+    controls), a sample sheet and random IDATs for n_samples. Returns make(n_samples=2) -> manifest path; pass it as
+    run_pipeline(tmp_path, array_type='450k', manifest_filepath=...). """
+    rng = np.random.default_rng(0)
+    designs = [('II', None)] * 1000 + [('I', 'Grn')] * 300 + [('I', 'Red')] * 500
+    addresses = iter(rng.permutation(np.arange(10_000_000, 10_010_000)))
+    probes = [(f'cgx{i:07d}', next(addresses), next(addresses) if design == 'I' else None, design, channel)
+        for i, (design, channel) in enumerate(designs)]
+    probes += [(f'rsx{i:07d}', next(addresses), next(addresses), 'I', 'Grn' if i % 2 else 'Red') for i in range(20)]
+    manifest = pd.DataFrame(probes, columns=['IlmnID', 'AddressA_ID', 'AddressB_ID', 'Infinium_Design_Type', 'Color_Channel'])
+    manifest = manifest.astype({'AddressA_ID': 'Int64', 'AddressB_ID': 'Int64'})
+    for column in ['Genome_Build', 'CHR', 'MAPINFO', 'Strand', 'OLD_Genome_Build', 'OLD_CHR', 'OLD_MAPINFO', 'OLD_Strand']:
+        manifest[column] = '1'
+    controls = [(next(addresses), control_type, color, f'{control_type}_{i}') for control_type, color, n in
+        [('NEGATIVE', 'Red', 60), ('NORM_A', 'Red', 4), ('NORM_T', 'Red', 4), ('NORM_C', 'Green', 4),
+         ('NORM_G', 'Green', 4), ('STAINING', 'Red', 2), ('EXTENSION', 'Green', 2)] for i in range(n)]
+    manifest_path = tmp_path / 'manifest.csv'
+    with open(manifest_path, 'w') as f:
+        manifest.to_csv(f, index=False)
+        f.write('[Controls]' + ',' * 12 + '\n')
+        for address, control_type, color, name in controls:
+            f.write(f"{address},{control_type},{color},{name}" + ',' * 9 + '\n')
+    monkeypatch.setattr(ArrayType, 'num_probes', property(lambda self: len(manifest)))
+    monkeypatch.setattr(ArrayType, 'num_controls', property(lambda self: len(controls)))
+    monkeypatch.setattr(ArrayType, 'from_probe_count', classmethod(lambda cls, probe_count: cls.ILLUMINA_450K))
+
+    def make(n_samples=2):
+        rows = []
+        for i in range(n_samples):
+            green, red = {}, {}
+            for probe in manifest.itertuples(index=False):
+                beta, signal = rng.uniform(), rng.exponential(6000)
+                background = rng.normal(400, 120, 4).clip(1)
+                if probe.Infinium_Design_Type == 'II':
+                    green[probe.AddressA_ID] = beta * signal + background[0]
+                    red[probe.AddressA_ID] = (1 - beta) * signal + background[1]
+                    continue
+                in_band, out_of_band = (green, red) if probe.Color_Channel == 'Grn' else (red, green)
+                in_band[probe.AddressA_ID] = (1 - beta) * signal + background[0]
+                in_band[probe.AddressB_ID] = beta * signal + background[1]
+                out_of_band[probe.AddressA_ID], out_of_band[probe.AddressB_ID] = background[2:]
+            for address, control_type, color, _ in controls:
+                signal, background = rng.exponential(6000), rng.normal(400, 120, 2).clip(1)
+                green[address], red[address] = background if control_type == 'NEGATIVE' else (
+                    (signal, background[0]) if color == 'Green' else (background[0], signal))
+            sample_addresses = sorted(green)
+            sentrix_id = f'20000000{i:04d}'
+            for channel, values in (('Grn', green), ('Red', red)):
+                means = np.array([values[address] for address in sample_addresses]).clip(0, 65000).round()
+                write_idat(tmp_path / f'{sentrix_id}_R01C01_{channel}.idat', sample_addresses, means)
+            rows.append({'Sample_Name': f'Sample_{i}', 'Sentrix_ID': sentrix_id, 'Sentrix_Position': 'R01C01'})
+        pd.DataFrame(rows).to_csv(tmp_path / 'samplesheet.csv', index=False)
+        return manifest_path
+    return make
@@ -0,0 +1,61 @@
+import gc
+import os
+import pandas as pd
+# App
+from methylprep.models import ArrayType, Channel
+from methylprep.processing import cache as cache_module
+from methylprep.processing.cache import StageCache, manifest_fingerprint
+
+
+class FakeManifest():
+    def __init__(self, addresses):
+        self.array_type = ArrayType.ILLUMINA_450K
+        self.data_frame = pd.DataFrame({'AddressA_ID': addresses, 'AddressB_ID': addresses}, index=[f'cg{i}' for i in addresses])
+        self.control_data_frame = pd.DataFrame({'Control_Type': ['NEGATIVE']})
+        self.snp_data_frame = pd.DataFrame()
+
+
+def fake_manifest(addresses):
+    return FakeManifest(addresses)
+
+
+def test_stage_cache_keys(tmp_path, fake_sample):
+    cache = StageCache(tmp_path / 'cache')
+    sample = fake_sample('200000000001')
+    manifest = fake_manifest([1, 2, 3])
+    key = cache.key('processed', sample, manifest, {'bit': 'float32'})
+    assert cache.load('processed', key) is None
+    cache.save('processed', key, {'noob_meth': [1.0]})
+    assert StageCache(tmp_path / 'cache').load('processed', key) == {'noob_meth': [1.0]}
+    # a change to the stage's parameters, the manifest or an IDAT is a different key
+    assert cache.key('processed', sample, manifest, {'bit': 'float16'}) != key
+    assert StageCache(tmp_path / 'cache').key('processed', sample, fake_manifest([1, 2, 4]), {'bit': 'float32'}) != key
+    assert manifest_fingerprint(manifest) == manifest_fingerprint(fake_manifest([1, 2, 3]))
+    sample.get_filepath('idat', Channel.RED).write_bytes(b'rescanned')
+    assert StageCache(tmp_path / 'cache').key('processed', sample, manifest, {'bit': 'float32'}) != key
+
+
+def test_stage_cache_evicts_least_recently_used(tmp_path):
+    cache = StageCache(tmp_path / 'cache', max_size=3500)
+    for i, key in enumerate(['a', 'b', 'c']):
+        cache.save('pvalues', key, b'x' * 1000)
+        os.utime(cache._entry('pvalues', key), (i, i)) # saved in this order
+    # 'a' was used last, so the oldest entry is 'b'
+    assert cache.load('pvalues', 'a') is not None
+    cache.save('pvalues', 'd', b'x' * 1000)
+    assert cache.size() > 3500 # saving does not evict; run_pipeline evicts once per batch
+    cache.evict()
+    assert [key for key in 'abcd' if cache.load('pvalues', key) is not None] == ['a', 'c', 'd']
+    assert cache.size() <= 3500
+
+
+def test_stage_cache_fingerprints_each_manifest_object(tmp_path, fake_sample, monkeypatch):
+    cache = StageCache(tmp_path / 'cache')
+    sample = fake_sample('200000000001')
+    key = cache.key('processed', sample, fake_manifest([1, 2, 3]), {'bit': 'float32'})
+    gc.collect()
+    assert not cache_module._FINGERPRINTS # memos go away with their manifest
+    # a later manifest that is given the id() of a garbage-collected one still gets its own fingerprint
+    monkeypatch.setattr(cache_module, 'id', lambda obj: 1, raising=False)
+    assert cache.key('processed', sample, fake_manifest([1, 2, 4]), {'bit': 'float32'}) != key
+    assert cache.key('processed', sample, fake_manifest([1, 2, 3]), {'bit': 'float32'}) == key
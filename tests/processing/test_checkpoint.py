@@ -0,0 +1,32 @@
+import json
+import pandas as pd
+# App
+from methylprep.models import Channel
+from methylprep.processing.checkpoint import Checkpoint
+
+
+def test_checkpoint_resumes_unchanged_samples(tmp_path, fake_sample):
+    params = {'bit': 'float32', 'sesame': True}
+    samples = [fake_sample(f'20000000000{i}') for i in range(3)]
+    checkpoint = Checkpoint(tmp_path, params)
+    for sample in samples[:2]:
+        result = (pd.DataFrame({'beta_value': [0.5]}, index=[str(sample)]), None, None)
+        checkpoint.record(sample, result, array_type='450k')
+    with open(checkpoint.journal_path, 'a') as f:
+        f.write('{"sample_id": "2000000000') # a journal line cut short by a crash
+    # a new run with the same parameters
+    checkpoint = Checkpoint(tmp_path, params)
+    assert sorted(checkpoint.entries) == ['200000000000_R01C01', '200000000001_R01C01']
+    assert checkpoint.load(samples[0])[0].loc['200000000000_R01C01', 'beta_value'] == 0.5
+    assert checkpoint.array_type(samples[0]) == '450k'
+    assert checkpoint.load(samples[2]) is None
+    # a changed IDAT is processed again
+    samples[1].get_filepath('idat', Channel.RED).write_bytes(b'rescanned')
+    assert Checkpoint(tmp_path, params).load(samples[1]) is None
+    # and so is everything, if the parameters change
+    checkpoint = Checkpoint(tmp_path, dict(params, bit='float64'))
+    assert checkpoint.entries == {} and checkpoint.load(samples[0]) is None
+    with open(checkpoint.path / 'params.json') as f:
+        assert json.load(f)['params']['bit'] == 'float64'
+    checkpoint.clear()
+    assert not checkpoint.path.exists()
@@ -0,0 +1,135 @@
+import math
+import numpy as np
+import pandas as pd
+from scipy.interpolate import interp1d
+# App
+from methylprep.processing.dye_bias import (
+    get_ranks,
+    qnorm_using_target,
+    _same_N_interpol,
+    _transfer_curve,
+    _apply_transfer_curve,
+)
+
+
+def loop_qnorm_using_target(data, target):
+    """ line-by-line port of preprocessCore's using_target(), the pre-v1.7.2 implementation """
+    nrows = data.shape[0]
+    float_eps = np.finfo(np.float32).eps
+    dimat = sorted([(data[i, 0], i) for i in range(nrows) if not np.isnan(data[i, 0])], key=lambda k: k[0])
+    non_na = len(dimat)
+    ranks = np.zeros(non_na)
+    i = 0
+    while i < non_na:
+        j = i
+        while j < non_na - 1 and dimat[j][0] == dimat[j + 1][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j + 2) / 2.0
+        i = j + 1
+    for i, (_, ind) in enumerate(dimat):
+        if non_na == nrows:
+            if (ranks[i] - math.floor(ranks[i])) > 0.4:
+                data[ind, 0] = 0.5*(target[int(math.floor(ranks[i])-1)] + target[int(math.floor(ranks[i]))])
+            else:
+                data[ind, 0] = target[int(math.floor(ranks[i])-1)]
+            continue
+        samplepercentile = float(ranks[i] - 1)/float(non_na - 1)
+        target_ind_double = 1.0 + (float(nrows) - 1.0) * samplepercentile
+        target_ind_double_floor = math.floor(target_ind_double + 4*float_eps)
+        target_ind_double = target_ind_double - target_ind_double_floor
+        if math.fabs(target_ind_double) <= 4*float_eps:
+            target_ind_double = 0.0
+        if target_ind_double == 0.0:
+            data[ind, 0] = target[int(math.floor(target_ind_double_floor + 0.5)) - 1]
+        elif target_ind_double == 1.0:
+            data[ind, 0] = target[int(math.floor(target_ind_double_floor + 1.5)) - 1]
+        else:
+            target_ind = int(math.floor(target_ind_double_floor + 0.5))
+            if 0 < target_ind < nrows:
+                data[ind, 0] = (1.0 - target_ind_double)*target[target_ind-1] + target_ind_double*target[target_ind]
+            elif target_ind >= nrows:
+                data[ind, 0] = target[nrows-1]
+            else:
+                data[ind, 0] = target[0]
+    return data[:, 0]
+
+
+def test_get_ranks_averages_ties():
+    assert np.array_equal(get_ranks(np.array([1., 2., 2., 3., 5., 5., 5.])), [1, 2.5, 2.5, 4, 6, 6, 6])
+    assert np.array_equal(get_ranks(np.array([4.])), [1])
+    assert len(get_ranks(np.array([]))) == 0
+
+
+def test_qnorm_using_target_matches_loop_version():
+    rng = np.random.default_rng(0)
+    for trial in range(20):
+        n = int(rng.integers(2, 2000))
+        # rounded intensities give lots of ties, like real noob values
+        data = rng.integers(1, int(rng.integers(3, 400)), n).astype(float)
+        if trial % 2:
+            data[rng.uniform(size=n) < 0.1] = np.nan
+        target = np.sort(rng.exponential(1000, n))
+        expected = loop_qnorm_using_target(data.copy()[:, None], target)
+        result = qnorm_using_target(data.copy()[:, None], target[:, None])
+        assert np.array_equal(result, expected, equal_nan=True), f"trial {trial}"
+
+
+def test_same_N_interpol_matches_interp1d_extrapolation():
+    values = np.sort(np.random.default_rng(1).exponential(1000, 500))
+    for num in (100, 499, 500, 1234):
+        expected = interp1d(np.arange(values.size), values, fill_value="extrapolate")(np.linspace(0, values.size, num=num))
+        assert np.allclose(_same_N_interpol(values, num), expected, rtol=1e-12, atol=0)
+
+
+def test_apply_transfer_curve_support_regions():
+    x1 = np.array([10., 20., 30., 40.])
+    curve = _transfer_curve(x1, np.array([12., 24., 30., 44.]), min_x=10., max_x=40.)
+    parts = [
+        pd.Series([np.nan, 15., 40.], index=['a', 'b', 'c'], name='noob_Meth', dtype='float32'),
+        pd.Series([5., 50.], index=['d', 'e'], name='noob_Unmeth', dtype='float32'),
+    ]
+    first, second = _apply_transfer_curve(curve, parts)
+    assert list(first.index) == ['a', 'b', 'c'] and list(second.index) == ['d', 'e']
+    assert np.isnan(first['a'])
+    assert first['b'] == 18 # in-support: interpolated along the curve
+    assert first['c'] == 44
+    assert second['d'] == 6 # under-support: scaled by min_mid / min
+    assert second['e'] == 54 # over-support: shifted by max_mid - max
+
+
+def loop_fit_func(data, x1, xmid, min_x, max_x):
+    """ the pre-v1.7.2 fit_func_red / fit_func_green, applied to one probe subset at a time with pandas .loc """
+    max_mid = max(xmid)
+    min_mid = min(xmid)
+    _x1 = np.array(x1)
+    _xmid = np.array(xmid)
+    insupp = ((data >= np.nanmin(min_x)) & (data <= np.nanmax(max_x)) & ~data.isna())
+    oversupp = (data > max_x) & ~data.isna()
+    undersupp = (data < min_x) & ~data.isna()
+    mask = ~np.isnan(_x1) & ~np.isnan(_xmid)
+    yinterp = np.interp(x=data.loc[insupp], xp=_x1[mask], fp=_xmid[mask], period=None, left=None, right=None)
+    data.loc[insupp] = yinterp
+    data.loc[oversupp] = data.loc[oversupp] - max_x + max_mid
+    data.loc[undersupp] = data.loc[undersupp] * (min_mid / min_x)
+    return data
+
+
+def test_apply_transfer_curve_matches_loop_version():
+    rng = np.random.default_rng(2)
+    for trial in range(10):
+        # a channel's sorted Meth + Unmeth intensities and their midpoints with the other channel's qnorm values
+        x1 = np.sort(rng.integers(50, 20000, int(rng.integers(50, 3000))).astype(float))
+        xmid = (x1 + np.sort(rng.exponential(4000, x1.size))) / 2.0
+        min_x, max_x = x1.min(), x1.max()
+        # probe subsets of different sizes, with values under, inside and over the curve's support, and NaNs
+        parts = []
+        for size in rng.integers(0, 800, 4):
+            values = rng.uniform(1, 30000, size).astype('float32').round()
+            values[rng.uniform(size=size) < 0.05] = np.nan
+            parts.append(pd.Series(values, index=[f'cg{trial}_{len(parts)}_{i}' for i in range(size)], name='noob_Meth'))
+        expected = [loop_fit_func(part.astype('float32').copy(), x1.tolist(), xmid, min_x, max_x).round() for part in parts]
+        result = _apply_transfer_curve(_transfer_curve(x1, xmid, min_x, max_x), parts)
+        for old, new in zip(expected, result):
+            assert new.index.equals(old.index) and new.name == old.name
+            assert np.array_equal(new.to_numpy(), old.to_numpy(), equal_nan=True), f"trial {trial}"
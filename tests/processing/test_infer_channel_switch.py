@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+# App
+from methylprep.models import ProbeType, Channel
+from methylprep.processing.infer_channel_switch import (
+    infer_type_I_probes,
+    get_channel_plan,
+    get_infer_channel_probes,
+)
+
+
+class FakeManifest():
+    """ type-I red and green probes, plus type II probes that channel inference ignores """
+
+    def __init__(self, n=3000):
+        rng = np.random.default_rng(1)
+        names = np.array([f'cg{i:08d}' for i in rng.permutation(n)])
+        addresses = rng.permutation(np.arange(10000, 10000 + 2*n))
+        self.data_frame = pd.DataFrame({
+            'AddressA_ID': pd.array(addresses[:n], dtype='Int64'),
+            'AddressB_ID': pd.array(np.where(np.arange(n) % 3 == 0, pd.NA, addresses[n:]), dtype='Int64'),
+            'probe_type': np.where(np.arange(n) % 3 == 0, 'II', 'I'),
+            'Color_Channel': np.where(np.arange(n) % 3 == 0, None, np.where(np.arange(n) % 3 == 1, 'Red', 'Grn')),
+        }, index=pd.Index(names, name='IlmnID'))
+
+    def get_probe_details(self, probe_type, channel=None):
+        frame = self.data_frame[self.data_frame['probe_type'] == probe_type.value]
+        return frame[frame['Color_Channel'] == channel.value]
+
+
+class FakeIdat():
+    def __init__(self, probe_means):
+        self.probe_means = probe_means
+
+
+class FakeContainer():
+    def __init__(self, manifest, seed=0):
+        rng = np.random.default_rng(seed)
+        addresses = np.sort(np.r_[
+            manifest.data_frame['AddressA_ID'].dropna().to_numpy(dtype=int),
+            manifest.data_frame['AddressB_ID'].dropna().to_numpy(dtype=int)])
+        addresses = addresses[rng.uniform(size=addresses.size) > 0.01] # a few addresses missing from the idats
+        index = pd.Index(addresses, name='illumina_id')
+        def probe_means():
+            # mostly bright in-band, dim out-of-band values, with overlap so that some probes switch or fail
+            values = np.where(rng.uniform(size=index.size) < 0.5, rng.exponential(3000, index.size), rng.normal(400, 150, index.size))
+            return pd.DataFrame({'mean_value': np.clip(values, 1, 65535).astype('uint16'), 'n_beads': 10}, index=index)
+        self.manifest = manifest
+        self.green_idat = FakeIdat(probe_means())
+        self.red_idat = FakeIdat(probe_means())
+
+
+def dataframe_infer_type_I_probes(container):
+    """ the pre-v1.7.2 DataFrame version: switched probe names and the swapped idat mean_values """
+    channels = get_infer_channel_probes(container.manifest, container.green_idat, container.red_idat)
+    green, red = channels['green'].dropna(), channels['red'].dropna()
+    red_max, green_max = red.max(axis=1), green.max(axis=1)
+    red_idx = red_max > green_max
+    min_ib = pd.DataFrame(np.minimum(red.min(axis=1), green.min(axis=1))).quantile(0.95, axis=0).values[0]
+    big_idx = np.maximum(red_max, green_max) > min_ib
+    R2G = red.index[red.index.isin(channels['IR'].index) & ~red_idx & big_idx]
+    G2R = green.index[green.index.isin(channels['IG'].index) & red_idx & big_idx]
+    lookup = channels['lookup']
+    switched = lookup[lookup.index.isin(R2G.append(G2R))]
+    mask = container.red_idat.probe_means.index.isin(switched['AddressA_ID'].to_list() + switched['AddressB_ID'].to_list())
+    post_red = container.red_idat.probe_means['mean_value'].copy()
+    post_green = container.green_idat.probe_means['mean_value'].copy()
+    post_red[mask] = container.green_idat.probe_means.loc[mask, 'mean_value']
+    post_green[mask] = container.red_idat.probe_means.loc[mask, 'mean_value']
+    return list(R2G), list(G2R), post_red, post_green
+
+
+def test_infer_type_I_probes_matches_dataframe_version():
+    manifest = FakeManifest()
+    for seed in range(3):
+        container = FakeContainer(manifest, seed)
+        red_switched, green_switched, post_red, post_green = dataframe_infer_type_I_probes(container)
+        assert red_switched and green_switched
+        infer_type_I_probes(container)
+        assert container.red_switched == red_switched
+        assert container.green_switched == green_switched
+        assert container.red_idat.probe_means['mean_value'].equals(post_red)
+        assert container.green_idat.probe_means['mean_value'].equals(post_green)
+        assert container.red_idat.probe_means['n_beads'].eq(10).all()
+
+
+def test_channel_plan_is_computed_once_per_manifest():
+    manifest = FakeManifest()
+    plan = get_channel_plan(manifest)
+    assert get_channel_plan(manifest) is plan
+    assert list(plan['IlmnID']) == sorted(plan['IlmnID'])
+    IR = manifest.get_probe_details(ProbeType.ONE, Channel.RED)
+    assert plan['is_IR'].sum() == len(IR)
+    assert set(plan['IlmnID'][plan['is_IR']]) == set(IR.index)
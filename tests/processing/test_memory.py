@@ -0,0 +1,42 @@
+import pytest
+# App
+from methylprep.processing.memory import (
+    CONTAINER_BYTES_PER_PROBE,
+    MAIN_BYTES_PER_PROBE,
+    OUTPUT_BYTES_PER_PROBE,
+    WORKER_BYTES_PER_PROBE,
+    available_cpus,
+    available_memory,
+    parse_memory,
+    plan_batches,
+)
+
+
+def test_parse_memory():
+    assert parse_memory('16G') == 16 * 1024**3
+    assert parse_memory('512mb') == 512 * 1024**2
+    assert parse_memory('1.5GiB') == int(1.5 * 1024**3)
+    assert parse_memory(1000) == 1000
+    with pytest.raises(ValueError):
+        parse_memory('lots')
+
+
+def test_plan_batches_stays_under_max_memory():
+    probes = 865918 # EPIC
+    per_sample = probes * (CONTAINER_BYTES_PER_PROBE + 4 * OUTPUT_BYTES_PER_PROBE)
+    for max_memory, n_jobs in (('8G', None), ('64G', 4), ('3G', 16)):
+        batch_size, workers = plan_batches(3000, probes, max_memory=max_memory, n_jobs=n_jobs, n_outputs=4)
+        assert 1 <= workers <= (n_jobs or available_cpus())
+        used = probes * MAIN_BYTES_PER_PROBE + workers * probes * WORKER_BYTES_PER_PROBE + batch_size * per_sample
+        assert used <= parse_memory(max_memory)
+        assert used + per_sample > parse_memory(max_memory) # and the batch is as big as fits
+    # a few samples that fit together are one batch
+    assert plan_batches(10, probes, max_memory='64G', n_jobs=2) == (None, 2)
+    # too little memory still processes, one sample at a time
+    assert plan_batches(10, probes, max_memory='1G', n_jobs=4) == (1, 1)
+
+
+def test_available_memory_and_cpus():
+    memory = available_memory()
+    assert memory is None or memory > 0
+    assert available_cpus() >= 1
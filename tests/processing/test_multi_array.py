@@ -0,0 +1,75 @@
+import struct
+from types import SimpleNamespace
+import pandas as pd
+import pytest
+# App
+from methylprep.files import IdatDataset
+from methylprep.models import ArrayType
+from methylprep.processing import pipeline, run_pipeline
+from methylprep.processing.multi_array_idat_batches import partition_by_array_type
+
+
+def write_idat_header(path, probe_count):
+    """ an IDAT with only the header and its probe count section (1000), which is all the array type comes from """
+    with open(path, 'wb') as f:
+        f.write(b'IDAT' + struct.pack('<q', 3) + struct.pack('<i', 1))
+        f.write(struct.pack('<H', 1000) + struct.pack('<q', 26))
+        f.write(struct.pack('<i', probe_count))
+
+
+def write_sample_folder(folder, sentrix_ids, probe_count):
+    folder.mkdir()
+    rows = []
+    for i, sentrix_id in enumerate(sentrix_ids):
+        for channel in ('Grn', 'Red'):
+            write_idat_header(folder / f'{sentrix_id}_R01C01_{channel}.idat', probe_count)
+        rows.append({'Sample_Name': f'{folder.name}_{i}', 'Sentrix_ID': sentrix_id, 'Sentrix_Position': 'R01C01'})
+    pd.DataFrame(rows).to_csv(folder / 'samplesheet.csv', index=False)
+
+
+def test_partition_by_array_type(tmp_path):
+    write_sample_folder(tmp_path / 'GPL13534', ['200000000001', '200000000002'], 622399)
+    write_sample_folder(tmp_path / 'GPL21145', ['200000000003'], 1051815)
+    assert IdatDataset.read_probe_count(tmp_path / 'GPL21145' / '200000000003_R01C01_Grn.idat') == 1051815
+    partitions = sorted(partition_by_array_type(tmp_path), key=lambda partition: partition.label)
+    assert [partition.array_type for partition in partitions] == [ArrayType.ILLUMINA_450K, ArrayType.ILLUMINA_EPIC]
+    assert [sample.sentrix_id for sample in partitions[0].get_samples()] == ['200000000001', '200000000002']
+    assert partitions[1].get_sample('GPL21145_0').sentrix_id == '200000000003'
+    meta = partitions[0].build_meta_data(partitions[0].get_samples())
+    assert meta['Sample_ID'].tolist() == ['200000000001_R01C01', '200000000002_R01C01']
+
+
+def test_run_pipeline_mixed_arrays_needs_their_own_manifests(tmp_path):
+    write_sample_folder(tmp_path / 'GPL13534', ['200000000001'], 622399)
+    write_sample_folder(tmp_path / 'GPL21145', ['200000000003'], 1051815)
+    with pytest.raises(ValueError, match='several array types'):
+        run_pipeline(str(tmp_path), manifest_filepath=str(tmp_path / 'manifest.csv'))
+
+
+def test_run_pipeline_saves_each_array_type_in_its_folder(stub_pipeline, monkeypatch, tmp_path):
+    # stub_pipeline replaces reading and processing the IDATs; the sample sheets and IDAT headers are real
+    monkeypatch.setattr(pipeline, 'Manifest', lambda array_type, filepath=None: SimpleNamespace(array_type=array_type))
+    write_sample_folder(tmp_path / 'GPL13534', ['200000000001', '200000000002'], 622399)
+    write_sample_folder(tmp_path / 'GPL21145', ['200000000003'], 1051815)
+    partitions = partition_by_array_type(tmp_path)
+    run_args = dict(array_type=None, manifest_filepath=None, betas=True, results='files', kwargs={})
+    outputs = pipeline._run_array_partitions(tmp_path, partitions, run_args)
+    assert sorted(outputs) == ['450k', 'epic']
+    assert outputs['450k'].paths['beta_values'] == [tmp_path / '450k' / 'beta_values.pkl']
+    assert sorted(outputs['450k']['beta_values'].columns) == ['200000000001_R01C01', '200000000002_R01C01']
+    assert list(outputs['epic']['beta_values'].columns) == ['200000000003_R01C01']
+    assert not (tmp_path / 'beta_values.pkl').exists()
+    # and run_pipeline splits the folder the same way, with batches
+    outputs = run_pipeline(str(tmp_path), betas=True, results='files', batch_size=1)
+    assert sorted(outputs['450k']['beta_values'].columns) == ['200000000001_R01C01', '200000000002_R01C01']
+    assert list(outputs['epic']['beta_values'].columns) == ['200000000003_R01C01']
+
+
+def test_batch_merge_only_reads_this_runs_parts(stub_pipeline, tmp_path):
+    stale = pd.DataFrame({'999999999999_R01C01': [0.5]}, index=pd.Index(['cg00000000'], name='IlmnID'))
+    for folder in (tmp_path / '450k', tmp_path / '.methylprep_shards' / 'outputs' / 'shard_00000.g0'):
+        folder.mkdir(parents=True)
+        stale.to_pickle(folder / 'beta_values_1.pkl')
+    stale.to_pickle(tmp_path / 'beta_values_3.pkl') # a part left by an earlier run with more batches
+    betas = stub_pipeline(n_samples=3, betas=True, batch_size=2, results='files')['beta_values']
+    assert sorted(betas.columns) == ['200000000000_R01C01', '200000000001_R01C01', '200000000002_R01C01']
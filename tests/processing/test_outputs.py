@@ -0,0 +1,221 @@
+import pickle
+import threading
+import time
+import numpy as np
+import pandas as pd
+import pytest
+# App
+from methylprep.processing import MatrixWriter, ProcessedOutputs, load_matrix, pipeline, run_pipeline
+from methylprep.processing.outputs import ExportWriter, append_outputs, existing_sample_ids
+
+
+def test_processed_outputs_load_lazily(tmp_path):
+    index = pd.Index([f'cg{i:08d}' for i in range(10)], name='IlmnID')
+    part1 = pd.DataFrame(np.random.default_rng(0).uniform(size=(10, 2)), index=index, columns=['s1', 's2'])
+    part2 = pd.DataFrame(np.random.default_rng(1).uniform(size=(10, 1)), index=index, columns=['s3'])
+    part1.to_pickle(tmp_path / 'beta_values_1.pkl')
+    part2.to_pickle(tmp_path / 'beta_values_2.pkl')
+    with open(tmp_path / 'control_probes.pkl', 'wb') as f:
+        pickle.dump({'s1': part1[['s1']]}, f)
+    outputs = ProcessedOutputs()
+    outputs.add('beta_values', [tmp_path / 'beta_values_1.pkl', tmp_path / 'beta_values_2.pkl'])
+    outputs.add('control_probes', tmp_path / 'control_probes.pkl')
+    (tmp_path / 'control_probes.pkl').unlink() # nothing is read until asked for
+    assert 'control_probes' in outputs and 'm_values' not in outputs
+    assert list(outputs) == ['beta_values', 'control_probes']
+    assert outputs['beta_values'].equals(pd.concat([part1, part2], axis='columns'))
+    with pytest.raises(FileNotFoundError):
+        outputs['control_probes']
+    with pytest.raises(KeyError):
+        outputs['m_values']
+
+
+def test_run_pipeline_results_option():
+    with pytest.raises(ValueError):
+        run_pipeline('docs/example_data/GSE69852', results='containers')
+    with pytest.raises(ValueError):
+        run_pipeline('docs/example_data/GSE69852', file_format='npy')
+
+
+def test_matrix_writer_matches_consolidated_frame(tmp_path):
+    rng = np.random.default_rng(0)
+    probes = pd.Index([f'cg{i:08d}' for i in rng.permutation(50)], name='IlmnID') # unsorted, like a manifest
+    samples = {f'20000000000{i}_R01C01': rng.uniform(size=50).astype('float32') for i in (3, 1, 2, 0)}
+    samples['200000000002_R01C01'][5] = np.nan
+    expected = pd.DataFrame(samples, index=probes).sort_index().reindex(sorted(samples), axis=1)
+    for file_format in ('pickle', 'npy'):
+        writer = MatrixWriter(tmp_path, f'beta_values_{file_format}', probes, list(samples))
+        for sample_id, values in samples.items():
+            if sample_id == '200000000001_R01C01': # one sample arrives in another probe order
+                order = rng.permutation(50)
+                writer.write(sample_id, values[order], probes=probes[order])
+            else:
+                writer.write(sample_id, values, probes=probes)
+        with pytest.raises(ValueError):
+            writer.write('200000000000_R01C01', values) # already written
+        path = writer.finalize(file_format)
+        saved = pd.read_pickle(path) if file_format == 'pickle' else load_matrix(path)
+        assert saved.equals(expected)
+        assert not writer.temp_path.exists()
+    assert not load_matrix(tmp_path / 'beta_values_npy.npy').values.flags.writeable # a view of the read-only memmap
+    outputs = ProcessedOutputs({'beta_values': tmp_path / 'beta_values_npy.npy'}, {'beta_values': 'npy'})
+    assert outputs['beta_values'].equals(expected)
+
+
+def test_matrix_writer_uint16_and_unwritten_samples(tmp_path):
+    probes = pd.Index(['cg2', 'cg1', 'cg3'], name='IlmnID')
+    writer = MatrixWriter(tmp_path, 'noob_meth_values', probes, ['s2', 's1', 's3'])
+    writer.write('s1', np.array([200., 100., 300.]))
+    writer.write('s3', np.array([20., 10., 30.]))
+    saved = pd.read_pickle(writer.finalize('pickle', uint16=True))
+    assert list(saved.columns) == ['s1', 's3'] and list(saved.index) == ['cg1', 'cg2', 'cg3']
+    assert saved.dtypes.unique().tolist() == [np.dtype('uint16')]
+    assert saved['s1'].tolist() == [100, 200, 300]
+    writer = MatrixWriter(tmp_path, 'noob_meth_values', probes, ['s2', 's1', 's3'])
+    writer.write('s1', np.array([200., np.nan, 300.]))
+    saved = load_matrix(writer.finalize('npy', uint16=True))
+    assert saved['s2'].isna().all() and np.isnan(saved.loc['cg1', 's1'])
+
+
+def test_append_outputs_adds_new_samples(tmp_path):
+    rng = np.random.default_rng(0)
+    index = pd.Index([f'cg{i:08d}' for i in range(20)], name='IlmnID')
+    old = pd.DataFrame(rng.integers(1, 1000, (20, 2)), index=index, columns=['s1', 's2']).astype('uint16')
+    old.to_pickle(tmp_path / 'noob_meth_values.pkl')
+    old.T.astype('float32').to_pickle(tmp_path / 'beta_values.pkl') # saved with samples in rows
+    with open(tmp_path / 'control_probes.pkl', 'wb') as f:
+        pickle.dump({'s1': old[['s1']], 's2': old[['s2']]}, f)
+    assert existing_sample_ids(tmp_path, ['beta_values', 'noob_meth_values', 'm_values']) == {'s1', 's2'}
+    # a run's outputs for sample s3 (and s2 again), saved in a staging folder
+    staging = tmp_path / '.methylprep_append'
+    staging.mkdir()
+    new = pd.DataFrame(rng.integers(1, 1000, (20, 2)), index=index, columns=['s3', 's2']).astype('float32')
+    new.to_pickle(staging / 'noob_meth_values.pkl')
+    new.to_pickle(staging / 'beta_values.pkl')
+    with open(staging / 'control_probes.pkl', 'wb') as f:
+        pickle.dump({'s3': new[['s3']]}, f)
+    staged = ProcessedOutputs({name: staging / f'{name}.pkl' for name in ('noob_meth_values', 'beta_values', 'control_probes')})
+    outputs = append_outputs(staged, tmp_path, uint16=['noob_meth_values'])
+    assert outputs.paths['beta_values'] == [tmp_path / 'beta_values.pkl'] and not staging.exists()
+    expected = pd.concat([old[['s1']], new[['s2', 's3']]], axis='columns')
+    assert outputs['noob_meth_values'].equals(expected.astype('uint16'))
+    assert outputs['beta_values'].equals(expected.astype('float32'))
+    assert sorted(outputs['control_probes']) == ['s1', 's2', 's3']
+    assert not list(tmp_path.glob('.*.append'))
+
+
+def test_append_npy_is_replaced_with_the_other_outputs(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    index = pd.Index([f'cg{i:08d}' for i in range(20)], name='IlmnID')
+    def save(data_dir, frame):
+        writer = MatrixWriter(data_dir, 'beta_values', index, list(frame.columns))
+        for sample_id in frame.columns:
+            writer.write(sample_id, frame[sample_id].to_numpy())
+        writer.finalize('npy')
+    old = pd.DataFrame(rng.uniform(size=(20, 2)), index=index, columns=['s1', 's2']).astype('float32')
+    save(tmp_path, old)
+    old.to_pickle(tmp_path / 'm_values.pkl')
+    def files():
+        return {path.name: path.read_bytes() for path in tmp_path.glob('[!.]*')}
+    saved = files()
+    staging = tmp_path / '.methylprep_append'
+    staging.mkdir()
+    new = pd.DataFrame(rng.uniform(size=(20, 1)), index=index, columns=['s3']).astype('float32')
+    save(staging, new)
+    new.to_pickle(staging / 'm_values.pkl')
+    staged = ProcessedOutputs({'beta_values': staging / 'beta_values.npy', 'm_values': staging / 'm_values.pkl'},
+        {'beta_values': 'npy', 'm_values': 'pickle'})
+    def fail(*args, **kwargs):
+        raise OSError('disk full')
+    with monkeypatch.context() as patch:
+        patch.setattr('methylprep.processing.outputs._append_matrix', fail)
+        with pytest.raises(OSError):
+            append_outputs(staged, tmp_path)
+    # the npy matrix and its index are untouched until every output is combined
+    assert files() == saved
+    outputs = append_outputs(staged, tmp_path)
+    expected = pd.concat([old, new], axis='columns')
+    assert load_matrix(tmp_path / 'beta_values.npy').equals(expected)
+    assert outputs['m_values'].equals(expected)
+    assert sorted(files()) == ['beta_values.index.json', 'beta_values.npy', 'm_values.pkl']
+    assert not list(tmp_path.glob('.beta_values*')) and not list(tmp_path.glob('.m_values*'))
+
+
+def test_export_writer_back_pressure_and_errors():
+    release = threading.Event()
+    written = []
+    def write(name):
+        release.wait(5)
+        if name == 'bad':
+            raise OSError('disk full')
+        written.append(name)
+    writer = ExportWriter(workers=1, max_pending=2)
+    writer.submit(write, 'a')
+    writer.submit(write, 'b')
+    # a third write waits until one of the two pending ones is saved
+    third = threading.Thread(target=writer.submit, args=(write, 'c'))
+    third.start()
+    third.join(0.2)
+    assert third.is_alive()
+    release.set()
+    third.join(5)
+    writer.wait()
+    assert written == ['a', 'b', 'c']
+    # a failed write raises in the thread that submits or waits
+    writer.submit(write, 'bad')
+    with pytest.raises(OSError, match='disk full'):
+        writer.close()
+
+
+@pytest.mark.parametrize('export', [False, True])
+def test_stream_outputs_match_batch_outputs(stub_pipeline, tmp_path, export):
+    batch = stub_pipeline(betas=True, export=export, results='files')
+    expected = {name: batch[name] for name in ('beta_values', 'noob_meth_values', 'noob_unmeth_values')}
+    streamed = stub_pipeline(betas=True, export=export, results='files', stream_outputs=True)
+    for name, frame in expected.items():
+        pd.testing.assert_frame_equal(streamed[name].sort_index(), frame.sort_index(), check_names=False)
+    if export:
+        exported = sorted(tmp_path.glob('*_processed.csv'))
+        assert len(exported) == 3
+        assert pd.read_csv(exported[0], index_col=0)['quality_mask'].notna().all()
+
+
+def test_stream_outputs_follow_bit(stub_pipeline):
+    batch = stub_pipeline(betas=True, bit='float16')
+    streamed = stub_pipeline(betas=True, bit='float16', stream_outputs=True)
+    assert (batch.dtypes == 'float16').all() and (streamed.dtypes == 'float16').all()
+    pd.testing.assert_frame_equal(streamed.sort_index(), batch.sort_index(), check_names=False)
+
+
+def test_stream_outputs_discarded_when_a_run_fails(stub_pipeline, monkeypatch, tmp_path):
+    process_sample = pipeline._process_sample # the stub
+    def fail_on_last_sample(idat_dataset_pair, manifest, **kwargs):
+        if idat_dataset_pair['sample'].name == 'Sample_2':
+            raise RuntimeError('unreadable IDAT')
+        return process_sample(idat_dataset_pair, manifest, **kwargs)
+    monkeypatch.setattr(pipeline, '_process_sample', fail_on_last_sample)
+    with pytest.raises(RuntimeError):
+        stub_pipeline(betas=True, stream_outputs=True)
+    assert list(tmp_path.glob('.*.partial.npy')) == []
+    assert list(tmp_path.glob('beta_values*')) == []
+
+
+def test_exports_stop_when_a_run_fails(stub_pipeline, monkeypatch, tmp_path):
+    process_sample = pipeline._process_sample # the stub
+    write_export = pipeline._write_export
+    def slow_write_export(*args):
+        time.sleep(0.2)
+        write_export(*args)
+    def fail_on_third_sample(idat_dataset_pair, manifest, **kwargs):
+        if idat_dataset_pair['sample'].name == 'Sample_2':
+            raise RuntimeError('unreadable IDAT')
+        return process_sample(idat_dataset_pair, manifest, **kwargs)
+    monkeypatch.setattr(pipeline, '_write_export', slow_write_export)
+    monkeypatch.setattr(pipeline, '_process_sample', fail_on_third_sample)
+    with pytest.raises(RuntimeError):
+        stub_pipeline(n_samples=4, export=True, stream_outputs=True)
+    exported = sorted(tmp_path.glob('*_processed.csv'))
+    time.sleep(0.5)
+    # the export threads were stopped with the run: nothing is written after it failed
+    assert sorted(tmp_path.glob('*_processed.csv')) == exported
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith('methylprep-export')]
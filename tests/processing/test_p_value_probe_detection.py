@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+from scipy import stats
+from statsmodels.distributions.empirical_distribution import ECDF
+# App
+from methylprep.processing.p_value_probe_detection import (
+    _pval_sesame_preprocess,
+    _pval_neg_ecdf,
+    pval_ecdf_batch,
+    detect_probes,
+)
+
+
+class FakeSigSet():
+    """ the SigSet subsets that poobah reads, with synthetic (rounded, so tied) intensities """
+    debug = False
+
+    def __init__(self, seed=0):
+        rng = np.random.default_rng(seed)
+        def probes(prefix, n, scale):
+            return pd.DataFrame({
+                'Meth': rng.exponential(scale, n).round().astype('float32'),
+                'Unmeth': rng.exponential(scale, n).round().astype('float32'),
+            }, index=pd.Index([f'{prefix}{i:06d}' for i in range(n)], name='IlmnID'))
+        def controls(n):
+            return pd.DataFrame({
+                'Control_Type': ['NEGATIVE'] * n + ['NORM_A'] * 5,
+                'Extended_Type': [f'Negative {i}' for i in range(n)] + [f'Norm_A {i}' for i in range(5)],
+                'mean_value': rng.normal(400, 100, n + 5).round().astype('float32'),
+            })
+        self.IR = probes('cgR', 300, 2000)
+        self.IG = probes('cgG', 200, 2000)
+        self.II = probes('cgII', 800, 2000)
+        self.oobR = probes('cgG', 200, 400)
+        self.oobG = probes('cgR', 300, 400)
+        self.ctrl_red = controls(60)
+        self.ctrl_green = controls(60)
+        self.sample = f'sample{seed}'
+        # what detect_probes reads: the manifest and a data frame of uncorrected intensities, in another probe order
+        self.man = pd.concat([
+            pd.DataFrame({'Infinium_Design_Type': 'I', 'Color_Channel': 'Red'}, index=self.IR.index),
+            pd.DataFrame({'Infinium_Design_Type': 'I', 'Color_Channel': 'Grn'}, index=self.IG.index),
+            pd.DataFrame({'Infinium_Design_Type': 'II', 'Color_Channel': None}, index=self.II.index),
+        ])
+        self._SampleDataContainer__data_frame = pd.concat([self.II, self.IG, self.IR]).rename(
+            columns={'Meth': 'meth', 'Unmeth': 'unmeth'}).sort_index()
+
+
+def statsmodels_poobah(container, combine_neg=True):
+    """ the pre-v1.7.2 statsmodels ECDF version of _pval_sesame_preprocess """
+    bgG = list(container.oobG['Unmeth'].values) + list(container.oobG['Meth'].values)
+    bgR = list(container.oobR['Unmeth'].values) + list(container.oobR['Meth'].values)
+    if combine_neg:
+        bgG += list(container.ctrl_green.loc[container.ctrl_green['Control_Type'] == 'NEGATIVE', 'mean_value'].values)
+        bgR += list(container.ctrl_red.loc[container.ctrl_red['Control_Type'] == 'NEGATIVE', 'mean_value'].values)
+    funcG, funcR = ECDF(bgG), ECDF(bgR)
+    return np.concatenate([
+        1 - np.maximum(funcR(container.IR['Meth']), funcR(container.IR['Unmeth'])),
+        1 - np.maximum(funcG(container.IG['Meth']), funcG(container.IG['Unmeth'])),
+        1 - np.maximum(funcG(container.II['Meth']), funcR(container.II['Unmeth'])),
+    ])
+
+
+def test_poobah_matches_statsmodels_ecdf():
+    container = FakeSigSet()
+    for combine_neg in (True, False):
+        pval = _pval_sesame_preprocess(container, combine_neg=combine_neg)
+        assert list(pval.columns) == ['poobah_pval']
+        assert pval.index.equals(container.IR.index.append(container.IG.index).append(container.II.index))
+        assert np.array_equal(pval['poobah_pval'].to_numpy(), statsmodels_poobah(container, combine_neg))
+
+
+def test_pneg_ecdf_matches_statsmodels_ecdf():
+    container = FakeSigSet()
+    funcG = ECDF(container.ctrl_green.loc[container.ctrl_green['Control_Type'] == 'NEGATIVE', 'mean_value'].values)
+    funcR = ECDF(container.ctrl_red.loc[container.ctrl_red['Control_Type'] == 'NEGATIVE', 'mean_value'].values)
+    pval = _pval_neg_ecdf(container)
+    assert list(pval.columns) == ['pNegECDF_pval']
+    assert np.array_equal(pval.loc[container.II.index, 'pNegECDF_pval'].to_numpy(),
+        1 - np.maximum(funcG(container.II['Meth']), funcR(container.II['Unmeth'])))
+
+
+def test_pval_ecdf_batch_matches_per_sample():
+    containers = [FakeSigSet(seed) for seed in range(3)]
+    # probe columns in IR, IG, II order, like the per-sample output
+    meth = np.vstack([np.concatenate([c.IR['Meth'], c.IG['Meth'], c.II['Meth']]) for c in containers])
+    unmeth = np.vstack([np.concatenate([c.IR['Unmeth'], c.IG['Unmeth'], c.II['Unmeth']]) for c in containers])
+    n_IR, n_IG, n_II = len(containers[0].IR), len(containers[0].IG), len(containers[0].II)
+    red_meth = np.r_[np.ones(n_IR, bool), np.zeros(n_IG + n_II, bool)]
+    red_unmeth = np.r_[np.ones(n_IR, bool), np.zeros(n_IG, bool), np.ones(n_II, bool)]
+    bg_green = [np.concatenate([c.oobG['Unmeth'], c.oobG['Meth'], c.ctrl_green['mean_value'][:60]]) for c in containers]
+    bg_red = [np.concatenate([c.oobR['Unmeth'], c.oobR['Meth'], c.ctrl_red['mean_value'][:60]]) for c in containers]
+    batch = pval_ecdf_batch(meth, unmeth, red_meth, red_unmeth, bg_green, bg_red)
+    assert batch.shape == (3, n_IR + n_IG + n_II)
+    for row, container in zip(batch, containers):
+        assert np.array_equal(row, _pval_sesame_preprocess(container)['poobah_pval'].to_numpy())
+
+
+def test_detect_probes_sesame_matches_per_sample_poobah():
+    containers = [FakeSigSet(seed) for seed in range(5)]
+    for chunk_size in (2, 100):
+        pval = detect_probes(containers, method='sesame', chunk_size=chunk_size)
+        assert list(pval.columns) == [c.sample for c in containers]
+        for container in containers:
+            expected = _pval_sesame_preprocess(container)['poobah_pval']
+            assert np.array_equal(pval.loc[expected.index, container.sample].to_numpy(), expected.to_numpy())
+
+
+def test_detect_probes_minfi_matches_normal_fit():
+    containers = [FakeSigSet(seed) for seed in range(5)]
+    pval = detect_probes(containers, method='minfi', chunk_size=2)
+    for container in containers:
+        negG = container.ctrl_green['mean_value'][:60].to_numpy(dtype='float64')
+        negR = container.ctrl_red['mean_value'][:60].to_numpy(dtype='float64')
+        muG, sdG = np.median(negG), stats.median_abs_deviation(negG, scale='normal')
+        muR, sdR = np.median(negR), stats.median_abs_deviation(negR, scale='normal')
+        frame = container._SampleDataContainer__data_frame
+        total = (frame['meth'] + frame['unmeth']).astype('float64')
+        IR, IG, II = container.IR.index, container.IG.index, container.II.index
+        assert np.allclose(pval.loc[IR, container.sample], 1 - stats.norm.cdf(total[IR], 2*muR, 2*sdR))
+        assert np.allclose(pval.loc[IG, container.sample], 1 - stats.norm.cdf(total[IG], 2*muG, 2*sdG))
+        assert np.allclose(pval.loc[II, container.sample], 1 - stats.norm.cdf(total[II], muR + muG, sdR + sdG))
@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+import pandas as pd
+import pytest
+# App
+from methylprep.processing import pipeline
+
+
+def test_n_jobs_validation():
+    assert pipeline._resolve_n_jobs(None) == 1
+    assert pipeline._resolve_n_jobs(3) == 3
+    assert pipeline._resolve_n_jobs(-1) >= 1
+    for n_jobs in (0, -2, 1.5, '2', True):
+        with pytest.raises(ValueError):
+            pipeline._resolve_n_jobs(n_jobs)
+    with pytest.raises(ValueError):
+        pipeline.run_pipeline('docs/example_data/GSE69852', n_jobs=0)
+
+
+def test_pool_reports_every_failed_sample():
+    # idat pairs without idats: every sample fails inside its worker
+    idat_datasets = [{'sample': f'Sample_{i}', 'green_idat': None, 'red_idat': None} for i in range(3)]
+    sample_kwargs = dict(container_kwargs={}, export=False, file_format='pickle', save_control=False, low_memory=True)
+    with pytest.raises(RuntimeError) as error:
+        list(pipeline._process_samples_in_pool(idat_datasets, None, 2, sample_kwargs))
+    assert '3 of 3 samples failed' in str(error.value)
+    for i in range(3):
+        assert f'Sample_{i}:' in str(error.value)
+
+
+@pytest.mark.parametrize('stream_outputs', [False, True])
+def test_n_jobs_gives_the_same_outputs(stub_pipeline, tmp_path, stream_outputs):
+    # the stubbed _process_sample is inherited by the forked workers; results come back pickled, in sample order
+    def run(n_jobs):
+        outputs = stub_pipeline(n_samples=5, betas=True, export=True, results='files', n_jobs=n_jobs,
+            stream_outputs=stream_outputs)
+        frames = {name: outputs[name] for name in ('beta_values', 'noob_meth_values', 'noob_unmeth_values')}
+        exported = {path.name: pd.read_csv(path, index_col=0) for path in sorted(tmp_path.glob('*_processed.csv'))}
+        return frames, exported
+    serial_frames, serial_exported = run(1)
+    pooled_frames, pooled_exported = run(2)
+    for name, frame in serial_frames.items():
+        pd.testing.assert_frame_equal(pooled_frames[name], frame)
+    assert list(pooled_exported) == list(serial_exported) and len(serial_exported) == 5
+    for name, frame in serial_exported.items():
+        pd.testing.assert_frame_equal(pooled_exported[name], frame)
+
+
+def test_pool_yields_results_as_they_arrive(stub_pipeline):
+    # stub_pipeline replaces _process_sample; the forked workers inherit it
+    samples = [SimpleNamespace(name=f'Sample_{i}', sentrix_id=f'200000000{i:03d}', sentrix_position='R01C01') for i in range(8)]
+    sample_kwargs = dict(container_kwargs={}, export=False, file_format='pickle', save_control=False, low_memory=True)
+    pooled = pipeline._process_samples_in_pool([{'sample': sample} for sample in samples], None, 2, sample_kwargs)
+    container, _, _ = next(pooled) # the first result, while later samples are still processing
+    assert container.sample.name == 'Sample_0'
+    assert [container.sample.name for container, _, _ in pooled] == [f'Sample_{i}' for i in range(1, 8)]
+    # an on_result error (a checkpoint that can't be saved, ...) is not a sample failure: it stops the run as it is
+    def record(idat_dataset_pair, result):
+        raise OSError('disk full')
+    with pytest.raises(OSError):
+        list(pipeline._process_samples_in_pool([{'sample': sample} for sample in samples], None, 2, sample_kwargs, on_result=record))
@@ -0,0 +1,56 @@
+# App
+from methylprep.processing import make_pipeline, run_pipeline, PipelinePlan
+from methylprep.processing.plan import build_plan
+
+
+def test_make_pipeline_plan_only_skips_unused_columns():
+    plan = make_pipeline('.', steps=['all'], exports=[], estimator='beta', plan_only=True)
+    assert isinstance(plan, PipelinePlan)
+    assert plan.stages == ['read_idats', 'infer_channel_switch', 'poobah', 'quality_mask', 'noob', 'dye_bias', 'beta_value']
+    assert plan.columns == ['beta_value'] and 'm_value' in plan.skipped
+    assert plan.outputs == ['beta_values', 'noob_meth_values', 'noob_unmeth_values']
+    assert plan.returns == 'beta_values'
+    # a CSV export, or returned containers, needs every column
+    assert make_pipeline('.', steps=['noob'], exports=['csv'], estimator='m_value', plan_only=True).columns == ['beta_value', 'm_value']
+    assert make_pipeline('.', steps=['noob'], exports=[], estimator=None, plan_only=True).columns == ['beta_value', 'm_value']
+
+
+def test_run_pipeline_plan_only():
+    plan = run_pipeline('.', m_value=True, pneg_ecdf=True, results='files', plan_only=True)
+    assert plan.columns == ['m_value'] and plan.returns == 'files'
+    assert 'pneg_ecdf' not in plan.stages and 'pneg_ecdf' in plan.skipped
+    plan = run_pipeline('.', m_value=True, pneg_ecdf=True, export_poobah=True, batch_size=500, plan_only=True)
+    assert 'pneg_ecdf' in plan.stages and 'pNegECDF_values' in plan.outputs and plan.returns is None
+
+
+def test_build_plan_runs_poobah_only_when_needed():
+    matrix_outputs = {'beta_value': ('beta_values', False, False), 'poobah_pval': ('poobah_values', False, False)}
+    # exporting the p-values needs the poobah stage, even without the filter
+    plan = build_plan(matrix_outputs, poobah=False, dye_bias=False, returns='beta_values', meta_data_frame=False, do_mouse=False)
+    assert plan.outputs == ['beta_values', 'poobah_values'] and 'poobah' in plan.stages
+    assert 'noob (linear dye bias)' in plan.stages and 'dye_bias' not in plan.stages
+    plan = build_plan({'beta_value': ('beta_values', False, False)}, poobah=False, returns='beta_values')
+    assert 'poobah' not in plan.stages and 'skipped poobah' in repr(plan)
+    # make_pipeline steps without 'poobah' leave it out, and skip the p-value export
+    plan = build_plan(matrix_outputs, poobah=False, returns='beta_values', meta_data_frame=False, do_mouse=False, poobah_step=False)
+    assert plan.outputs == ['beta_values'] and 'poobah' not in plan.stages
+    assert 'skipped poobah_values' in repr(plan)
+
+
+def test_run_pipeline_poobah_follows_sesame_unless_set():
+    assert 'poobah' in run_pipeline('.', betas=True, plan_only=True).stages
+    assert 'poobah' not in run_pipeline('.', betas=True, sesame=False, plan_only=True).stages
+    # sesame no longer forces the filter on
+    plan = run_pipeline('.', betas=True, poobah=False, plan_only=True)
+    assert 'poobah' not in plan.stages and 'quality_mask' in plan.stages
+    plan = run_pipeline('.', betas=True, poobah=False, export_poobah=True, plan_only=True)
+    assert 'poobah' in plan.stages and 'poobah_values' in plan.outputs
+
+
+def test_sesame_without_poobah_runs_to_the_end(synthetic_idats, tmp_path):
+    # run_pipeline used to force poobah=True with sesame, in case sesame without poobah hung
+    manifest_filepath = synthetic_idats(n_samples=2)
+    betas = run_pipeline(tmp_path, array_type='450k', manifest_filepath=manifest_filepath, betas=True, poobah=False)
+    filtered = run_pipeline(tmp_path, array_type='450k', manifest_filepath=manifest_filepath, betas=True)
+    assert betas.shape == filtered.shape == (1800, 2)
+    assert betas.isna().sum().sum() < filtered.isna().sum().sum()
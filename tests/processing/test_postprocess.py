@@ -0,0 +1,161 @@
+import numpy as np
+import pandas as pd
+import pytest
+# App
+from methylprep.processing.postprocess import (
+    calculate_beta_value,
+    calculate_m_value,
+    consolidate_values,
+    consolidate_values_for_sheet,
+    rethreshold,
+    rethreshold_values,
+)
+
+
+def saved_outputs(seed=0, probes=500, samples=4):
+    """ synthetic poobah_values, noob_meth_values, noob_unmeth_values, shaped like run_pipeline pickles """
+    rng = np.random.default_rng(seed)
+    index = pd.Index([f'cg{i:08d}' for i in range(probes)], name='IlmnID')
+    columns = [f'20000000000{i}_R01C01' for i in range(samples)]
+    def frame(values):
+        return pd.DataFrame(values.astype('float32'), index=index, columns=columns)
+    poobah = frame(rng.uniform(0, 0.1, (probes, samples)))
+    meth = frame(rng.exponential(5000, (probes, samples)).round())
+    unmeth = frame(rng.exponential(5000, (probes, samples)).round())
+    return poobah, meth, unmeth
+
+
+def test_rethreshold_values_matches_nan_filtering():
+    poobah, meth, unmeth = saved_outputs()
+    outputs = rethreshold_values(poobah, meth, unmeth, poobah_sig=0.02)
+    failed = poobah >= 0.02
+    expected_beta = pd.DataFrame(calculate_beta_value(meth.mask(failed).to_numpy(), unmeth.mask(failed).to_numpy(), offset=0), index=meth.index, columns=meth.columns)
+    expected_m = pd.DataFrame(calculate_m_value(meth.mask(failed).to_numpy(), unmeth.mask(failed).to_numpy()), index=meth.index, columns=meth.columns)
+    assert set(outputs) == {'beta_values', 'm_values'}
+    assert outputs['beta_values'].dtypes.unique().tolist() == [np.dtype('float32')]
+    assert np.allclose(outputs['beta_values'], expected_beta, equal_nan=True)
+    assert np.allclose(outputs['m_values'], expected_m, equal_nan=True)
+    assert outputs['beta_values'].isna().equals(failed)
+    # minfi offset, chunking and transposed (samples in rows) inputs give the same answer
+    minfi = rethreshold_values(poobah.T, meth.T, unmeth, poobah_sig=0.02, sesame=False, m_value=False, chunk_size=3)
+    assert list(minfi) == ['beta_values']
+    assert np.allclose(minfi['beta_values'], calculate_beta_value(meth.mask(failed).to_numpy(), unmeth.mask(failed).to_numpy(), offset=100), equal_nan=True)
+
+
+def test_rethreshold_values_quality_mask():
+    poobah, meth, unmeth = saved_outputs()
+    with pytest.raises(ValueError):
+        rethreshold_values(poobah, meth, unmeth, quality_mask=True)
+    outputs = rethreshold_values(poobah, meth, unmeth, poobah_sig=None, quality_mask=True, array_type='450k', m_value=False,
+        run_poobah_sig=None)
+    # synthetic probe names are not in the 450k quality_mask, and no poobah filter: nothing is removed
+    assert outputs['beta_values'].isna().sum().sum() == 0
+
+
+def test_rethreshold_reads_and_writes_pickles(tmp_path):
+    poobah, meth, unmeth = saved_outputs()
+    poobah.to_pickle(tmp_path / 'poobah_values.pkl')
+    meth.to_pickle(tmp_path / 'noob_meth_values.pkl')
+    unmeth.to_pickle(tmp_path / 'noob_unmeth_values.pkl')
+    saved = rethreshold(tmp_path, poobah_sig=0.01, out_dir=tmp_path / 'strict')
+    assert sorted(path.name for path in saved) == ['beta_values.pkl', 'm_values.pkl']
+    betas = pd.read_pickle(tmp_path / 'strict' / 'beta_values.pkl')
+    assert betas.isna().equals(poobah >= 0.01)
+    with pytest.raises(FileNotFoundError):
+        rethreshold(tmp_path / 'strict')
+
+
+def test_rethreshold_values_reads_the_orientation_from_the_probe_names():
+    # more samples than probes, but saved with probes in rows: the IlmnID index says so, not the shape
+    poobah, meth, unmeth = saved_outputs(probes=3, samples=6)
+    outputs = rethreshold_values(poobah, meth, unmeth, poobah_sig=0.02)
+    assert outputs['beta_values'].shape == (3, 6)
+    assert outputs['beta_values'].isna().equals(poobah >= 0.02)
+    # saved with samples in rows and unnamed axes: the sentrix_id_position rows are samples
+    unnamed = [frame.rename_axis(None).T for frame in (poobah, meth, unmeth)]
+    assert rethreshold_values(*unnamed, poobah_sig=0.02)['beta_values'].rename_axis('IlmnID').equals(outputs['beta_values'])
+
+
+def test_rethreshold_cli_refuses_to_loosen(tmp_path, capsys):
+    from methylprep import cli
+    poobah, meth, unmeth = saved_outputs()
+    for name, frame in (('poobah_values', poobah), ('noob_meth_values', meth), ('noob_unmeth_values', unmeth)):
+        frame.to_pickle(tmp_path / f'{name}.pkl')
+    with pytest.raises(SystemExit) as error:
+        cli.cli_rethreshold(['-d', str(tmp_path), '--poobah_sig', '0.1'])
+    assert error.value.code == 2
+    assert 'looser than the --run_poobah_sig 0.05' in capsys.readouterr().err
+    assert not (tmp_path / 'beta_values.pkl').exists()
+    cli.cli_rethreshold(['-d', str(tmp_path), '--poobah_sig', '0.1', '--run_poobah_sig', 'none'])
+    assert pd.read_pickle(tmp_path / 'beta_values.pkl').isna().equals(poobah >= 0.1)
+
+
+class FakeContainer():
+    """ the parts of a processed SampleDataContainer that consolidation reads """
+
+    def __init__(self, seed, quality_mask=True):
+        rng = np.random.default_rng(seed)
+        index = pd.Index([f'cg{i:08d}' for i in range(300)] + [f'rs{i:05d}' for i in range(5)], name='IlmnID')
+        self.sample = type('Sample', (), {'sentrix_id': f'20000000000{seed}', 'sentrix_position': 'R01C01'})
+        self.quality_mask = quality_mask
+        self._SampleDataContainer__data_frame = pd.DataFrame({
+            'noob_meth': rng.exponential(5000, len(index)).round(),
+            'beta_value': rng.uniform(size=len(index)),
+            'poobah_pval': rng.uniform(0, 0.1, len(index)),
+            'quality_mask': np.where(rng.uniform(size=len(index)) < 0.1, 0.0, 1.0),
+        }, index=index)
+
+
+def pandas_consolidation(containers, column, poobah):
+    """ the pre-v1.7.2 consolidate_values_for_sheet, without modifying the containers """
+    columns = {}
+    for container in containers:
+        frame = container._SampleDataContainer__data_frame
+        values = frame[column].copy()
+        if poobah:
+            values[frame['poobah_pval'] >= 0.05] = np.nan
+        if container.quality_mask:
+            values[frame['quality_mask'] == 0] = np.nan
+        columns[f"{container.sample.sentrix_id}_{container.sample.sentrix_position}"] = values[~frame.index.str.startswith('rs')]
+    return pd.DataFrame(columns)
+
+
+def test_consolidate_values_matches_per_column_consolidation():
+    containers = [FakeContainer(seed, quality_mask=bool(seed % 2)) for seed in range(4)]
+    before = [container._SampleDataContainer__data_frame.copy() for container in containers]
+    outputs = consolidate_values(containers, {'beta_value': True, 'noob_meth': True, 'poobah_pval': False})
+    assert list(outputs) == ['beta_value', 'noob_meth', 'poobah_pval']
+    for column, poobah in (('beta_value', True), ('noob_meth', True), ('poobah_pval', False)):
+        expected = pandas_consolidation(containers, column, poobah)
+        assert outputs[column].dtypes.unique().tolist() == [np.dtype('float32')]
+        assert outputs[column].index.equals(expected.index) and list(outputs[column].columns) == list(expected.columns)
+        assert np.array_equal(outputs[column].to_numpy(), expected.to_numpy(dtype='float32'), equal_nan=True)
+    single = consolidate_values_for_sheet(containers, postprocess_func_colname='noob_meth', bit='float64')
+    assert single.dtypes.unique().tolist() == [np.dtype('float64')]
+    assert np.array_equal(single.to_numpy(), pandas_consolidation(containers, 'noob_meth', True).to_numpy(), equal_nan=True)
+    # the containers are not modified
+    for container, frame in zip(containers, before):
+        assert container._SampleDataContainer__data_frame.equals(frame)
+
+
+def test_run_pipeline_filters_outputs_at_poobah_sig(stub_pipeline):
+    for stream_outputs in (False, True):
+        default = stub_pipeline(betas=True, results='files', stream_outputs=stream_outputs)['beta_values']
+        strict = stub_pipeline(betas=True, results='files', stream_outputs=stream_outputs, poobah_sig=0.01)['beta_values']
+        # fake p-values are uniform in [0, 0.2): about a quarter pass at 0.05, a twentieth at 0.01
+        assert strict.isna().sum().sum() > default.isna().sum().sum()
+        assert strict.notna().sum().sum() < default.notna().sum().sum() / 2
+
+
+def test_rethreshold_loosens_only_unfiltered_runs(stub_pipeline, tmp_path):
+    stub_pipeline(betas=True, export_poobah=True) # filtered at the default poobah_sig, 0.05
+    with pytest.raises(ValueError):
+        rethreshold(tmp_path, poobah_sig=0.1, out_dir=tmp_path / 'loose')
+    stub_pipeline(betas=True, poobah=False, export_poobah=True) # p-values saved, noob values unfiltered
+    saved = rethreshold(tmp_path, poobah_sig=0.1, out_dir=tmp_path / 'loose', run_poobah_sig=None)
+    betas = pd.read_pickle(saved[0])
+    poobah = pd.read_pickle(tmp_path / 'poobah_values.pkl')
+    if poobah.columns.name == 'IlmnID':
+        poobah = poobah.transpose()
+    assert betas.isna().equals((poobah >= 0.1).reindex_like(betas))
+    assert 0 < betas.isna().sum().sum() < (poobah >= 0.05).sum().sum()
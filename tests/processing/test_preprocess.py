@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import norm
+# App
+from methylprep.processing.preprocess import (
+    BackgroundCorrectionParams,
+    apply_bg_correction,
+    apply_bg_correction_batch,
+    normexp_signal,
+    preprocess_noob,
+    preprocess_noob_arrays,
+)
+
+
+def scipy_stats_normexp(mean_values, params):
+    """ the frozen scipy.stats.norm form of apply_bg_correction, before v1.7.2 """
+    mu_sf = mean_values - params.bg_mean - (params.bg_mad ** 2) / params.mean_signal
+    signal = mu_sf + (params.bg_mad ** 2) * np.exp(norm(mu_sf, params.bg_mad).logpdf(0) - norm(mu_sf, params.bg_mad).logsf(0))
+    return np.maximum(signal, 1e-6) + params.offset
+
+
+def synthetic_intensities(seed=0, n=20000):
+    rng = np.random.default_rng(seed)
+    values = np.concatenate([rng.normal(400, 120, n // 2), rng.exponential(6000, n // 2)])
+    return np.clip(values, 1, 65535).round()
+
+
+def test_normexp_matches_scipy_stats():
+    values = synthetic_intensities()
+    params = BackgroundCorrectionParams(412.3, 95.1, 5800.2, 15)
+    expected = scipy_stats_normexp(values, params)
+    corrected = apply_bg_correction(values, params)
+    assert corrected.dtype == np.float64
+    assert np.allclose(corrected, expected, rtol=1e-10, atol=0)
+    # extremes: very dim, very bright, and very high background all stay finite and above the offset
+    extreme = normexp_signal(np.array([0., 1., 65535.]), 5000., 10., 500., 15)
+    assert np.isfinite(extreme).all() and (extreme >= 15).all()
+
+
+def test_normexp_writes_in_place_float32():
+    values = synthetic_intensities()
+    params = BackgroundCorrectionParams(412.3, 95.1, 5800.2, 15)
+    out = np.empty(values.shape, dtype='float32')
+    corrected = apply_bg_correction(values, params, out=out)
+    assert corrected is out
+    assert np.allclose(out, scipy_stats_normexp(values, params), rtol=1e-5, atol=0.01)
+    with pytest.raises(ValueError):
+        apply_bg_correction(values, params, out=np.empty(values.shape, dtype='float16'))
+    with pytest.raises(ValueError):
+        apply_bg_correction(values, (412.3, 95.1, 5800.2, 15))
+
+
+def test_normexp_batch_matches_per_sample():
+    values = np.vstack([synthetic_intensities(seed) for seed in range(3)])
+    params = [
+        BackgroundCorrectionParams(412.3, 95.1, 5800.2, 15),
+        BackgroundCorrectionParams(380.0, 140.6, 4100.9, 15),
+        BackgroundCorrectionParams(520.5, 60.2, 7300.0, 0),
+    ]
+    out = np.empty(values.shape, dtype='float64')
+    batch = apply_bg_correction_batch(values, params, out=out)
+    assert batch is out
+    for i, param in enumerate(params):
+        assert np.array_equal(batch[i], apply_bg_correction(values[i], param))
+    with pytest.raises(ValueError):
+        apply_bg_correction_batch(values, params[:2])
+
+
+class FakeSigSet():
+    """ just the SigSet attributes that NOOB reads, with synthetic intensities """
+    poobah_sig = 0.05
+
+    def __init__(self, seed=0, n=2000):
+        rng = np.random.default_rng(seed)
+        ids = pd.Index([f'cg{i:08d}' for i in range(n)], name='IlmnID')
+        def subset(part, bright):
+            index = ids[part]
+            size = len(index)
+            meth = (rng.exponential(6000, size) if bright else rng.normal(400, 120, size)).round().astype('float32')
+            unmeth = (rng.exponential(6000, size) if bright else rng.normal(400, 120, size)).round().astype('float32')
+            meth[:3] = [np.nan, 0, -5] # missing and sub-1 intensities
+            return pd.DataFrame({'Meth': meth, 'Unmeth': unmeth, 'used': 'M'}, index=index)
+        self.ibG = subset(slice(0, 1200), True)
+        self.ibR = subset(slice(800, 2000), True)
+        self.oobG = subset(slice(1200, 2000), False)
+        self.oobR = subset(slice(800, 1200), False)
+        self.sample = type('Sample', (), {'name': f'sample{seed}'})
+        self.pval_probes_df = pd.DataFrame({'poobah_pval': rng.uniform(0, 0.2, n)}, index=ids)
+        self.quality_mask_df = pd.DataFrame({'quality_mask': np.where(rng.uniform(size=n) < 0.1, np.nan, 1.0)}, index=ids).fillna(0)
+
+
+@pytest.mark.parametrize('masks', [False, True])
+def test_preprocess_noob_arrays_matches_reference(masks):
+    container = FakeSigSet()
+    kwargs = dict(pval_probes_df=container.pval_probes_df, quality_mask_df=container.quality_mask_df) if masks else {}
+    expected = preprocess_noob(container, unit_test_oob=True, **kwargs)
+    result = preprocess_noob_arrays(container, unit_test_oob=True, **kwargs)
+    for key in ('oobG', 'oobR'):
+        assert np.array_equal(result[key]['mean_value'].to_numpy(), expected[key]['mean_value'].to_numpy())
+    for key in ('noob_green', 'noob_red'):
+        for column in ('IlmnID', 'used', 'bg_corrected'):
+            assert np.array_equal(result[key][column].to_numpy(), expected[key][column].to_numpy()), f"{key} {column}"
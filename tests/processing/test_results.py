@@ -0,0 +1,39 @@
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+# App
+from methylprep.processing.postprocess import consolidate_values
+from methylprep.processing.results import ProcessedSample, SharedProbeIndex
+
+
+def fake_container(sentrix_position, seed):
+    """ the parts of a processed SampleDataContainer that ProcessedSample reads """
+    rng = np.random.default_rng(seed)
+    probes = pd.Index(['cg01', 'cg02', 'cg03', 'rs01']) # a separate index object per sample, like containers
+    frame = pd.DataFrame({
+        'noob_meth': rng.integers(100, 5000, 4).astype('float64'),
+        'noob_unmeth': rng.integers(100, 5000, 4).astype('float64'),
+        'poobah_pval': [0.001, 0.2, 0.013, 0.0],
+        'quality_mask': [1.0, 1.0, np.nan, 1.0],
+    }, index=probes)
+    frame['beta_value'] = frame['noob_meth'] / (frame['noob_meth'] + frame['noob_unmeth'])
+    sample = SimpleNamespace(sentrix_id='200000000000', sentrix_position=sentrix_position, name=sentrix_position)
+    return SimpleNamespace(data_frame=frame, sample=sample, quality_mask=True, mouse_data_frame=pd.DataFrame())
+
+
+def test_processed_sample_matches_its_container():
+    containers = [fake_container('R01C01', 0), fake_container('R02C01', 1)]
+    shared = SharedProbeIndex()
+    samples = [ProcessedSample.from_container(container, shared) for container in containers]
+    assert samples[0].probes is samples[1].probes
+    assert samples[0].sample_id == '200000000000_R01C01' and samples[0].mouse_data_frame is None
+    # integer-valued noob columns are kept as float32; others only if that is exact
+    assert samples[0].values['noob_meth'].dtype == np.float32
+    assert samples[0].values['poobah_pval'].dtype == np.float64
+    pd.testing.assert_frame_equal(samples[0].data_frame, containers[0].data_frame, check_dtype=False)
+    assert samples[1]['beta_value'].equals(containers[1].data_frame['beta_value'])
+    # and they consolidate like containers
+    columns = {'beta_value': True, 'noob_meth': True, 'poobah_pval': False}
+    expected = consolidate_values(containers, columns)
+    for column, frame in consolidate_values(samples, columns).items():
+        pd.testing.assert_frame_equal(frame, expected[column])
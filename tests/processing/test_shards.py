@@ -0,0 +1,57 @@
+import os
+import time
+import pandas as pd
+import pytest
+# App
+from methylprep.processing.outputs import ProcessedOutputs, merge_outputs
+from methylprep.processing.shards import ShardQueue
+
+
+def save_run(folder, sample_ids):
+    """ the outputs of one shard's run: a uint16-able matrix, its meta data and control probes """
+    folder.mkdir(parents=True, exist_ok=True)
+    outputs = ProcessedOutputs()
+    probes = ['cg01', 'cg02'] if len(sample_ids) > 1 else ['cg01', 'cg02', 'cg03']
+    matrix = pd.DataFrame({sample_id: [100.0 + i for i in range(len(probes))] for sample_id in sample_ids}, index=probes)
+    matrix.to_pickle(folder / 'noob_meth_values.pkl')
+    outputs.add('noob_meth_values', folder / 'noob_meth_values.pkl', 'pickle')
+    pd.DataFrame({'Sample_ID': sample_ids}).to_pickle(folder / 'sample_sheet_meta_data.pkl')
+    outputs.add('sample_sheet_meta_data', folder / 'sample_sheet_meta_data.pkl', 'pickle')
+    pd.to_pickle({sample_id: pd.DataFrame({'x': [1]}) for sample_id in sample_ids}, folder / 'control_probes.pkl')
+    outputs.add('control_probes', folder / 'control_probes.pkl', 'pickle')
+    return outputs
+
+
+def test_shard_claims_expire_and_are_done_once(tmp_path):
+    shards = [['A_R01C01', 'B_R01C01'], ['C_R01C01']]
+    first, second = ShardQueue(tmp_path, lease=60), ShardQueue(tmp_path, lease=60)
+    first.open(shards, {'betas': True})
+    assert second.open(shards, {'betas': True}) == shards
+    with pytest.raises(ValueError, match='other processing parameters'):
+        ShardQueue(tmp_path).open(shards, {'betas': False})
+
+    claim = first.claim('shard_00000')
+    assert claim is not None and second.claim('shard_00000') is None
+    # a claim that is not renewed for the lease is taken over by the next worker
+    stale = time.time() - 120
+    os.utime(claim, (stale, stale))
+    takeover = second.claim('shard_00000')
+    assert takeover.name == 'shard_00000.g1' and first.claim('shard_00000') is None
+
+    assert second.mark_done(0, takeover, save_run(second.output_dir(takeover), shards[0]))
+    assert not first.mark_done(0, claim, save_run(first.output_dir(claim), shards[0])) # the late copy loses
+    assert first.is_done(0) and not first.all_done()
+    third = first.claim('shard_00001')
+    assert first.mark_done(1, third, save_run(first.output_dir(third), shards[1]))
+    assert second.all_done() and second.finished() is None
+
+    merged = merge_outputs(second.done_outputs(), tmp_path, uint16=['noob_meth_values'])
+    second.finish(merged)
+    assert first.finished().paths == merged.paths
+    assert not (tmp_path / '.methylprep_shards' / 'outputs').exists()
+
+    betas = pd.read_pickle(tmp_path / 'noob_meth_values.pkl')
+    assert list(betas.columns) == ['A_R01C01', 'B_R01C01', 'C_R01C01'] and list(betas.index) == ['cg01', 'cg02', 'cg03']
+    assert betas.dtypes.iloc[0] == 'float32' # cg03 is missing for A and B, so not uint16
+    assert pd.read_pickle(tmp_path / 'sample_sheet_meta_data.pkl')['Sample_ID'].tolist() == ['A_R01C01', 'B_R01C01', 'C_R01C01']
+    assert sorted(pd.read_pickle(tmp_path / 'control_probes.pkl')) == ['A_R01C01', 'B_R01C01', 'C_R01C01']
@@ -51,11 +51,6 @@ def test_run_pipeline_all_the_invalid_kwargs():
         methylprep.run_pipeline(test_data_dir, blah='blah')
     with pytest.raises(ValueError):
         methylprep.run_pipeline(test_data_dir, batch_size='blah')
-    with pytest.raises(SystemExit) as excinfo:
-        methylprep.run_pipeline('docs/example_data')
-        # should be multiple arrays error
-        if "This folder contains idats for multiple types of arrays." not in str(excinfo.value):
-            raise AssertionError("docs/example_data contains idats for multiple types of arrays, but did not throw exception.")
 
 # untested parts of code:
 #  test_run_pipeline_noname_samplesheet
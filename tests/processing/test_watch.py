@@ -0,0 +1,27 @@
+import os
+import time
+# App
+from methylprep.processing.watch import find_ready_samples, _watch_sample_sheet
+
+
+def write_idat(path, age):
+    path.write_bytes(b'IDAT')
+    os.utime(path, (time.time() - age, time.time() - age))
+
+
+def test_find_ready_samples_needs_both_settled_channels(tmp_path):
+    write_idat(tmp_path / '200000000001_R01C01_Grn.idat', 120)
+    write_idat(tmp_path / '200000000001_R01C01_Red.idat', 120)
+    write_idat(tmp_path / '200000000002_R01C01_Grn.idat', 120) # Red not scanned yet
+    write_idat(tmp_path / '200000000003_R01C01_Grn.idat', 120)
+    write_idat(tmp_path / '200000000003_R01C01_Red.idat', 5) # still being written
+    (tmp_path / 'GPL13534').mkdir()
+    write_idat(tmp_path / 'GPL13534' / 'GSM1_200000000004_R02C01_Grn.idat', 120)
+    write_idat(tmp_path / 'GPL13534' / 'GSM1_200000000004_R02C01_Red.idat', 120)
+    ready = find_ready_samples(tmp_path, settle=60)
+    assert sorted(ready) == ['200000000001_R01C01', '200000000004_R02C01']
+    assert sorted(find_ready_samples(tmp_path, settle=1)) == ['200000000001_R01C01', '200000000003_R01C01', '200000000004_R02C01']
+    # without a sample sheet, the ready samples are named by their sentrix ids
+    samples = _watch_sample_sheet(tmp_path, None, ready).get_samples()
+    assert [(sample.name, sample.sentrix_id, sample.sentrix_position) for sample in samples] == [
+        ('200000000001_R01C01', '200000000001', 'R01C01'), ('200000000004_R02C01', '200000000004', 'R02C01')]
@@ -0,0 +1,24 @@
+import subprocess
+import sys
+import pytest
+
+
+def run_python(code):
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    return result.stdout.strip()
+
+
+HEAVY_MODULES = ('numpy', 'pandas', 'scipy', 'statsmodels', 'methylcheck', 'bs4', 'requests', 'methylprep.processing', 'methylprep.download')
+
+@pytest.mark.parametrize('statement', [
+    'import methylprep',
+    'from methylprep import cli; cli.build_parser',
+])
+def test_startup_does_not_import_heavy_modules(statement):
+    loaded = run_python(f"import sys; {statement}; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    assert loaded == '', f"`{statement}` imported {loaded}"
+
+
+def test_lazy_names_resolve():
+    assert run_python("import methylprep; print(methylprep.run_pipeline.__module__, methylprep.ArrayType.__name__)") == 'methylprep.processing.pipeline ArrayType'
+    assert run_python("from methylprep import *; print(callable(make_pipeline), callable(run_series))") == 'True True'
@@ -0,0 +1,56 @@
+import json
+import time
+import pandas as pd
+# App
+from methylprep.utils.profiling import (
+    active_profiler,
+    profile_stage,
+    profiling_sample,
+    start_profiling,
+    stop_profiling,
+)
+
+
+def test_profile_stage_does_nothing_when_not_profiling():
+    stop_profiling()
+    with profile_stage('noob'):
+        pass
+    assert active_profiler() is None
+
+
+def test_profiler_records_and_reports_stages(tmp_path):
+    profiler = start_profiling()
+    try:
+        profiler.batch = 1
+        for sample in ('200000000000_R01C01', '200000000000_R02C01'):
+            with profiling_sample(sample):
+                with profile_stage('noob'):
+                    data = [0.0] * 500000 # some memory
+                    time.sleep(0.01)
+                    del data
+                with profile_stage('poobah'):
+                    pass
+        with profile_stage('consolidate'):
+            pass
+    finally:
+        stop_profiling()
+    records = profiler.frame()
+    assert list(records['stage']) == ['noob', 'poobah', 'noob', 'poobah', 'consolidate']
+    assert list(records['sample'])[:2] == ['200000000000_R01C01'] * 2
+    assert pd.isna(records['sample'].iloc[-1]) # batch-level stage
+    assert (records['batch'] == 1).all()
+    noob = records[records['stage'] == 'noob']
+    assert (noob['wall_s'] >= 0.01).all() and (noob['peak_rss_mb'] > 0).all()
+
+    summary = profiler.summary()
+    assert list(summary) == ['noob', 'poobah', 'consolidate']
+    assert summary['noob']['count'] == 2
+    assert summary['noob']['wall_s_p50'] <= summary['noob']['wall_s_p99'] <= summary['noob']['wall_s_max']
+    assert 'noob' in profiler.batch_summary(1)
+
+    json_path, csv_path = profiler.write_report(tmp_path / 'methylprep_profile')
+    with open(json_path) as f:
+        report = json.load(f)
+    assert set(report['samples']) == {'200000000000_R01C01', '200000000000_R02C01'}
+    assert report['stages']['poobah']['count'] == 2 and len(report['records']) == 5
+    assert len(pd.read_csv(csv_path)) == 5